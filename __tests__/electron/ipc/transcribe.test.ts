@@ -43,6 +43,44 @@ describe("IPC: Transcribe", () => {
     setupTranscriptionHandlers();
   });
 
+  afterEach(() => {
+    const { stopTranscriptionWorker } = require("@/electron/ipc/transcribe");
+    stopTranscriptionWorker();
+  });
+
+  const createMockProcess = () => {
+    const listeners: Record<string, Function> = {};
+    return {
+      stdin: {
+        write: jest.fn(),
+        end: jest.fn(),
+        on: jest.fn((event: string, callback: Function) => {
+          listeners[`stdin:${event}`] = callback;
+        }),
+      },
+      kill: jest.fn(),
+      stdout: {
+        on: jest.fn((event: string, callback: Function) => {
+          listeners[`stdout:${event}`] = callback;
+        }),
+      },
+      stderr: {
+        on: jest.fn((event: string, callback: Function) => {
+          listeners[`stderr:${event}`] = callback;
+        }),
+      },
+      on: jest.fn((event: string, callback: Function) => {
+        listeners[event] = callback;
+      }),
+      emit: (key: string, ...args: any[]) => listeners[key]?.(...args),
+    } as any;
+  };
+
+  const lastRequest = (mockProcess: any) => {
+    const calls = mockProcess.stdin.write.mock.calls;
+    return JSON.parse(calls[calls.length - 1][0]);
+  };
+
   const invoke = async (channel: string, ...args: any[]) => {
     const handler = handlers[channel];
     if (!handler) {
@@ -65,84 +103,175 @@ describe("IPC: Transcribe", () => {
       expect(result.message).toContain("Python実行環境が見つかりません");
     });
 
-    it("successfully returns LRC from python process", async () => {
+    it("successfully returns LRC from the worker process", async () => {
       (fs.existsSync as jest.Mock).mockReturnValue(true);
-
-      const mockStdout = JSON.stringify({
-        status: "success",
-        lrc: "[00:00.00]Test LRC",
-      });
-
-      const mockProcess: any = {
-        stdout: { on: jest.fn() },
-        stderr: { on: jest.fn() },
-        on: jest.fn(),
-      };
-
+      const mockProcess = createMockProcess();
       (spawn as jest.Mock).mockReturnValue(mockProcess);
 
-      // Simulate stdout data
-      mockProcess.stdout.on.mockImplementation(
-        (event: string, callback: Function) => {
-          if (event === "data") {
-            callback(Buffer.from(mockStdout));
-          }
-        },
-      );
-
-      // Simulate process close
-      mockProcess.on.mockImplementation((event: string, callback: Function) => {
-        if (event === "close") {
-          callback(0);
-        }
-      });
-
-      const result = await invoke(
+      const pending = invoke(
         "transcribe:generate-lrc",
         "test.mp3",
         "test lyrics",
       );
 
+      const request = lastRequest(mockProcess);
+      expect(request).toMatchObject({
+        command: "generate",
+        audio_path: "test.mp3",
+        lyrics: "test lyrics",
+      });
+      mockProcess.emit(
+        "stdout:data",
+        Buffer.from(
+          JSON.stringify({
+            id: request.id,
+            status: "success",
+            lrc: "[00:00.00]Test LRC",
+          }) + "\n",
+        ),
+      );
+
+      const result = await pending;
       expect(result.status).toBe("success");
       expect(result.lrc).toBe("[00:00.00]Test LRC");
-      expect(spawn).toHaveBeenCalled();
+      expect(result.id).toBeUndefined();
+      expect(spawn).toHaveBeenCalledWith(
+        expect.any(String),
+        expect.arrayContaining(["--server"]),
+      );
     });
 
     it("returns error if python process fails", async () => {
       (fs.existsSync as jest.Mock).mockReturnValue(true);
+      const mockProcess = createMockProcess();
+      (spawn as jest.Mock).mockReturnValue(mockProcess);
 
-      const mockProcess: any = {
-        stdout: { on: jest.fn() },
-        stderr: { on: jest.fn() },
-        on: jest.fn(),
-      };
+      const pending = invoke(
+        "transcribe:generate-lrc",
+        "test.mp3",
+        "test lyrics",
+      );
+      mockProcess.emit("stderr:data", Buffer.from("Traceback..."));
+      mockProcess.emit("close", 1);
 
+      const result = await pending;
+      expect(result.status).toBe("error");
+      expect(result.message).toContain(
+        "トランスクライブエンジンの実行に失敗しました",
+      );
+    });
+
+    it("reuses the running worker for subsequent requests", async () => {
+      (fs.existsSync as jest.Mock).mockReturnValue(true);
+      const mockProcess = createMockProcess();
       (spawn as jest.Mock).mockReturnValue(mockProcess);
 
-      mockProcess.stderr.on.mockImplementation(
-        (event: string, callback: Function) => {
-          if (event === "data") {
-            callback(Buffer.from("Traceback..."));
-          }
-        },
+      const first = invoke("transcribe:generate-lrc", "a.mp3", "first");
+      const second = invoke("transcribe:generate-lrc", "b.mp3", "second");
+      const [firstRequest, secondRequest] =
+        mockProcess.stdin.write.mock.calls.map((call: any[]) =>
+          JSON.parse(call[0]),
+        );
+      expect(firstRequest.id).not.toBe(secondRequest.id);
+
+      // 応答は順不同かつ複数チャンクに分かれて届いてもよい
+      const payload =
+        JSON.stringify({ id: secondRequest.id, status: "success", lrc: "B" }) +
+        "\n" +
+        JSON.stringify({ id: firstRequest.id, status: "success", lrc: "A" }) +
+        "\n";
+      mockProcess.emit("stdout:data", Buffer.from(payload.slice(0, 10)));
+      mockProcess.emit("stdout:data", Buffer.from(payload.slice(10)));
+
+      expect((await first).lrc).toBe("A");
+      expect((await second).lrc).toBe("B");
+      expect(spawn).toHaveBeenCalledTimes(1);
+    });
+
+    it("restarts the worker after it exits", async () => {
+      (fs.existsSync as jest.Mock).mockReturnValue(true);
+      const crashed = createMockProcess();
+      const restarted = createMockProcess();
+      (spawn as jest.Mock)
+        .mockReturnValueOnce(crashed)
+        .mockReturnValueOnce(restarted);
+
+      const first = invoke("transcribe:generate-lrc", "a.mp3", "first");
+      crashed.emit("close", 1);
+      expect((await first).status).toBe("error");
+
+      const second = invoke("transcribe:generate-lrc", "a.mp3", "second");
+      restarted.emit(
+        "stdout:data",
+        Buffer.from(
+          JSON.stringify({
+            id: lastRequest(restarted).id,
+            status: "success",
+            lrc: "ok",
+          }) + "\n",
+        ),
       );
+      expect((await second).lrc).toBe("ok");
+      expect(spawn).toHaveBeenCalledTimes(2);
+    });
+
+    it("returns an error and restarts when writing to the worker fails", async () => {
+      (fs.existsSync as jest.Mock).mockReturnValue(true);
+      const broken = createMockProcess();
+      const restarted = createMockProcess();
+      (spawn as jest.Mock)
+        .mockReturnValueOnce(broken)
+        .mockReturnValueOnce(restarted);
+
+      const first = invoke("transcribe:generate-lrc", "a.mp3", "first");
+      const second = invoke("transcribe:generate-lrc", "b.mp3", "second");
+      // ワーカーが終了した直後の書き込みは stdin の error (EPIPE) になる
+      const epipe = Object.assign(new Error("write EPIPE"), { code: "EPIPE" });
+      expect(() => broken.emit("stdin:error", epipe)).not.toThrow();
 
-      mockProcess.on.mockImplementation((event: string, callback: Function) => {
-        if (event === "close") {
-          callback(1);
-        }
+      expect((await first).status).toBe("error");
+      expect((await second).status).toBe("error");
+      expect(broken.kill).toHaveBeenCalled();
+
+      // 遅れて届く close では何も起きず、次のリクエストは新しいワーカーで処理する
+      broken.emit("close", null);
+      const third = invoke("transcribe:generate-lrc", "c.mp3", "third");
+      restarted.emit(
+        "stdout:data",
+        Buffer.from(
+          JSON.stringify({
+            id: lastRequest(restarted).id,
+            status: "success",
+            lrc: "ok",
+          }) + "\n",
+        ),
+      );
+      expect((await third).lrc).toBe("ok");
+      expect(spawn).toHaveBeenCalledTimes(2);
+    });
+
+    it("forwards the requested tier to the worker", async () => {
+      (fs.existsSync as jest.Mock).mockReturnValue(true);
+      const mockProcess = createMockProcess();
+      (spawn as jest.Mock).mockReturnValue(mockProcess);
+
+      invoke("transcribe:generate-lrc", "test.mp3", "test lyrics", "fast");
+
+      expect(lastRequest(mockProcess)).toMatchObject({
+        command: "generate",
+        tier: "fast",
       });
+    });
 
+    it("returns an error object for an unknown tier", async () => {
       const result = await invoke(
         "transcribe:generate-lrc",
         "test.mp3",
         "test lyrics",
+        "ultra",
       );
-
       expect(result.status).toBe("error");
-      expect(result.message).toContain(
-        "トランスクライブエンジンの実行に失敗しました",
-      );
+      expect(spawn).not.toHaveBeenCalled();
     });
 
     it("returns an error object (not a rejection) on invalid input", async () => {
@@ -211,8 +211,12 @@ export interface ElectronAPI {
 
   // 文字起こし
   transcribe: {
-    // LRCファイルを生成
-    generateLrc: (audioPath: string, lyricsText: string) => Promise<{ status: string; lrc?: string; message?: string }>;
+    // LRCファイルを生成 (tier: 速度/精度のティア、省略時は accurate)
+    generateLrc: (
+      audioPath: string,
+      lyricsText: string,
+      tier?: "fast" | "balanced" | "accurate",
+    ) => Promise<{ status: string; lrc?: string; message?: string }>;
   };
 }
 
@@ -1,6 +1,6 @@
 import { CHANNELS } from "../channels";
 import { ipcMain, app } from "electron";
-import { spawn } from "child_process";
+import { spawn, ChildProcess } from "child_process";
 import * as path from "path";
 import * as fs from "fs";
 import * as https from "https";
@@ -10,6 +10,126 @@ import { validateInput } from "../lib/ipc-validate";
 
 const audioPathSchema = z.string().min(1).max(2048);
 const lyricsTextSchema = z.string().max(50000);
+// python/tiers.py の TIERS と同じ名前 (省略時は Python 側の既定 "accurate")
+const tierSchema = z.enum(["fast", "balanced", "accurate"]).optional();
+
+// 常駐ワーカーがアイドル時にモデルを解放するまでの秒数
+const WORKER_IDLE_TIMEOUT_SEC = 300;
+// エラー時のログ用に保持する stderr の末尾の文字数
+const STDERR_TAIL_LENGTH = 10000;
+
+// metrics は Python 側のステージごとの計測 (実時間・CPU 時間・ピークメモリ)
+// separation はボーカル抽出をどう使ったか (path: "mix" | "separated" | "separated_spans") と信頼度
+type TranscribeResult = {
+  status: string;
+  lrc?: string;
+  message?: string;
+  metrics?: Record<string, unknown>;
+  separation?: Record<string, unknown>;
+};
+
+interface TranscriptionWorker {
+  process: ChildProcess;
+  pending: Map<number, (result: TranscribeResult) => void>;
+  stdoutBuffer: string;
+  stderrTail: string;
+}
+
+let worker: TranscriptionWorker | null = null;
+let nextRequestId = 1;
+
+/**
+ * 常駐ワーカー (lrc_generator.py --server) を取得する
+ * 未起動または終了済みの場合は新しく起動する。モデルはワーカー内に保持されるため、
+ * 2回目以降のリクエストではモデルのロードを省略できる。
+ */
+function getWorker(pythonPath: string, scriptPath: string): TranscriptionWorker {
+  if (worker) return worker;
+
+  const child = spawn(pythonPath, [
+    scriptPath,
+    "--server",
+    "--idle-timeout",
+    String(WORKER_IDLE_TIMEOUT_SEC),
+  ]);
+  const current: TranscriptionWorker = {
+    process: child,
+    pending: new Map(),
+    stdoutBuffer: "",
+    stderrTail: "",
+  };
+
+  // 応答は 1 行 1 JSON。id で対応するリクエストに返す
+  child.stdout?.on("data", (data) => {
+    current.stdoutBuffer += data.toString();
+    let newline = current.stdoutBuffer.indexOf("\n");
+    while (newline >= 0) {
+      const line = current.stdoutBuffer.slice(0, newline).trim();
+      current.stdoutBuffer = current.stdoutBuffer.slice(newline + 1);
+      newline = current.stdoutBuffer.indexOf("\n");
+      if (!line) continue;
+
+      try {
+        const { id, ...result } = JSON.parse(line);
+        const resolve = current.pending.get(id);
+        if (resolve) {
+          current.pending.delete(id);
+          resolve(result);
+        }
+      } catch (e) {
+        console.error(`[Transcribe] JSON Parse Error: ${line}`);
+      }
+    }
+  });
+  child.stderr?.on("data", (data) => {
+    current.stderrTail = (current.stderrTail + data.toString()).slice(
+      -STDERR_TAIL_LENGTH,
+    );
+  });
+
+  // ワーカーが終了した場合は処理中のリクエストをすべてエラーで返し、次回再起動する
+  const handleExit = (code: number | null) => {
+    if (worker === current) worker = null;
+    if (current.pending.size === 0) return;
+
+    console.error(
+      `[Transcribe] Python Error (code ${code}): ${current.stderrTail}`,
+    );
+    current.pending.forEach((resolve) =>
+      resolve({
+        status: "error",
+        message: `トランスクライブエンジンの実行に失敗しました`,
+      }),
+    );
+    current.pending.clear();
+  };
+  child.on("close", handleExit);
+  child.on("error", (err) => {
+    console.error(`[Transcribe] Failed to start worker: ${err.message}`);
+    handleExit(null);
+  });
+  // 終了直後のワーカーに書き込むと EPIPE になる。リスナーがないとメインプロセスの
+  // 未処理例外になるので、終了した場合と同じく処理中のリクエストをエラーで返して再起動させる
+  child.stdin?.on("error", (err) => {
+    console.error(`[Transcribe] Failed to write to worker: ${err.message}`);
+    handleExit(null);
+    child.kill();
+  });
+
+  worker = current;
+  return current;
+}
+
+/**
+ * 常駐ワーカーを停止する（アプリ終了時）
+ */
+export function stopTranscriptionWorker() {
+  if (!worker) return;
+  const current = worker;
+  worker = null;
+  // 標準入力を閉じるとワーカーはモデルを解放して終了する
+  current.process.stdin?.end();
+}
 
 /**
  * トランスクライブ関連のIPCハンドラーをセットアップする
@@ -19,14 +139,21 @@ export function setupTranscriptionHandlers() {
    * LRC生成リクエスト
    * @param audioPath 音声ファイルのパス（ローカルまたはURL）
    * @param lyricsText 歌詞テキスト
+   * @param tier 速度/精度のティア ("fast" | "balanced" | "accurate")
    */
   ipcMain.handle(
     CHANNELS.GENERATE_LRC,
-    async (_event, rawAudioPath: string, rawLyricsText: string) => {
+    async (
+      _event,
+      rawAudioPath: string,
+      rawLyricsText: string,
+      rawTier?: string,
+    ) => {
       return new Promise((resolve) => {
         // 入力検証: 長さ制限と基本型チェック
         let audioPath: string;
         let lyricsText: string;
+        let tier: string | undefined;
         try {
           audioPath = validateInput(
             audioPathSchema,
@@ -38,6 +165,11 @@ export function setupTranscriptionHandlers() {
             rawLyricsText,
             "transcribe:generate-lrc:lyricsText",
           );
+          tier = validateInput(
+            tierSchema,
+            rawTier,
+            "transcribe:generate-lrc:tier",
+          );
         } catch (validationError) {
           // バリデーション失敗は例外ではなく、クライアントが期待する
           // { status: "error", message } 形式で返す
@@ -86,51 +218,29 @@ export function setupTranscriptionHandlers() {
           });
         }
 
-        // Python実行コア
+        // Python実行コア（常駐ワーカーにリクエストを送る）
         const runPython = (targetPath: string, isTemp: boolean = false) => {
           console.log(`[Transcribe] Executing Python with: ${targetPath}`);
-          const pythonProcess = spawn(pythonPath, [
-            scriptPath,
-            targetPath,
-            lyricsText,
-          ]);
-
-          let stdout = "";
-          let stderr = "";
+          const current = getWorker(pythonPath, scriptPath);
+          const id = nextRequestId++;
 
-          pythonProcess.stdout.on("data", (data) => {
-            stdout += data.toString();
-          });
-          pythonProcess.stderr.on("data", (data) => {
-            stderr += data.toString();
-          });
-
-          pythonProcess.on("close", (code) => {
+          current.pending.set(id, (result) => {
             if (isTemp && fs.existsSync(targetPath)) {
               fs.unlink(targetPath, () => {});
             }
-
-            if (code !== 0) {
-              console.error(
-                `[Transcribe] Python Error (code ${code}): ${stderr}`,
-              );
-              return resolve({
-                status: "error",
-                message: `トランスクライブエンジンの実行に失敗しました`,
-              });
-            }
-
-            try {
-              const result = JSON.parse(stdout.trim());
-              resolve(result);
-            } catch (e) {
-              console.error(`[Transcribe] JSON Parse Error: ${stdout}`);
-              resolve({
-                status: "error",
-                message: "トランスクライブエンジンの出力解析に失敗しました",
-              });
-            }
+            resolve(result);
           });
+          current.process.stdin?.write(
+            JSON.stringify({
+              id,
+              command: "generate",
+              audio_path: targetPath,
+              lyrics: lyricsText,
+              tier,
+              // ユーザーの操作による生成は、バックグラウンドの一括生成より先に実行させる
+              priority: "interactive",
+            }) + "\n",
+          );
         };
 
         // パス判定と処理開始
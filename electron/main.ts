@@ -24,7 +24,10 @@ import { setupQueryHandlers } from "./ipc/queries";
 import { setupMutationHandlers } from "./ipc/mutations";
 import { setupAuthHandlers } from "./ipc/auth";
 import { setupDiscordHandlers } from "./ipc/discord";
-import { setupTranscriptionHandlers } from "./ipc/transcribe";
+import {
+  setupTranscriptionHandlers,
+  stopTranscriptionWorker,
+} from "./ipc/transcribe";
 import { setupMiniPlayerHandlers } from "./ipc/mini-player";
 import { setupDevShortcuts } from "./shortcuts";
 import { setupThumbBarHandlers } from "./lib/thumbbar";
@@ -174,4 +177,5 @@ app.on("activate", () => {
 app.on("will-quit", () => {
   globalShortcut.unregisterAll();
   stopOAuthServer();
+  stopTranscriptionWorker();
 });
@@ -344,8 +344,11 @@ contextBridge.exposeInMainWorld("electron", {
 
   // トランスクライブ機能
   transcribe: {
-    generateLrc: (audioPath: string, lyricsText: string) =>
-      ipcRenderer.invoke(CHANNELS.GENERATE_LRC, audioPath, lyricsText),
+    generateLrc: (
+      audioPath: string,
+      lyricsText: string,
+      tier?: "fast" | "balanced" | "accurate",
+    ) => ipcRenderer.invoke(CHANNELS.GENERATE_LRC, audioPath, lyricsText, tier),
   },
 
   // ミニプレイヤー機能
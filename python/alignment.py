@@ -0,0 +1,455 @@
+import math
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+
+# CTC強制アライメントのコア (NumPy のみに依存)
+#
+# トレリスは 1 フレーム (行) 単位でトークン方向をまとめて計算する。
+# 浮動小数点の演算順序は従来の二重ループ実装と同じなので、結果はビット単位で一致する。
+
+# トレリス全体 (float64, フレーム数 × トークン数) がこのサイズを超える場合は
+# チェックポイント方式の省メモリモードに切り替える
+TRELLIS_MEMORY_LIMIT = 512 * 1024 * 1024
+
+# 分割アライメント: 1 パス目 (アンカー探索) で emission を縮約する倍率
+COARSE_DOWNSAMPLE = 4
+# 分割アライメント: 1 グループあたりの最小フレーム数 (50fps で約 10 秒)
+MIN_GROUP_FRAMES = 500
+# 分割アライメント: アンカー前後の文字確率の平均がこれを下回ったら全体アライメントに戻す
+MIN_ANCHOR_CONFIDENCE = 0.2
+# アンカー信頼度の計算に使う前後のトークン数
+ANCHOR_CONFIDENCE_WINDOW = 16
+
+# 分割アライメントのプロセスプール (プロセスで 1 つだけ作り、リクエスト間で使い回す)
+# 常駐ワーカーはスレッドを動かしているので fork せず、spawn で子プロセスを作る
+_pool_lock = threading.Lock()
+_pool = None
+_pool_workers = 0
+
+
+@dataclass(frozen=True)
+class AlignmentPath:
+    """backtrack の結果 (パス上の各点をトークン位置・フレーム・確率の配列で保持)"""
+
+    token_index: np.ndarray
+    frame: np.ndarray
+    score: np.ndarray
+
+    def __len__(self):
+        return len(self.frame)
+
+
+@dataclass(frozen=True)
+class Segments:
+    """merge_repeats / merge_words の結果 (ラベルごとのランレングス)"""
+
+    label: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    score: np.ndarray
+
+    def __len__(self):
+        return len(self.start)
+
+
+def _advance(row, out, t, emission, blank, next_tokens):
+    """t 行目から t+1 行目 (先頭列以外) を計算して out に書き込む"""
+    np.maximum(
+        row[1:] + blank[t],
+        row[:-1] + emission[t, next_tokens],
+        out=out[1:],
+    )
+
+
+def get_trellis(emission, tokens, blank_id=0):
+    emission = np.asarray(emission)
+    tokens = np.asarray(tokens, dtype=np.int64)
+    num_frame = emission.shape[0]
+    num_tokens = len(tokens)
+    trellis = np.full((num_frame, num_tokens), -np.inf)
+
+    # 初期条件 (blank のみで先頭トークンに留まり続けるスコア)
+    blank = emission[:, blank_id]
+    trellis[:, 0] = np.cumsum(blank)
+
+    # 1 行ずつ stay / change の最大値を取る
+    next_tokens = tokens[1:]
+    for t in range(num_frame - 1):
+        _advance(trellis[t], trellis[t + 1], t, emission, blank, next_tokens)
+    return trellis
+
+
+class CheckpointedTrellis:
+    """
+    トレリスを一定間隔の行 (チェックポイント) だけ保持し、
+    参照された区間をその都度再計算する省メモリ版トレリス
+
+    間隔を √フレーム数 にすると、保持する行数はチェックポイントと再計算中の
+    ブロックを合わせて約 2√フレーム数 行になる。backtrack は末尾から順に
+    参照するので、各ブロックの再計算は 1 回で済む。
+    再計算は get_trellis と同じ演算順序なので、値は完全に一致する。
+    """
+
+    def __init__(self, emission, tokens, blank_id=0, interval=None):
+        self.emission = np.asarray(emission)
+        self.tokens = np.asarray(tokens, dtype=np.int64)
+        num_frame = self.emission.shape[0]
+        num_tokens = len(self.tokens)
+        self.shape = (num_frame, num_tokens)
+        self.interval = interval or max(1, math.isqrt(max(num_frame - 1, 0)) + 1)
+
+        self._blank = self.emission[:, blank_id]
+        self._first_col = np.cumsum(self._blank)
+        self._next_tokens = self.tokens[1:]
+
+        num_checkpoints = (num_frame - 1) // self.interval + 1 if num_frame else 0
+        self._checkpoints = np.full((num_checkpoints, num_tokens), -np.inf)
+        self._block = np.full((self.interval, num_tokens), -np.inf)
+        self._block_id = None
+
+        # 前向き計算 (2 行を使い回し、間隔ごとにチェックポイントへ保存)
+        if num_frame == 0:
+            return
+        row = np.full(num_tokens, -np.inf)
+        nxt = np.full(num_tokens, -np.inf)
+        row[0] = self._first_col[0]
+        self._checkpoints[0] = row
+        for t in range(num_frame - 1):
+            nxt[0] = self._first_col[t + 1]
+            _advance(row, nxt, t, self.emission, self._blank, self._next_tokens)
+            if (t + 1) % self.interval == 0:
+                self._checkpoints[(t + 1) // self.interval] = nxt
+            row, nxt = nxt, row
+
+    def _row(self, t):
+        block_id = t // self.interval
+        if block_id != self._block_id:
+            start = block_id * self.interval
+            stop = min(start + self.interval, self.shape[0])
+            block = self._block
+            block[0] = self._checkpoints[block_id]
+            for i in range(1, stop - start):
+                block[i, 0] = self._first_col[start + i]
+                _advance(
+                    block[i - 1],
+                    block[i],
+                    start + i - 1,
+                    self.emission,
+                    self._blank,
+                    self._next_tokens,
+                )
+            self._block_id = block_id
+        return self._block[t - block_id * self.interval]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            t, j = key
+            return self._row(t)[j]
+        return self._row(key)
+
+
+def backtrack(trellis, emission, tokens, blank_id=0):
+    emission = np.asarray(emission)
+    t, j = trellis.shape[0] - 1, trellis.shape[1] - 1
+
+    # 最後の点
+    token_index = [j]
+    frames = [t]
+    scores = [np.exp(emission[t, blank_id])]
+
+    while j > 0 and t > 0:
+        p_stay = emission[t - 1, blank_id]
+        p_change = emission[t - 1, tokens[j]]
+        stay_score = trellis[t - 1, j] + p_stay
+        change_score = trellis[t - 1, j - 1] + p_change
+
+        t -= 1
+        if change_score > stay_score:
+            j -= 1
+            scores.append(np.exp(change_score))
+        else:
+            scores.append(np.exp(stay_score))
+        token_index.append(j)
+        frames.append(t)
+
+    # 残りのフレームは先頭トークンに blank で留まる
+    head = t
+    token_index = np.concatenate(
+        [np.full(head, j, dtype=np.int64), np.array(token_index[::-1], dtype=np.int64)]
+    )
+    frames = np.concatenate(
+        [np.arange(head, dtype=np.int64), np.array(frames[::-1], dtype=np.int64)]
+    )
+    scores = np.concatenate(
+        [
+            np.exp(emission[:head, blank_id]).astype(np.float64),
+            np.array(scores[::-1], dtype=np.float64),
+        ]
+    )
+    return AlignmentPath(token_index, frames, scores)
+
+
+def trellis_nbytes(num_frame, num_tokens):
+    """get_trellis が確保するトレリス全体のバイト数"""
+    return num_frame * num_tokens * np.dtype(np.float64).itemsize
+
+
+def align(emission, tokens, blank_id=0, low_memory=None, memory_limit=None, timing=None):
+    """
+    トレリス計算とバックトラックをまとめて行い、AlignmentPath を返す
+
+    Args:
+        emission: log_softmax 済みの出力 (フレーム数 × 語彙数)
+        tokens: トークンIDの列
+        blank_id: blank トークンのID
+        low_memory: True で省メモリモード、None ならトレリスのサイズから自動選択
+        memory_limit: 自動選択の閾値 (バイト, デフォルト: TRELLIS_MEMORY_LIMIT)
+        timing: dict を渡すと "trellis" / "backtrack" にかかった秒数を加算する
+    """
+    emission = np.asarray(emission)
+    if low_memory is None:
+        limit = TRELLIS_MEMORY_LIMIT if memory_limit is None else memory_limit
+        low_memory = trellis_nbytes(emission.shape[0], len(tokens)) > limit
+
+    started = time.perf_counter()
+    if low_memory:
+        trellis = CheckpointedTrellis(emission, tokens, blank_id)
+    else:
+        trellis = get_trellis(emission, tokens, blank_id)
+    traced = time.perf_counter()
+    path = backtrack(trellis, emission, tokens, blank_id)
+    if timing is not None:
+        # 省メモリモードではトレリスの再計算が backtrack の側に入る
+        timing["trellis"] = timing.get("trellis", 0.0) + traced - started
+        timing["backtrack"] = timing.get("backtrack", 0.0) + time.perf_counter() - traced
+    return path
+
+
+def downsample_emission(emission, factor):
+    """
+    factor フレームごとに各トークンの log 確率の最大値を取って縮約する
+    (CTC の出力は 1 フレームだけ鋭く立つため、平均だと文字のピークが埋もれる)
+    """
+    emission = np.asarray(emission)
+    pad = (-emission.shape[0]) % factor
+    if pad:
+        emission = np.concatenate([emission, np.repeat(emission[-1:], pad, axis=0)])
+    return emission.reshape(-1, factor, emission.shape[1]).max(axis=1)
+
+
+def _pick_group_boundaries(line_ends, num_tokens, num_groups):
+    """トークン数がほぼ均等になるよう、行末の区切りトークンからグループ境界を選ぶ"""
+    line_ends = np.asarray(line_ends, dtype=np.int64)
+    chosen = []
+    for k in range(1, num_groups):
+        target = num_tokens * k / num_groups
+        s = int(line_ends[np.argmin(np.abs(line_ends - target))])
+        if not chosen or s > chosen[-1]:
+            chosen.append(s)
+    return chosen
+
+
+def _anchor_confidence(path, emission, tokens, lo, hi):
+    """
+    トークン区間 [lo, hi] の各文字について、割り当てられたフレーム (と直前のフレーム)
+    での出力確率の最大値を取り、その平均を返す
+    """
+    mask = (path.token_index >= lo) & (path.token_index <= hi)
+    j = path.token_index[mask]
+    t = path.frame[mask]
+    best = np.zeros(hi - lo + 1)
+    for frames in (t, np.maximum(t - 1, 0)):
+        np.maximum.at(best, j - lo, np.exp(emission[frames, tokens[j]]))
+    return float(best.mean())
+
+
+def shared_pool(workers):
+    """
+    workers 個以上のプロセスを持つ共有のプロセスプールを返す (最初に呼ばれたときに作る)
+
+    より多くのプロセスが要求されたら作り直す (古いプールは実行中の処理を終えてから閉じる)。
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            _pool_workers = workers
+        return _pool
+
+
+def _align_window(args):
+    emission, tokens, blank_id = args
+    timing = {}
+    return align(emission, tokens, blank_id, timing=timing), timing
+
+
+def align_segmented(
+    emission,
+    tokens,
+    line_ends,
+    blank_id=0,
+    workers=None,
+    downsample=COARSE_DOWNSAMPLE,
+    min_confidence=MIN_ANCHOR_CONFIDENCE,
+    timing=None,
+):
+    """
+    粗→細の 2 パスでアライメントし、(AlignmentPath, 情報 dict) を返す
+
+    1 パス目は縮約した emission に対して全体をアライメントし、行の区切りトークンが
+    置かれたフレームをアンカーとする。2 パス目はアンカーで区切った各グループを
+    プロセスプールで独立にアライメントし、フレーム・トークン位置を戻して連結する。
+    曲が短い・アンカーの信頼度が低いなど分割できない場合は align() の結果を返す。
+
+    Args:
+        emission: log_softmax 済みの出力 (フレーム数 × 語彙数)
+        tokens: トークンIDの列 (先頭と末尾は区切りトークン)
+        line_ends: 各行の直後にある区切りトークンの位置 (最終行を除く)
+        blank_id: blank トークンのID
+        workers: 並列数 (デフォルト: CPU コア数、1 ならプロセスプールを使わない)。
+            プロセスプールは shared_pool でプロセス全体で共有する
+        downsample: 1 パス目の縮約倍率
+        min_confidence: アンカー信頼度の下限
+        timing: dict を渡すと "trellis" / "backtrack" にかかった秒数を加算する
+            (2 パス目は各グループの合計なので、並列実行では実時間より長くなる)
+    """
+    emission = np.asarray(emission)
+    tokens = np.asarray(tokens, dtype=np.int64)
+    num_frame = emission.shape[0]
+    num_tokens = len(tokens)
+    workers = workers or os.cpu_count() or 1
+
+    if timing is None:
+        timing = {}
+
+    def fallback(reason, **info):
+        return align(emission, tokens, blank_id, timing=timing), {
+            "mode": "global",
+            "reason": reason,
+            **info,
+        }
+
+    num_groups = min(len(line_ends) + 1, workers * 2, num_frame // MIN_GROUP_FRAMES)
+    if num_groups < 2:
+        return fallback("too_short")
+    if num_frame // downsample < num_tokens:
+        return fallback("too_dense")
+
+    # 1 パス目: 縮約した emission で全体をアライメントしてアンカーを決める
+    coarse = downsample_emission(emission, downsample)
+    coarse_path = align(coarse, tokens, blank_id, timing=timing)
+
+    boundaries = _pick_group_boundaries(line_ends, num_tokens, num_groups)
+    anchors = []
+    confidence = []
+    for s in boundaries:
+        frames = coarse_path.frame[coarse_path.token_index == s]
+        anchors.append(min((frames[0] + frames[-1] + 1) * downsample // 2, num_frame))
+        confidence.append(
+            _anchor_confidence(
+                coarse_path,
+                coarse,
+                tokens,
+                max(s - ANCHOR_CONFIDENCE_WINDOW, 0),
+                min(s + ANCHOR_CONFIDENCE_WINDOW, num_tokens - 1),
+            )
+        )
+
+    min_conf = min(confidence)
+    if min_conf < min_confidence:
+        return fallback("low_confidence", confidence=min_conf)
+
+    frame_cuts = [0] + anchors + [num_frame]
+    token_cuts = [0] + boundaries + [num_tokens - 1]
+    for k in range(len(boundaries) + 1):
+        if frame_cuts[k + 1] - frame_cuts[k] <= token_cuts[k + 1] - token_cuts[k]:
+            return fallback("infeasible_window", confidence=min_conf)
+
+    # 2 パス目: 各グループを独立にアライメント (隣接グループは境界の区切りトークンを共有)
+    jobs = [
+        (
+            emission[frame_cuts[k] : frame_cuts[k + 1]],
+            tokens[token_cuts[k] : token_cuts[k + 1] + 1],
+            blank_id,
+        )
+        for k in range(len(boundaries) + 1)
+    ]
+    if workers > 1:
+        # 共有のプールは他のリクエストの workers で大きくなっていることがあるので、
+        # 同時に投げるのは workers 個までにする
+        pool = shared_pool(workers)
+        windows = []
+        for start in range(0, len(jobs), workers):
+            windows.extend(pool.map(_align_window, jobs[start : start + workers]))
+    else:
+        windows = [_align_window(job) for job in jobs]
+    results = [path for path, _ in windows]
+    for _, window_timing in windows:
+        for name, seconds in window_timing.items():
+            timing[name] = timing.get(name, 0.0) + seconds
+
+    path = AlignmentPath(
+        np.concatenate([r.token_index + token_cuts[k] for k, r in enumerate(results)]),
+        np.concatenate([r.frame + frame_cuts[k] for k, r in enumerate(results)]),
+        np.concatenate([r.score for r in results]),
+    )
+    return path, {"mode": "segmented", "groups": len(jobs), "confidence": min_conf}
+
+
+def _run_bounds(keys):
+    """連続して同じ値が並ぶ区間の [start, end) インデックスを返す"""
+    change = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [len(keys)]])
+    return starts, ends
+
+
+def merge_repeats(path, transcript):
+    if len(path) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return Segments(np.array([], dtype="<U1"), empty, empty, np.zeros(0))
+
+    starts, ends = _run_bounds(path.token_index)
+    labels = np.array(list(transcript))[path.token_index[starts]]
+    score = np.add.reduceat(path.score, starts) / (ends - starts)
+    return Segments(
+        labels,
+        path.frame[starts],
+        path.frame[ends - 1] + 1,
+        score,
+    )
+
+
+def merge_words(segments, separator="|"):
+    # 区切り文字以外のセグメントを、直前までの区切り文字の数でグループ化する
+    is_sep = segments.label == separator
+    members = np.flatnonzero(~is_sep)
+    if len(members) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return Segments(np.array([], dtype=str), empty, empty, np.zeros(0))
+
+    group = np.cumsum(is_sep)[members]
+    starts, ends = _run_bounds(group)
+    first = members[starts]
+    last = members[ends - 1]
+
+    word_start = segments.start[first]
+    word_end = segments.end[last]
+    weighted = segments.score[members] * (
+        segments.end[members] - segments.start[members]
+    )
+    score = np.add.reduceat(weighted, starts) / (word_end - word_start)
+
+    labels = segments.label[members]
+    words = np.array(["".join(labels[s:e]) for s, e in zip(starts, ends)])
+    return Segments(words, word_start, word_end, score)
@@ -0,0 +1,206 @@
+import os
+import time
+
+import numpy as np
+
+
+# 音声の読み込み (16kHz モノラル float32)
+#
+# librosa.load は元のサンプリングレートのまま全体をデコードしてからリサンプルするため、
+# 長い FLAC/WAV ではメモリと時間がかかる。soundfile で読めるファイルはブロックごとに
+# 読み込み、モノラル化して soxr のストリームで 16kHz に変換する (StreamingAudio)。
+# チャンク分割推論はこれを配列のようにスライスし、使い終わった区間を release() で捨てるので、
+# 保持するサンプルは曲の長さによらず 1 バッチ分程度になる。
+# soundfile で開けない形式 (動画コンテナ、古い libsndfile の MP3 など) は librosa で読む。
+
+SAMPLE_RATE = 16000
+# 1 回に読み込む元音声のフレーム数 (44.1kHz で約 1.5 秒)
+READ_BLOCK_FRAMES = 65536
+# soundfile で長さが分からない形式で、ファイルサイズから長さを見積もるときのビットレート
+ASSUMED_BITRATE = 128_000
+
+
+class StreamingUnsupported(Exception):
+    """ストリーミングで読めない (librosa.load に任せる) 形式"""
+
+
+class SampleBuffer:
+    """
+    先頭から順に追加されるサンプル列のうち、まだ捨てていない区間をブロックのまま保持する
+
+    サンプル位置は列全体での位置。release(n) で n より前のブロックを捨てる。
+    """
+
+    def __init__(self):
+        self._blocks = []
+        # 保持している先頭のブロックの、列全体でのサンプル位置
+        self.offset = 0
+        # 追加されたサンプルの総数
+        self.end = 0
+
+    def append(self, block):
+        if len(block):
+            self._blocks.append(np.asarray(block, dtype=np.float32))
+            self.end += len(block)
+
+    def truncate(self, length):
+        """length より後ろのサンプルを捨てる"""
+        while self.end > length and self._blocks:
+            last = self._blocks[-1]
+            keep = len(last) - (self.end - length)
+            if keep > 0:
+                self._blocks[-1] = last[:keep]
+                self.end = length
+            else:
+                self._blocks.pop()
+                self.end -= len(last)
+
+    def release(self, before):
+        """before より前のサンプルしか含まないブロックを捨てる"""
+        while self._blocks and self.offset + len(self._blocks[0]) <= before:
+            self.offset += len(self._blocks.pop(0))
+
+    def held(self):
+        """保持しているサンプル数"""
+        return self.end - self.offset
+
+    def slice(self, start, stop):
+        """[start, stop) のサンプルを新しい配列で返す (保持している区間のみ)"""
+        if start < self.offset or stop > self.end:
+            raise IndexError(
+                f"区間 [{start}, {stop}) は保持している [{self.offset}, {self.end}) の外です"
+            )
+        pieces = []
+        pos = self.offset
+        for block in self._blocks:
+            block_stop = pos + len(block)
+            if block_stop > start and pos < stop:
+                pieces.append(block[max(start - pos, 0) : min(stop, block_stop) - pos])
+            if block_stop >= stop:
+                break
+            pos = block_stop
+        if not pieces:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(pieces)
+
+
+class StreamingAudio:
+    """
+    音声ファイルを 16kHz モノラルの配列のようにスライスできるストリーム
+
+    len() は元のフレーム数から求めた変換後のサンプル数で、デコードの結果が
+    これとずれた場合は末尾を 0 で埋めるか切り詰める (チャンクの計画をずらさないため)。
+    スライスは先頭から順に参照し、使い終わった区間は release() で捨てる。
+    decode_seconds はデコードとリサンプルにかかった秒数の合計。
+    """
+
+    def __init__(self, path, sr=SAMPLE_RATE, block_frames=READ_BLOCK_FRAMES):
+        try:
+            import soundfile
+            import soxr
+        except ImportError as e:
+            raise StreamingUnsupported(str(e)) from e
+        try:
+            self._file = soundfile.SoundFile(path)
+        except Exception as e:
+            raise StreamingUnsupported(str(e)) from e
+        if self._file.frames <= 0:
+            self._file.close()
+            raise StreamingUnsupported("長さが分からないストリームです")
+
+        self.sr = sr
+        self.source_sr = self._file.samplerate
+        self._block_frames = block_frames
+        self._resampler = None
+        if self.source_sr != sr:
+            self._resampler = soxr.ResampleStream(
+                self.source_sr, sr, 1, dtype="float32", quality="HQ"
+            )
+        self._length = int(round(self._file.frames * sr / self.source_sr))
+        self._buffer = SampleBuffer()
+        self._eof = False
+        self.decode_seconds = 0.0
+
+    def __len__(self):
+        return self._length
+
+    def _read_block(self):
+        started = time.perf_counter()
+        data = self._file.read(self._block_frames, dtype="float32", always_2d=True)
+        last = len(data) < self._block_frames
+        mono = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+        if self._resampler is not None:
+            mono = self._resampler.resample_chunk(mono, last=last)
+        self._buffer.append(mono)
+        if last:
+            self._eof = True
+            self._file.close()
+            if self._buffer.end < self._length:
+                self._buffer.append(np.zeros(self._length - self._buffer.end, np.float32))
+            self._buffer.truncate(self._length)
+        self.decode_seconds += time.perf_counter() - started
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("StreamingAudio は連続したスライスだけに対応しています")
+        start, stop, _ = key.indices(self._length)
+        stop = max(start, stop)
+        while self._buffer.end < stop and not self._eof:
+            self._read_block()
+        return self._buffer.slice(start, stop)
+
+    def release(self, before):
+        """before より前のサンプルはもう参照しない (メモリを解放する)"""
+        self._buffer.release(before)
+
+    def held_samples(self):
+        return self._buffer.held()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        self._buffer = SampleBuffer()
+
+
+def open_audio(path, sr=SAMPLE_RATE):
+    """
+    音声を開き、StreamingAudio (ストリーミングで読める場合) または
+    librosa.load で全体を読み込んだ配列を返す
+    """
+    try:
+        return StreamingAudio(path, sr)
+    except StreamingUnsupported:
+        import librosa
+
+        audio, _ = librosa.load(path, sr=sr)
+        return audio
+
+
+def load_audio(path, sr=SAMPLE_RATE):
+    """音声全体を 16kHz モノラルの float32 配列で返す (元のレートの全体をメモリに持たない)"""
+    audio = open_audio(path, sr)
+    if isinstance(audio, StreamingAudio):
+        try:
+            return audio[: len(audio)]
+        finally:
+            audio.close()
+    return audio
+
+
+def audio_duration(path):
+    """
+    音声の長さ (秒) をデコードせずに返す
+    soundfile で分からない形式はファイルサイズから見積もり、ファイルがなければ None
+    """
+    try:
+        import soundfile
+
+        info = soundfile.info(path)
+        if info.frames > 0:
+            return info.frames / info.samplerate
+    except Exception:
+        pass
+    try:
+        return os.path.getsize(path) * 8 / ASSUMED_BITRATE
+    except OSError:
+        return None
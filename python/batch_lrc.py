@@ -0,0 +1,438 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from audio_io import load_audio
+from chunking import FrameGeometry, plan_chunks, seconds_to_frames
+from hardware import BACKENDS, choose_chunk_seconds, is_out_of_memory
+from lrc_generator import (
+    SAMPLE_RATE,
+    ModelCache,
+    align_lyrics,
+    frame_seconds,
+    infer_batch,
+    normalize_audio_path,
+    prepare_transcript,
+    release_device_memory,
+    tokenize,
+)
+from model_store import set_offline
+from resource_policy import get_profile, memory_limit
+from tiers import DEFAULT_TIER, TIERS, get_tier
+
+# 1 回の forward にまとめるチャンク数 (同じ長さであれば複数曲のチャンクを混ぜて詰める)
+DEFAULT_BATCH_SIZE = 8
+# ボーカル抽出を先に済ませてメモリに置いておく音声の長さ (秒)。16kHz の float32 で約 230MB
+GROUP_AUDIO_SECONDS = 60 * 60
+
+
+class SongJob:
+    """推論待ち〜アライメント中の 1 曲分の状態"""
+
+    def __init__(self, entry, clean_lines_data, padded_transcript, tokens):
+        self.id = entry["id"]
+        self.audio = entry["audio"]
+        self.clean_lines_data = clean_lines_data
+        self.padded_transcript = padded_transcript
+        self.tokens = tokens
+        self.emissions = []
+        self.remaining = 0
+        self.failed = False
+
+
+def read_manifest(manifest_path):
+    """
+    JSON Lines 形式のマニフェストを読み込む
+
+    各行は {"audio": 音声ファイルのパス, "lyrics": 歌詞テキスト} または
+    {"audio": ..., "lyrics_path": 歌詞ファイルのパス}。"id" を省略した場合は audio を使う。
+    """
+    entries = []
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "lyrics" not in entry and "lyrics_path" in entry:
+                lyrics_path = os.path.join(base_dir, entry["lyrics_path"])
+                with open(lyrics_path, "r", encoding="utf-8") as lf:
+                    entry["lyrics"] = lf.read()
+            entry.setdefault("id", entry["audio"])
+            entries.append(entry)
+    return entries
+
+
+def read_finished_ids(output_path, retry_errors=False):
+    """
+    出力ファイルから処理済みの id を集める (再開用)
+    クラッシュで途中まで書かれた最終行は読み飛ばす
+    """
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if retry_errors and record.get("status") != "success":
+                continue
+            finished.add(record.get("id"))
+    return finished
+
+
+def _run_songs(todo, out, stats, started, models, tier, separator_model, batch_size, workers):
+    """
+    run_batch の本体。結果は out に 1 曲 1 行で書き、stats に成功・失敗を数える
+
+    分離モデルと CTC モデルを同時にデバイスに置かないよう、ボーカル抽出は
+    GROUP_AUDIO_SECONDS 分の曲ずつ分離モデルだけで行い、分離モデルを解放してから
+    CTC モデルでその曲をまとめて推論する (ボーカル抽出しない場合はすべて 1 つのグループ)。
+    """
+
+    def write_result(song_id, audio, result):
+        out.write(json.dumps({"id": song_id, "audio": audio, **result}, ensure_ascii=False))
+        out.write("\n")
+        out.flush()
+        stats["success" if result["status"] == "success" else "error"] += 1
+
+        done = stats["success"] + stats["error"]
+        elapsed = max(time.monotonic() - started, 1e-6)
+        print(
+            f"[Batch] {done}/{len(todo)} 曲完了 ({done / elapsed * 3600:.1f} songs/hour)",
+            file=sys.stderr,
+        )
+
+    # 推論待ちのチャンクをサンプル数ごとに分けて持つ。1 つのバッチには同じ長さのチャンクだけを
+    # 入れる (chunking.run_chunked と同じ)。パディングすると、attention_mask を使わない
+    # base モデルでは出力が変わり、同じ曲でも一緒に推論した曲によって結果が変わるため
+    pending_chunks = {}
+    in_flight = {}
+    ctc = {}
+
+    def load_ctc():
+        # 2 つ目以降のグループでは読み込み直すだけで、語彙とチャンク長は最初のものを使う
+        processor, model, device = models.ctc(tier.aligner_model, tier.precision)
+        if not ctc:
+            geometry = FrameGeometry.from_config(model.config)
+            ctc.update(
+                vocab=processor.tokenizer.get_vocab(),
+                geometry=geometry,
+                # 1 曲ずつの generate_lrc と同じチャンク長にする (チャンク長で emission が変わるため)
+                chunk_frames=seconds_to_frames(
+                    choose_chunk_seconds(
+                        device,
+                        tier.max_chunk_seconds,
+                        get_profile().memory_ratio,
+                        memory_limit(),
+                    ),
+                    geometry,
+                    SAMPLE_RATE,
+                ),
+                seconds_per_frame=frame_seconds(model, SAMPLE_RATE),
+            )
+        return processor, model, device
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def collect(block):
+            if not in_flight:
+                return
+            done, _ = wait(
+                list(in_flight),
+                timeout=None if block else 0,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                song = in_flight.pop(future)
+                try:
+                    lrc, _ = future.result()
+                    write_result(song.id, song.audio, {"status": "success", "lrc": lrc})
+                except Exception as e:
+                    write_result(
+                        song.id, song.audio, {"status": "error", "message": str(e)}
+                    )
+
+        def submit_alignment(song):
+            # CPU側が詰まっている間は推論を進めず、メモリ上の emission を増やさない
+            while len(in_flight) >= workers * 2:
+                collect(block=True)
+            emission = np.concatenate(song.emissions, axis=0)
+            song.emissions = None
+            future = pool.submit(
+                align_lyrics,
+                emission,
+                ctc["seconds_per_frame"],
+                song.clean_lines_data,
+                song.padded_transcript,
+                song.tokens,
+                1,
+            )
+            in_flight[future] = song
+
+        def next_batch_length(force):
+            """次に推論するチャンク長。バッチサイズ分たまった長さを優先する"""
+            for length, queued in pending_chunks.items():
+                if len(queued) >= batch_size:
+                    return length
+            # 曲の最後のチャンクは長さがばらばらなので、待たせすぎないよう古いものから流す
+            if pending_chunks and (
+                force or sum(map(len, pending_chunks.values())) >= batch_size * 2
+            ):
+                return next(iter(pending_chunks))
+            return None
+
+        def run_pending(processor, model, device, force=False):
+            nonlocal batch_size
+            while True:
+                length = next_batch_length(force)
+                if length is None:
+                    break
+                queued = pending_chunks.pop(length)
+                batch = queued[:batch_size]
+                if queued[batch_size:]:
+                    pending_chunks[length] = queued[batch_size:]
+                try:
+                    emissions = infer_batch(
+                        [samples for _, _, _, samples in batch], processor, model, device
+                    )
+                except Exception as e:
+                    if is_out_of_memory(e) and batch_size > 1:
+                        batch_size //= 2
+                        pending_chunks[length] = batch + pending_chunks.get(length, [])
+                        release_device_memory()
+                        print(
+                            f"[Batch] メモリ不足のためバッチサイズを {batch_size} に縮小します",
+                            file=sys.stderr,
+                        )
+                        continue
+                    for song, _, _, _ in batch:
+                        if not song.failed:
+                            song.failed = True
+                            write_result(
+                                song.id, song.audio, {"status": "error", "message": str(e)}
+                            )
+                    continue
+
+                for (song, index, chunk, _), chunk_emission in zip(batch, emissions):
+                    if song.failed:
+                        continue
+                    song.emissions[index] = chunk_emission[
+                        chunk.keep_start : chunk.keep_stop
+                    ]
+                    song.remaining -= 1
+                    if song.remaining == 0:
+                        submit_alignment(song)
+                collect(block=False)
+
+        def separate_group(entries):
+            """先頭から GROUP_AUDIO_SECONDS 分の曲を取り出し、[(entry, 前処理した歌詞, ボーカル)] を返す"""
+            group = []
+            group_seconds = 0.0
+            while entries and (not separator_model or group_seconds < GROUP_AUDIO_SECONDS):
+                entry = entries.pop(0)
+                try:
+                    prepared = prepare_transcript(entry.get("lyrics", ""))
+                    if prepared is None:
+                        raise ValueError("歌詞が空または無効です")
+                    audio = None
+                    if separator_model:
+                        # ボーカルはファイルを介さず 16kHz モノラルの配列で受け取る
+                        sep_result = models.separate(
+                            normalize_audio_path(entry["audio"]),
+                            separator_model,
+                            return_array=True,
+                            sr=SAMPLE_RATE,
+                        )
+                        if sep_result["status"] == "success":
+                            audio = sep_result["vocals"]
+                            group_seconds += len(audio) / SAMPLE_RATE
+                        else:
+                            print(
+                                f"[Batch] ボーカル抽出失敗、元音源を使用: {entry['id']}",
+                                file=sys.stderr,
+                            )
+                except Exception as e:
+                    write_result(
+                        entry["id"], entry["audio"], {"status": "error", "message": str(e)}
+                    )
+                    continue
+                group.append((entry, prepared, audio))
+            return group
+
+        entries = list(todo)
+        while entries:
+            group = separate_group(entries)
+            # CTC モデルを読み込む前に、分離で使ったデバイスメモリを返す
+            models.release_separator()
+            if not group:
+                continue
+            processor, model, device = load_ctc()
+            for entry, (clean_lines_data, padded_transcript), audio in group:
+                try:
+                    if audio is None:
+                        audio = load_audio(normalize_audio_path(entry["audio"]), SAMPLE_RATE)
+                    chunks = plan_chunks(len(audio), ctc["chunk_frames"], ctc["geometry"])
+                    if not chunks:
+                        raise ValueError("音声が短すぎます")
+                    song = SongJob(
+                        entry,
+                        clean_lines_data,
+                        padded_transcript,
+                        tokenize(padded_transcript, ctc["vocab"]),
+                    )
+                    song.emissions = [None] * len(chunks)
+                    song.remaining = len(chunks)
+                    for i, c in enumerate(chunks):
+                        pending_chunks.setdefault(c.stop - c.start, []).append(
+                            (song, i, c, audio[c.start : c.stop])
+                        )
+                except Exception as e:
+                    write_result(
+                        entry["id"], entry["audio"], {"status": "error", "message": str(e)}
+                    )
+                    continue
+
+                run_pending(processor, model, device)
+
+            run_pending(processor, model, device, force=True)
+            if entries and separator_model:
+                # 次のグループのボーカル抽出の前に CTC モデルを解放する
+                processor = model = None
+                models.release_ctc()
+
+        while in_flight:
+            collect(block=True)
+
+
+def run_batch(
+    manifest_path,
+    output_path,
+    batch_size=DEFAULT_BATCH_SIZE,
+    workers=None,
+    use_vocal_separation=True,
+    retry_errors=False,
+    tier=None,
+    backend="auto",
+):
+    """
+    マニフェストの曲をまとめてLRC生成し、結果を 1 曲 1 行で output_path に追記する
+
+    - ボーカル抽出とCTC推論はデバイス上で行い、同じ長さの複数曲のチャンクを同じバッチに詰める
+      (推論がメモリ不足で失敗したら、バッチサイズを半分にして同じチャンクからやり直す)
+    - 推論が終わった曲から順に、トレリス計算とLRC構成をCPUのプロセスプールに投げる
+    - 出力ファイルに記録済みの id は読み飛ばすので、中断しても同じコマンドで再開できる
+    - tier (ティア名) で分離モデル・アライメントモデル・チャンク長・精度を選ぶ
+    - backend で推論デバイスを指定する ("auto" ならプラットフォームに応じて選ぶ)
+    """
+    tier = get_tier(tier)
+    separator_model = tier.separator_model if use_vocal_separation else None
+    entries = read_manifest(manifest_path)
+    finished = read_finished_ids(output_path, retry_errors)
+    todo = [e for e in entries if e["id"] not in finished]
+    workers = workers or os.cpu_count() or 1
+
+    print(
+        f"[Batch] {len(entries)} 曲中 {len(entries) - len(todo)} 曲は処理済み、"
+        f"{len(todo)} 曲を処理します",
+        file=sys.stderr,
+    )
+
+    stats = {"success": 0, "error": 0}
+    started = time.monotonic()
+
+    # 前回の最終行が途中で切れている場合に備えて改行を補う
+    needs_newline = False
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+
+    models = ModelCache(backend=backend)
+    with open(output_path, "a", encoding="utf-8") as out:
+        if needs_newline:
+            out.write("\n")
+        try:
+            _run_songs(
+                todo, out, stats, started, models, tier, separator_model, batch_size, workers
+            )
+        finally:
+            models.unload()
+
+    elapsed = time.monotonic() - started
+    processed = stats["success"] + stats["error"]
+    return {
+        "status": "success",
+        "processed": processed,
+        "succeeded": stats["success"],
+        "failed": stats["error"],
+        "skipped": len(entries) - len(todo),
+        "elapsed": round(elapsed, 1),
+        "songs_per_hour": round(processed / elapsed * 3600, 1) if elapsed > 0 else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    # 配布版 (Windows) で子プロセスがこのスクリプトを起動し直した場合に備える
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Batch LRC generation from a manifest")
+    parser.add_argument("manifest", help="JSON Lines manifest of {audio, lyrics|lyrics_path, id}")
+    parser.add_argument("output", help="JSON Lines file results are appended to (resumable)")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Chunks per forward pass (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="CPU alignment workers (default: CPU count)"
+    )
+    parser.add_argument(
+        "--no-separation", action="store_true", help="Skip vocal separation"
+    )
+    parser.add_argument(
+        "--retry-errors",
+        action="store_true",
+        help="Re-run entries whose previous result was an error",
+    )
+    parser.add_argument(
+        "--tier",
+        choices=list(TIERS),
+        default=DEFAULT_TIER,
+        help=f"Speed/quality tier (default: {DEFAULT_TIER})",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["auto", *BACKENDS],
+        default="auto",
+        help="Inference backend (default: auto-detect)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never access the network; models must already be in the local model store",
+    )
+    args = parser.parse_args()
+    if args.offline:
+        set_offline()
+
+    summary = run_batch(
+        args.manifest,
+        args.output,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        use_vocal_separation=not args.no_separation,
+        retry_errors=args.retry_errors,
+        tier=args.tier,
+        backend=args.backend,
+    )
+    print(json.dumps(summary))
@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+
+import numpy as np
+
+from alignment import (
+    TRELLIS_MEMORY_LIMIT,
+    align,
+    align_segmented,
+    backtrack,
+    get_trellis,
+    merge_repeats,
+    merge_words,
+    trellis_nbytes,
+)
+from lrc_core import clean_text, prepare_transcript, tokenize
+
+
+# アライメントの CPU 処理のマイクロベンチマーク
+#
+# モデルを使わず、合成した歌詞と emission (50fps、wav2vec2 と同じ 32 語彙) で
+# 各関数の時間 (最小値) とピークメモリ (tracemalloc) を計測する。
+# --save でベースラインを benchmarks/ に保存し、--compare で閾値を超えた悪化を報告する
+# (終了コード 1)。時間はマシンに依存するので、比較は同じマシンで取ったベースラインと行う。
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmarks", "alignment_baseline.json"
+)
+# 悪化とみなす割合 (時間・ピークメモリとも)
+DEFAULT_THRESHOLD = 0.2
+# これより小さい差は計測誤差として無視する
+MIN_DELTA_SECONDS = 0.005
+MIN_DELTA_BYTES = 1024 * 1024
+
+# 1 フレームの秒数 (wav2vec2 のホップ長 320 / 16kHz)
+SECONDS_PER_FRAME = 0.02
+# wav2vec2-base-960h と同じ並びの語彙 (0 が blank)
+VOCAB = {"<pad>": 0, "<s>": 1, "</s>": 2, "<unk>": 3, "|": 4}
+VOCAB.update({c: i for i, c in enumerate("ETAONIHSRDLUMWCFGYPBVK'XJQZ", start=5)})
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    seconds: int
+    # 計測の繰り返し回数 (最小値を取る)
+    repeat: int
+
+
+SCENARIOS = {
+    s.name: s
+    for s in (
+        Scenario("pop-3min", 180, 5),
+        Scenario("track-10min", 600, 3),
+        Scenario("mix-1h", 3600, 1),
+    )
+}
+
+
+def synthetic_lyrics(rng, seconds):
+    """
+    曲の長さに見合った量の歌詞と、各文字 (区切りを含む) が歌われるフレームを返す
+    行ごとに 10-14 文字/秒で歌い、行間に 0.5-4 秒の間奏を入れる。8 行ごとにセクション見出しを入れる
+    """
+    num_frame = int(seconds / SECONDS_PER_FRAME)
+    letters = np.array(list("ETAONIHSRDLUMWCFGYPBVK"))
+    lines = []
+    frames = []
+    t = 5.0
+    while True:
+        words = [
+            "".join(rng.choice(letters, size=rng.integers(2, 9))).lower()
+            for _ in range(rng.integers(4, 10))
+        ]
+        line = " ".join(words)
+        rate = rng.uniform(10, 14)
+        if t + len(line) / rate > seconds - 5:
+            break
+        if len(lines) % 9 == 0:
+            lines.append(f"[Section {len(lines) // 9 + 1}]")
+        lines.append(line.capitalize())
+        frames.append(t / SECONDS_PER_FRAME + np.arange(len(line)) * (1 / rate / SECONDS_PER_FRAME))
+        t += len(line) / rate + rng.uniform(0.5, 4.0)
+    return "\n".join(lines), num_frame, frames
+
+
+def synthetic_emission(rng, num_frame, transcript, char_frames):
+    """
+    文字のフレームで、その文字の確率が立つ log_softmax 出力 (float32) を作る
+    transcript はパディングを含む区切り済みの文字列、char_frames は行ごとの文字のフレーム
+    """
+    logits = rng.normal(scale=0.5, size=(num_frame, len(VOCAB))).astype(np.float32)
+    logits[:, 0] += 4.0
+    # 行内の文字と、行の後ろの区切り "|" を順に並べる (先頭のパディングは音の前)
+    positions = np.concatenate(
+        [np.concatenate([f, [f[-1] + 2]]) for f in char_frames]
+    ).astype(np.int64)
+    ids = np.array(tokenize(transcript[1:], VOCAB))
+    positions = np.clip(positions[: len(ids)], 0, num_frame - 1)
+    logits[positions, ids] += 10.0
+    logits -= logits.max(axis=1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+
+def build_case(scenario, seed=0):
+    """シナリオの入力 (歌詞・emission・トークンなど) を決定的に作る"""
+    rng = np.random.default_rng(seed)
+    lyrics, num_frame, char_frames = synthetic_lyrics(rng, scenario.seconds)
+    clean_lines_data, transcript = prepare_transcript(lyrics)
+    emission = synthetic_emission(rng, num_frame, transcript, char_frames)
+    line_ends = np.cumsum([len(cl) + 1 for _, cl in clean_lines_data[:-1]]).tolist()
+    return {
+        "lyrics": lyrics,
+        "transcript": transcript,
+        "tokens": tokenize(transcript, VOCAB),
+        "line_ends": line_ends,
+        "emission": emission,
+    }
+
+
+def steps(case):
+    """
+    (関数名, 引数なしで呼べる関数) を依存順に返す
+    get_trellis / backtrack は、トレリス全体が align() の省メモリモードの閾値に
+    収まる場合だけ計測する (超える場合は本番でも使われない)
+    """
+    emission, tokens = case["emission"], case["tokens"]
+    state = {}
+    result = [("clean_text", lambda: clean_text(case["lyrics"]))]
+    if trellis_nbytes(len(emission), len(tokens)) <= TRELLIS_MEMORY_LIMIT:
+
+        def run_trellis():
+            state["trellis"] = get_trellis(emission, tokens)
+
+        result += [
+            ("get_trellis", run_trellis),
+            ("backtrack", lambda: backtrack(state["trellis"], emission, tokens)),
+        ]
+
+    def run_align():
+        state.pop("trellis", None)
+        state["path"] = align(emission, tokens)
+
+    def run_merge_repeats():
+        state["segments"] = merge_repeats(state["path"], case["transcript"])
+
+    result += [
+        ("align", run_align),
+        (
+            "align_segmented",
+            lambda: align_segmented(emission, tokens, case["line_ends"], workers=1),
+        ),
+        ("merge_repeats", run_merge_repeats),
+        ("merge_words", lambda: merge_words(state["segments"])),
+    ]
+    return result
+
+
+def measure(fn, repeat):
+    """fn の実行時間の最小値 (秒) と、1 回分のピークメモリ (バイト) を返す"""
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def run(scenarios, repeat=None):
+    """シナリオごとに {関数名: {"seconds", "peak_bytes"}} を計測して返す"""
+    results = {}
+    for name in scenarios:
+        scenario = SCENARIOS[name]
+        case = build_case(scenario)
+        print(
+            f"[Bench] {name}: {case['emission'].shape[0]} フレーム, "
+            f"{len(case['tokens'])} トークン",
+            file=sys.stderr,
+        )
+        results[name] = {}
+        for fn_name, fn in steps(case):
+            seconds, peak = measure(fn, repeat or scenario.repeat)
+            results[name][fn_name] = {"seconds": round(seconds, 5), "peak_bytes": peak}
+            print(
+                f"[Bench]   {fn_name}: {seconds:.4f}秒, {peak / 1024 / 1024:.1f}MB",
+                file=sys.stderr,
+            )
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor() or platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    ベースラインより threshold の割合を超えて遅く (または大きく) なった項目のリストを返す
+    ベースラインにない関数・シナリオは比較しない
+    """
+    regressions = []
+    for scenario, functions in report["results"].items():
+        base_functions = baseline["results"].get(scenario, {})
+        for name, current in functions.items():
+            base = base_functions.get(name)
+            if base is None:
+                continue
+            for metric, min_delta in (
+                ("seconds", MIN_DELTA_SECONDS),
+                ("peak_bytes", MIN_DELTA_BYTES),
+            ):
+                delta = current[metric] - base[metric]
+                if delta > min_delta and current[metric] > base[metric] * (1 + threshold):
+                    regressions.append(
+                        {
+                            "scenario": scenario,
+                            "function": name,
+                            "metric": metric,
+                            "baseline": base[metric],
+                            "current": current[metric],
+                            "ratio": round(current[metric] / max(base[metric], 1e-9), 2),
+                        }
+                    )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for the CTC alignment hot paths on synthetic songs"
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="Song sizes to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=None, help="Timing runs per function (default: per scenario)"
+    )
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE_PATH,
+        help="Baseline JSON file (default: benchmarks/alignment_baseline.json)",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="Write the results to the baseline file"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Compare against the baseline and exit 1 on regressions",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help=f"Relative slowdown treated as a regression (default: {DEFAULT_THRESHOLD})",
+    )
+    args = parser.parse_args()
+
+    report = run(args.scenarios, args.repeat)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        print(json.dumps({"regressions": regressions, **report}, indent=2))
+        sys.exit(1 if regressions else 0)
+
+    print(json.dumps(report, indent=2))
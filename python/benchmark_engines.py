@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+from ctc_engine import ENGINES, PARITY_MAX_FRAME_SHIFT, emission_parity, parity_ok
+from evaluate_tiers import parse_lrc
+from tiers import DEFAULT_TIER, TIERS, get_tier
+
+
+def lrc_shift_frames(reference_lrc, lrc, seconds_per_frame):
+    """2 つの LRC の同じ行のタイムスタンプのずれの最大値 (フレーム)"""
+    reference = parse_lrc(reference_lrc)
+    candidate = parse_lrc(lrc)
+    if len(reference) != len(candidate):
+        return None
+    shifts = [abs(a[0] - b[0]) / seconds_per_frame for a, b in zip(reference, candidate)]
+    return round(max(shifts, default=0.0), 1)
+
+
+def benchmark(audio_path, lyrics_text, engines, tier=None):
+    """
+    CPU 上で各エンジンのロード時間・推論時間を計測し、fp32 の torch との差を返す
+
+    ボーカル抽出は行わない (元音源をそのまま使う)。差は emission の確率の誤差、
+    強制アライメントのトークン開始位置のずれ、LRC の各行のタイムスタンプのずれで見る。
+    """
+    from audio_io import load_audio
+    from lrc_generator import (
+        SAMPLE_RATE,
+        align_lyrics,
+        compute_emission,
+        frame_seconds,
+        load_ctc_model,
+        prepare_transcript,
+        release_device_memory,
+        tokenize,
+    )
+
+    tier = get_tier(tier)
+    prepared = prepare_transcript(lyrics_text)
+    if prepared is None:
+        raise ValueError("歌詞が空または無効です")
+    clean_lines_data, padded_transcript = prepared
+    sr = SAMPLE_RATE
+    audio = load_audio(audio_path, sr)
+
+    report = {}
+    reference = None
+    for engine in ["torch", *[e for e in engines if e != "torch"]]:
+        started = time.perf_counter()
+        processor, model, device = load_ctc_model(
+            tier.aligner_model, "fp32", backend="cpu", engine=engine
+        )
+        load_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        emission = compute_emission(
+            audio, processor, model, device, chunk_seconds=tier.max_chunk_seconds
+        )
+        infer_time = time.perf_counter() - started
+
+        seconds_per_frame = frame_seconds(model, sr)
+        tokens = tokenize(padded_transcript, processor.tokenizer.get_vocab())
+        lrc, _ = align_lyrics(
+            emission, seconds_per_frame, clean_lines_data, padded_transcript, tokens
+        )
+
+        result = {
+            "load_seconds": round(load_time, 2),
+            "inference_seconds": round(infer_time, 2),
+            "realtime_factor": round(infer_time / (len(audio) / sr), 3),
+        }
+        if reference is None:
+            reference = (emission, lrc, tokens)
+        else:
+            parity = emission_parity(reference[0], emission, reference[2])
+            parity["lrc_max_shift_frames"] = lrc_shift_frames(
+                reference[1], lrc, seconds_per_frame
+            )
+            parity["ok"] = parity_ok(parity, engine) and (
+                parity["lrc_max_shift_frames"] is not None
+                and parity["lrc_max_shift_frames"] <= PARITY_MAX_FRAME_SHIFT
+            )
+            result.update(parity)
+        if engine in engines:
+            report[engine] = result
+        print(f"[Bench] {engine}: {result}", file=sys.stderr)
+
+        model = None
+        release_device_memory()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare fp32 torch, int8 and ONNX Runtime engines for CTC inference on CPU"
+    )
+    parser.add_argument("audio", help="Path to input audio file")
+    parser.add_argument("lyrics", help="Lyrics text or path to a text file")
+    parser.add_argument(
+        "--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES)
+    )
+    parser.add_argument(
+        "--tier",
+        choices=list(TIERS),
+        default=DEFAULT_TIER,
+        help=f"Tier whose aligner model is benchmarked (default: {DEFAULT_TIER})",
+    )
+    args = parser.parse_args()
+
+    lyrics = args.lyrics
+    if os.path.isfile(lyrics):
+        with open(lyrics, "r", encoding="utf-8") as f:
+            lyrics = f.read()
+
+    report = benchmark(os.path.abspath(args.audio), lyrics, args.engines, args.tier)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if all(r.get("ok", True) for r in report.values()) else 1)
@@ -0,0 +1,196 @@
+from dataclasses import dataclass
+
+
+# wav2vec2 系 CTC モデルの長時間音声向けチャンク分割 (標準ライブラリのみに依存)
+#
+# 特徴抽出の畳み込みはホップ長 (ストライドの積) ごとに 1 フレームを出力し、
+# フレーム k は入力の [k * hop, k * hop + 受容野) のサンプルだけから計算される。
+# チャンクの開始位置をホップ長の倍数に揃えれば、チャンク内のフレームは全体の
+# フレームと 1 対 1 に対応するので、比率からの概算なしにフレーム単位で結合できる。
+
+# facebook/wav2vec2-large-960h-lv60-self の特徴抽出 (config.conv_kernel / conv_stride)
+WAV2VEC2_CONV_KERNEL = (10, 3, 3, 3, 3, 2, 2)
+WAV2VEC2_CONV_STRIDE = (5, 2, 2, 2, 2, 2, 2)
+# 相対位置の畳み込み埋め込み (config.num_conv_pos_embeddings) のカーネル幅
+WAV2VEC2_CONV_POS_EMBEDDINGS = 128
+
+
+@dataclass(frozen=True)
+class FrameGeometry:
+    """特徴抽出の畳み込みで決まる、サンプルとフレームの対応"""
+
+    conv_kernel: tuple
+    conv_stride: tuple
+    # チャンクの両端に付ける文脈のフレーム数 (出力からは捨てる)
+    context_frames: int
+
+    @property
+    def hop(self):
+        """1 フレームあたりのサンプル数"""
+        hop = 1
+        for s in self.conv_stride:
+            hop *= s
+        return hop
+
+    @property
+    def receptive_field(self):
+        """1 フレームの計算に使われるサンプル数"""
+        field, jump = 1, 1
+        for k, s in zip(self.conv_kernel, self.conv_stride):
+            field += (k - 1) * jump
+            jump *= s
+        return field
+
+    def num_frames(self, num_samples):
+        """num_samples サンプルの入力に対する出力フレーム数 (畳み込みを 1 層ずつ計算)"""
+        n = num_samples
+        for k, s in zip(self.conv_kernel, self.conv_stride):
+            if n < k:
+                return 0
+            n = (n - k) // s + 1
+        return n
+
+    def span_samples(self, num_frames):
+        """num_frames フレームを出力するのに必要な最小のサンプル数"""
+        return (num_frames - 1) * self.hop + self.receptive_field
+
+    @classmethod
+    def from_config(cls, config):
+        """transformers のモデル設定から作る (文脈は位置埋め込みのカーネルの半分)"""
+        return cls(
+            tuple(getattr(config, "conv_kernel", WAV2VEC2_CONV_KERNEL)),
+            tuple(getattr(config, "conv_stride", WAV2VEC2_CONV_STRIDE)),
+            getattr(config, "num_conv_pos_embeddings", WAV2VEC2_CONV_POS_EMBEDDINGS) // 2,
+        )
+
+
+WAV2VEC2_GEOMETRY = FrameGeometry(
+    WAV2VEC2_CONV_KERNEL, WAV2VEC2_CONV_STRIDE, WAV2VEC2_CONV_POS_EMBEDDINGS // 2
+)
+
+
+@dataclass(frozen=True)
+class Chunk:
+    """1 チャンク分の入力範囲 (サンプル) と、出力から残すフレーム範囲"""
+
+    start: int
+    stop: int
+    # チャンクの出力のうち [keep_start, keep_stop) を残す
+    keep_start: int
+    keep_stop: int
+    # 残したフレームの先頭の、音声全体でのフレーム位置
+    frame_start: int
+
+    @property
+    def frame_stop(self):
+        return self.frame_start + self.keep_stop - self.keep_start
+
+
+def seconds_to_frames(seconds, geometry=WAV2VEC2_GEOMETRY, sr=16000):
+    """チャンク長 (秒) をフレーム数に直す"""
+    return max(1, geometry.num_frames(int(seconds * sr)))
+
+
+def plan_chunks(num_samples, chunk_frames, geometry=WAV2VEC2_GEOMETRY, start_frame=0):
+    """
+    音声全体のフレーム [start_frame, 総フレーム数) を、チャンクの列に分割する
+
+    各チャンクは残すフレーム (コア) の前後に geometry.context_frames フレーム分の
+    文脈を持ち、入力は最大 chunk_frames フレーム分。コアは隙間なく連続するので、
+    各チャンクの出力からコアを切り出して順に連結すると、音声全体を 1 回で推論した
+    場合と同じフレーム数・同じフレーム位置になる。
+    先頭と末尾以外のチャンクは同じ長さになる (同じバッチにまとめられる)。
+    """
+    total = geometry.num_frames(num_samples)
+    context = geometry.context_frames
+    core = max(1, chunk_frames - 2 * context)
+
+    chunks = []
+    frame = start_frame
+    while frame < total:
+        core_stop = min(frame + core, total)
+        input_start = max(0, frame - context)
+        input_stop = min(total, core_stop + context)
+        # 末尾のチャンクは残りのサンプルをすべて入力する (全体の推論と同じ端の扱い)
+        if input_stop == total:
+            stop = num_samples
+        else:
+            stop = input_start * geometry.hop + geometry.span_samples(
+                input_stop - input_start
+            )
+        chunks.append(
+            Chunk(
+                input_start * geometry.hop,
+                stop,
+                frame - input_start,
+                core_stop - input_start,
+                frame,
+            )
+        )
+        frame = core_stop
+    return chunks
+
+
+def run_chunked(
+    num_samples,
+    infer,
+    chunk_frames,
+    batch_size,
+    geometry=WAV2VEC2_GEOMETRY,
+    min_chunk_frames=None,
+    is_out_of_memory=None,
+    on_backoff=None,
+):
+    """
+    チャンクを最大 batch_size 個ずつ infer に渡して推論し、残したフレームのリストを返す
+
+    同じバッチには同じ長さのチャンクだけを入れる (パディングが発生しない)。
+    推論がメモリ不足で失敗した場合は、失敗したバッチから再開する。
+    まずバッチサイズを半分にし、1 になったらチャンク長を半分にして残りを計画し直す。
+    min_chunk_frames を下回る場合は例外をそのまま送出する。
+
+    Args:
+        num_samples: 音声全体のサンプル数
+        infer: チャンクのリストを受け取り、各チャンクの出力 (フレーム × 語彙) を返す関数
+        chunk_frames: 1 チャンクの入力フレーム数
+        batch_size: 1 回の infer にまとめるチャンク数
+        geometry: モデルの FrameGeometry
+        min_chunk_frames: バックオフで縮めるチャンク長の下限 (デフォルト: 文脈の 4 倍)
+        is_out_of_memory: 例外がメモリ不足かどうかを判定する関数 (None ならバックオフしない)
+        on_backoff: バックオフ時に (batch_size, chunk_frames) で呼ばれる関数
+    """
+    if min_chunk_frames is None:
+        min_chunk_frames = 4 * geometry.context_frames
+    kept = []
+    frame = 0
+    total = geometry.num_frames(num_samples)
+    while frame < total:
+        chunks = plan_chunks(num_samples, chunk_frames, geometry, start_frame=frame)
+        try:
+            start = 0
+            while start < len(chunks):
+                stop = start + 1
+                while (
+                    stop < len(chunks)
+                    and stop - start < batch_size
+                    and chunks[stop].stop - chunks[stop].start
+                    == chunks[start].stop - chunks[start].start
+                ):
+                    stop += 1
+                outputs = infer(chunks[start:stop])
+                for chunk, output in zip(chunks[start:stop], outputs):
+                    kept.append(output[chunk.keep_start : chunk.keep_stop])
+                frame = chunks[stop - 1].frame_stop
+                start = stop
+        except Exception as e:
+            if is_out_of_memory is None or not is_out_of_memory(e):
+                raise
+            if batch_size > 1:
+                batch_size //= 2
+            elif chunk_frames // 2 >= min_chunk_frames:
+                chunk_frames //= 2
+            else:
+                raise
+            if on_backoff is not None:
+                on_backoff(batch_size, chunk_frames)
+    return kept
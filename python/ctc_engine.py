@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import types
+
+import numpy as np
+
+from alignment import align
+from chunking import FrameGeometry
+from disk_cache import DiskCache, default_cache_dir, make_key
+from lrc_core import align_lines, prepare_transcript, tokenize
+
+
+# CPU 向けの CTC 推論エンジン
+#
+# - torch:      transformers のモデルをそのまま使う (fp32、または CUDA での fp16)
+# - torch-int8: nn.Linear を int8 に動的量子化した torch のモデル
+# - onnx:       ONNX にエクスポートしたグラフを ONNX Runtime (CPU) で実行する
+# - onnx-int8:  エクスポートしたグラフの重みを int8 に動的量子化したもの
+#
+# torch 以外のエンジンは CPU で動かす。ONNX のエクスポートはローカルにキャッシュし、
+# 初回のエクスポート時に fp32 の torch の出力と比べて、確率の誤差か LRC の行の位置の
+# ずれ (lrc_core.align_lines でアライメントした結果) が許容範囲を超えたら採用しない。
+
+ENGINES = ("torch", "torch-int8", "onnx", "onnx-int8")
+DEFAULT_ENGINE = "torch"
+
+ONNX_OPSET = 17
+# ONNX のエクスポートのキャッシュの容量上限 (large モデルの fp32 で約 1.3GB)
+DEFAULT_ONNX_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+# エクスポートの形式 (入力やパリティチェックを変えたら上げて、古いエクスポートを使わない)
+ONNX_EXPORT_VERSION = 2
+ONNX_FILE = "model.onnx"
+PARITY_FILE = "parity.json"
+
+# パリティチェックの許容範囲: 確率 (exp した emission) の最大誤差と、
+# 強制アライメントでのトークン開始位置のずれ (フレーム、実際の音声と歌詞で確認する場合)
+PARITY_ATOL = {"onnx": 1e-3, "onnx-int8": 0.2, "torch-int8": 0.2}
+PARITY_MAX_FRAME_SHIFT = 3
+# エクスポート時のパリティチェックに使う音声の長さ (秒)。infer_batch と同じように、
+# 長さの違う 2 つのチャンク (マスクを使うモデルではパディングしたバッチ) で比べる
+PARITY_SECONDS = 8
+PARITY_SHORT_SECONDS = 5
+# エクスポート時のパリティチェックで、LRC の行の位置を比べるためにアライメントする歌詞
+PARITY_LYRICS = "Hello darkness my old friend\nI come to talk with you again\nSing along"
+
+
+def uses_attention_mask(processor):
+    """
+    モデルが attention_mask を受け付けるか (特徴抽出の return_attention_mask に従う)
+
+    feat_extract_norm="group" のモデル (wav2vec2-base など) はマスクを渡してはいけない。
+    """
+    feature_extractor = getattr(processor, "feature_extractor", processor)
+    return bool(getattr(feature_extractor, "return_attention_mask", False))
+
+
+def token_start_frames(emission, tokens, blank_id=0):
+    """強制アライメントで各トークンが始まるフレーム位置を返す"""
+    path = align(emission, tokens, blank_id)
+    first = np.concatenate([[0], np.flatnonzero(np.diff(path.token_index)) + 1])
+    return path.frame[first]
+
+
+def emission_parity(reference, candidate, tokens=None, blank_id=0):
+    """
+    2 つの emission (log_softmax) の違いを返す
+
+    max_prob_diff / mean_prob_diff は確率の誤差 (log 確率の誤差は、使われない
+    極端に小さい確率で大きくなるため使わない)。tokens を渡すと、同じトークン列で
+    強制アライメントしたときのトークン開始位置のずれ (フレーム) を max_frame_shift に入れる。
+    フレーム数が違う場合は比較できないので comparable を False にする。
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    if reference.shape != candidate.shape:
+        return {"comparable": False}
+    diff = np.abs(np.exp(reference) - np.exp(candidate))
+    parity = {
+        "comparable": True,
+        "max_prob_diff": float(diff.max()),
+        "mean_prob_diff": float(diff.mean()),
+    }
+    if tokens is not None:
+        shift = np.abs(
+            token_start_frames(reference, tokens, blank_id)
+            - token_start_frames(candidate, tokens, blank_id)
+        )
+        parity["max_frame_shift"] = int(shift.max())
+    return parity
+
+
+def line_frame_shift(reference, candidate, vocab, lyrics=PARITY_LYRICS):
+    """
+    同じ歌詞を lrc_core.align_lines で 2 つの emission にアライメントし、
+    LRC の各行の開始・終了フレームのずれの最大を返す (片方だけ位置が決まらない行があれば None)
+    """
+    clean_lines_data, padded_transcript = prepare_transcript(lyrics)
+    tokens = tokenize(padded_transcript, vocab)
+    reference_lines, _ = align_lines(
+        reference, clean_lines_data, padded_transcript, tokens, workers=1
+    )
+    candidate_lines, _ = align_lines(
+        candidate, clean_lines_data, padded_transcript, tokens, workers=1
+    )
+    shift = 0
+    for a, b in zip(reference_lines, candidate_lines):
+        for field in ("start", "end"):
+            if a[field] is None or b[field] is None:
+                if a[field] != b[field]:
+                    return None
+                continue
+            shift = max(shift, abs(a[field] - b[field]))
+    return shift
+
+
+def parity_ok(parity, engine):
+    """emission_parity の結果がエンジンの許容範囲に収まっているか"""
+    if not parity["comparable"]:
+        return False
+    for field in ("max_frame_shift", "max_line_shift"):
+        if field in parity and (
+            parity[field] is None or parity[field] > PARITY_MAX_FRAME_SHIFT
+        ):
+            return False
+    return parity["max_prob_diff"] <= PARITY_ATOL.get(engine, 0.0)
+
+
+def parity_audio(sr=16000, seconds=PARITY_SECONDS):
+    """パリティチェック用の決定的な音声 (音程の変わるトーンと雑音)"""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(sr * seconds)) / sr
+    pitch = 180 + 60 * np.sin(2 * np.pi * 0.5 * t)
+    tone = 0.3 * np.sin(2 * np.pi * np.cumsum(pitch) / sr)
+    return (tone + rng.normal(scale=0.02, size=t.shape)).astype(np.float32)
+
+
+def _logits_only(model, attention_mask=True):
+    """エクスポート用に logits だけを返すモジュールで包む (attention_mask=False なら入力は音声だけ)"""
+    import torch
+
+    class LogitsOnly(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_values, attention_mask):
+            return self.model(input_values, attention_mask=attention_mask).logits
+
+    class ValuesOnly(LogitsOnly):
+        def forward(self, input_values):
+            return self.model(input_values).logits
+
+    return (LogitsOnly if attention_mask else ValuesOnly)(model)
+
+
+def export_onnx(model, path, opset=ONNX_OPSET, attention_mask=True):
+    """
+    CTC モデルを、バッチ・長さ可変の ONNX グラフとして path に書き出す
+
+    attention_mask=False (uses_attention_mask が偽のモデル) なら attention_mask の入力を持たない。
+    """
+    import torch
+
+    wrapped = _logits_only(model.float().cpu().eval(), attention_mask)
+    inputs = (torch.zeros(1, 16000),)
+    input_names = ["input_values"]
+    dynamic_axes = {
+        "input_values": {0: "batch", 1: "samples"},
+        "logits": {0: "batch", 1: "frames"},
+    }
+    if attention_mask:
+        inputs += (torch.ones(1, 16000, dtype=torch.long),)
+        input_names.append("attention_mask")
+        dynamic_axes["attention_mask"] = {0: "batch", 1: "samples"}
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapped,
+            inputs,
+            path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+
+
+def quantize_onnx(src, dst):
+    """ONNX グラフの重みを int8 に動的量子化する"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+
+
+class OnnxCTCModel:
+    """
+    ONNX Runtime のセッションを transformers の CTC モデルと同じ呼び出し方で使うラッパー
+    (infer_batch から見て、model(input_values, attention_mask=...).logits が同じように動く)
+    グラフが attention_mask の入力を持たない場合は、渡されたマスクを使わない。
+    """
+
+    def __init__(self, path, config, threads=None):
+        import onnxruntime as ort
+        import torch
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.config = config
+        self.dtype = torch.float32
+        self._takes_mask = any(
+            i.name == "attention_mask" for i in self.session.get_inputs()
+        )
+        self._geometry = FrameGeometry.from_config(config)
+
+    def eval(self):
+        return self
+
+    def _get_feat_extract_output_lengths(self, lengths):
+        import torch
+
+        return torch.tensor([self._geometry.num_frames(int(n)) for n in lengths])
+
+    def __call__(self, input_values, attention_mask=None):
+        import torch
+
+        values = input_values.detach().cpu().numpy().astype(np.float32)
+        feeds = {"input_values": values}
+        if self._takes_mask:
+            if attention_mask is None:
+                feeds["attention_mask"] = np.ones(values.shape, dtype=np.int64)
+            else:
+                feeds["attention_mask"] = attention_mask.detach().cpu().numpy().astype(np.int64)
+        (logits,) = self.session.run(["logits"], feeds)
+        return types.SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+def quantize_torch(model):
+    """nn.Linear を int8 に動的量子化した CPU 用のモデルを返す"""
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(
+        model.float().cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def parity_chunks(sr=16000):
+    """パリティチェック用の長さの違う 2 つのチャンク"""
+    audio = parity_audio(sr)
+    return [audio, audio[: sr * PARITY_SHORT_SECONDS]]
+
+
+def check_parity(reference_model, model, processor):
+    """
+    パリティチェック用の音声で fp32 の torch モデルと比べ、emission_parity の結果を返す
+
+    両方のモデルに parity_chunks を lrc_generator.infer_batch で 1 つのバッチとして渡し、
+    本番と同じパディング・attention_mask (マスクを使わないモデルでは長さごとの推論) で比べる。
+    PARITY_LYRICS を両方の emission にアライメントした LRC の行の位置のずれ (フレーム) を
+    max_line_shift に入れる (合成音声なので歌詞とは合わないが、エンジンの違いで
+    位置が動かないことは確かめられる。実際の曲では benchmark_engines.py で確認する)。
+    """
+    import torch
+
+    # lrc_generator はこのモジュールを import するので、ここで読み込む
+    from lrc_generator import infer_batch
+
+    chunks = parity_chunks()
+    device = torch.device("cpu")
+    reference = infer_batch(chunks, processor, reference_model, device)
+    candidate = infer_batch(chunks, processor, model, device)
+    parity = emission_parity(np.concatenate(reference), np.concatenate(candidate))
+    if parity["comparable"]:
+        parity["max_line_shift"] = line_frame_shift(
+            reference[0], candidate[0], processor.tokenizer.get_vocab()
+        )
+    return parity
+
+
+class OnnxExportCache(DiskCache):
+    """ONNX にエクスポートしたモデル (と int8 量子化版) のキャッシュ"""
+
+    def __init__(self, root=None, max_bytes=DEFAULT_ONNX_CACHE_BYTES):
+        super().__init__(root or default_cache_dir("onnx"), max_bytes)
+
+    @staticmethod
+    def key(model_id, engine):
+        import transformers
+
+        return make_key(
+            "onnx", model_id, engine, ONNX_OPSET, ONNX_EXPORT_VERSION, transformers.__version__
+        )
+
+
+def load_onnx_engine(model, processor, model_id, engine, cache=None):
+    """
+    engine ("onnx" / "onnx-int8") の OnnxCTCModel を返す
+
+    キャッシュになければエクスポート (と量子化) してパリティチェックを行い、
+    許容範囲に収まった場合だけキャッシュに公開する。収まらない場合は RuntimeError。
+    """
+    cache = cache or OnnxExportCache()
+    key = OnnxExportCache.key(model_id, engine)
+    entry = cache.lookup(key)
+    if entry is None:
+        print(f"[LRC] {engine} エンジン用に ONNX へエクスポートします...", file=sys.stderr)
+
+        def write(path):
+            onnx_path = os.path.join(path, ONNX_FILE)
+            attention_mask = uses_attention_mask(processor)
+            if engine == "onnx-int8":
+                fp32_path = os.path.join(path, "fp32.onnx")
+                export_onnx(model, fp32_path, attention_mask=attention_mask)
+                quantize_onnx(fp32_path, onnx_path)
+                os.remove(fp32_path)
+            else:
+                export_onnx(model, onnx_path, attention_mask=attention_mask)
+
+            parity = check_parity(model, OnnxCTCModel(onnx_path, model.config), processor)
+            with open(os.path.join(path, PARITY_FILE), "w", encoding="utf-8") as f:
+                json.dump(parity, f)
+            if not parity_ok(parity, engine):
+                raise RuntimeError(f"{engine} の出力が許容範囲を超えました: {parity}")
+
+        entry = cache.store(key, write)
+    import torch
+
+    return OnnxCTCModel(
+        os.path.join(entry, ONNX_FILE), model.config, threads=torch.get_num_threads()
+    )
+
+
+def load_torch_int8_engine(model, processor):
+    """torch-int8 のモデルを返す (量子化は数秒なのでキャッシュしない)"""
+    quantized = quantize_torch(model)
+    parity = check_parity(model, quantized, processor)
+    if not parity_ok(parity, "torch-int8"):
+        raise RuntimeError(f"torch-int8 の出力が許容範囲を超えました: {parity}")
+    return quantized
+
+
+def load_engine(model, processor, model_id, engine=DEFAULT_ENGINE):
+    """fp32 の CPU 上の torch モデルから、engine の推論モデルを作って返す"""
+    if engine == "torch":
+        return model
+    if engine == "torch-int8":
+        return load_torch_int8_engine(model, processor)
+    if engine in ("onnx", "onnx-int8"):
+        return load_onnx_engine(model, processor, model_id, engine)
+    raise ValueError(f"不明なエンジンです: {engine} (選択肢: {', '.join(ENGINES)})")
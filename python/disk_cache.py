@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+# キャッシュ全体の置き場所 (環境変数 BADWAVE_CACHE_DIR で変更できる)
+CACHE_DIR_ENV = "BADWAVE_CACHE_DIR"
+# CTC の emission キャッシュの容量上限 (4 分の曲で 1MB 弱)
+DEFAULT_EMISSION_CACHE_BYTES = 256 * 1024 * 1024
+# 分離済みステムのキャッシュの容量上限 (MP3 のボーカルとインストで 1 曲 10MB 前後、
+# CTC 用の 16kHz モノラルのボーカルの配列が 4 分の曲で約 15MB)
+DEFAULT_STEM_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+# ステムのキャッシュの容量上限 (MB) を変える環境変数
+STEM_CACHE_MB_ENV = "BADWAVE_STEM_CACHE_MB"
+# 内容ハッシュを計算するときの読み込み単位
+HASH_BLOCK_SIZE = 1024 * 1024
+# 書き込み途中のエントリのディレクトリ名の接頭辞 (一覧・容量計算の対象外)
+TMP_PREFIX = ".tmp-"
+
+
+def default_cache_dir(name):
+    """BadWave のキャッシュディレクトリ (の下の name) のパスを返す"""
+    root = os.environ.get(CACHE_DIR_ENV)
+    if not root:
+        if sys.platform == "win32":
+            base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+            root = os.path.join(base, "BadWave", "cache")
+        else:
+            base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            root = os.path.join(base, "badwave")
+    return os.path.join(root, name)
+
+
+def file_digest(path):
+    """ファイル内容の SHA-256 (16 進文字列)。パスや更新日時ではなく中身でキャッシュを引く"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_key(*parts):
+    """キーの構成要素から、ディレクトリ名に使えるキー文字列を作る"""
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskCache:
+    """
+    キーごとに 1 ディレクトリを持つ、容量上限つきの LRU ディスクキャッシュ
+
+    エントリは一時ディレクトリに書き終えてから rename で公開するので、
+    他のプロセスが書き込み途中のファイルを読むことはない。
+    参照したエントリは更新日時を新しくし、容量を超えたら古いものから削除する。
+    hits / misses はこのインスタンスでの参照回数。
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        """エントリのディレクトリを返す (LRU の順位を更新する)。なければ None"""
+        path = self._path(key)
+        if os.path.isdir(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def store(self, key, write):
+        """
+        write(ディレクトリ) でエントリを書き込み、公開したディレクトリを返す
+        同じキーを別のプロセスが先に公開していた場合は、そちらを残す
+        """
+        path = self._path(key)
+        tmp = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.root)
+        try:
+            write(tmp)
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return path
+
+    def entries(self):
+        """(更新日時, バイト数, キー) のリストを古い順に返す"""
+        result = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return result
+        for name in names:
+            if name.startswith(TMP_PREFIX):
+                continue
+            path = self._path(name)
+            try:
+                if not os.path.isdir(path):
+                    continue
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            result.append((mtime, _dir_size(path), name))
+        result.sort()
+        return result
+
+    def evict(self, keep=None):
+        """合計が max_bytes に収まるまで古いエントリを削除し、削除した数を返す"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def purge(self):
+        """すべてのエントリを削除し、削除した数を返す"""
+        entries = self.entries()
+        for _, _, key in entries:
+            shutil.rmtree(self._path(key), ignore_errors=True)
+        return len(entries)
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "path": self.root,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class EmissionCache(DiskCache):
+    """
+    CTC の log_softmax 出力 (emission) のキャッシュ
+
+    音声の内容・モデル・ボーカル抽出の方法が同じなら emission も同じなので、
+    歌詞だけを直して再生成する場合はアライメントだけで済む。
+    emission は float16 の .npy で保存する (容量は float32 の半分)。get() は mmap で開いた
+    ファイルから float32 に変換した配列をメモリ上に作って返す (アライメントは全体を読むので、
+    遅延して変換しても得にならない。mmap は float16 のままの複製を作らないためだけに使う)。
+    """
+
+    EMISSION_FILE = "emission.npy"
+    META_FILE = "meta.json"
+
+    def __init__(self, root=None, max_bytes=DEFAULT_EMISSION_CACHE_BYTES):
+        super().__init__(root or default_cache_dir("emissions"), max_bytes)
+
+    @staticmethod
+    def key(
+        audio_digest,
+        model_id,
+        separation,
+        precision="fp32",
+        engine="torch",
+        vad=False,
+        stream=False,
+    ):
+        """
+        separation はボーカル分離のモデル名 (分離しない場合は None)
+        vad は無音区間の推論を飛ばしたかどうか、stream はボーカル分離をウィンドウごとに
+        行ったかどうか (どちらも False のキーは従来と同じ)
+        """
+        parts = ["emission", audio_digest, model_id, separation, precision, engine]
+        if vad:
+            parts.append("vad")
+        if stream:
+            parts.append("stream")
+        return make_key(*parts)
+
+    def get(self, key):
+        """
+        (emission (float32), 1 フレームあたりの秒数, VAD で推論を飛ばしたフレーム区間) を返す。
+        なければ None。区間は VAD を実行しなかったエントリでは None
+        """
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(os.path.join(path, self.META_FILE), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            stored = np.load(os.path.join(path, self.EMISSION_FILE), mmap_mode="r")
+            # float32 への変換でファイル全体を読み、ファイルから切り離した配列になる
+            emission = np.asarray(stored, dtype=np.float32)
+            seconds_per_frame = meta["seconds_per_frame"]
+            skipped = meta.get("skipped")
+        except (OSError, ValueError, KeyError):
+            # 別プロセスによる削除と競合した場合などは未ヒット扱いにする
+            self.hits -= 1
+            self.misses += 1
+            return None
+        if skipped is not None:
+            skipped = [tuple(r) for r in skipped]
+        return emission, seconds_per_frame, skipped
+
+    def put(self, key, emission, seconds_per_frame, skipped=None):
+        def write(path):
+            np.save(
+                os.path.join(path, self.EMISSION_FILE),
+                np.asarray(emission, dtype=np.float16),
+            )
+            with open(os.path.join(path, self.META_FILE), "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "seconds_per_frame": seconds_per_frame,
+                        "shape": list(emission.shape),
+                        "skipped": skipped,
+                    },
+                    f,
+                )
+
+        return self.store(key, write)
+
+
+class StemCache(DiskCache):
+    """
+    ボーカル分離の出力 (ボーカル/インストゥルメンタルのファイル) のキャッシュ
+
+    音声の内容と分離モデルが同じなら出力も同じなので、同じ曲の再生成では分離を省略できる。
+    ファイル (MP3) とは別に、CTC に渡したボーカルの float32 の配列を、サンプリングレートと
+    チャンネル数ごとに劣化なしで保存する (put_array)。MP3 をデコードした波形は分離直後の
+    配列と一致しないので、キャッシュの有無で emission が変わらないようにするため。
+    エントリのファイルはキャッシュが管理するので、利用側で削除してはいけない。
+    容量上限は max_bytes、省略時は環境変数 BADWAVE_STEM_CACHE_MB (MB 単位) で決める。
+    """
+
+    VOCALS = "vocals"
+    INSTRUMENTAL = "instrumental"
+
+    def __init__(self, root=None, max_bytes=None):
+        if max_bytes is None:
+            mb = os.environ.get(STEM_CACHE_MB_ENV)
+            max_bytes = int(mb) * 1024 * 1024 if mb else DEFAULT_STEM_CACHE_BYTES
+        super().__init__(root or default_cache_dir("stems"), max_bytes)
+
+    @staticmethod
+    def key(audio_digest, model_name):
+        return make_key("stems", audio_digest, model_name)
+
+    @classmethod
+    def _stem_paths(cls, entry):
+        paths = {cls.VOCALS: None, cls.INSTRUMENTAL: None}
+        for name in os.listdir(entry):
+            stem = os.path.splitext(name)[0]
+            if stem in paths:
+                paths[stem] = os.path.join(entry, name)
+        return paths
+
+    def get(self, key):
+        """{"vocals": パス, "instrumental": パス} を返す。なければ None"""
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            paths = self._stem_paths(path)
+        except OSError:
+            paths = {}
+        if not paths.get(self.VOCALS):
+            self.hits -= 1
+            self.misses += 1
+            return None
+        return paths
+
+    @classmethod
+    def _array_name(cls, sr, mono):
+        return f"{cls.VOCALS}_{sr or 'native'}_{'mono' if mono else 'stereo'}.npz"
+
+    def get_array(self, key, sr=None, mono=True):
+        """put_array で保存したボーカルの (配列, サンプリングレート) を返す。なければ None"""
+        path = os.path.join(self._path(key), self._array_name(sr, mono))
+        try:
+            with np.load(path) as data:
+                return data["vocals"], int(data["sample_rate"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def put_array(self, key, vocals, sample_rate, sr=None, mono=True):
+        """
+        公開済みのエントリに、ボーカルの配列を (sr, mono) の組ごとに追加する
+        (一時ファイルに書いてから置き換えるので、読み手が書き込み途中のファイルを読むことはない)
+        """
+        entry = self._path(key)
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, suffix=".npz", dir=entry)
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, vocals=vocals, sample_rate=sample_rate)
+            os.replace(tmp, os.path.join(entry, self._array_name(sr, mono)))
+        except OSError:
+            # エントリが別のプロセスに削除された場合は保存しない
+            return
+        self.evict(keep=key)
+
+    def put(self, key, stems):
+        """
+        stems ({"vocals": パス, "instrumental": パス}) のファイルをキャッシュに移動し、
+        キャッシュ内のパスの dict を返す
+        """
+
+        def write(entry):
+            for stem, src in stems.items():
+                if src:
+                    ext = os.path.splitext(src)[1]
+                    shutil.move(src, os.path.join(entry, stem + ext))
+
+        entry = self.store(key, write)
+        # 既に別プロセスが公開していた場合は移動元が残るので片付ける
+        for src in stems.values():
+            if src and os.path.exists(src):
+                try:
+                    os.remove(src)
+                except OSError:
+                    pass
+        return self._stem_paths(entry)
@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+
+from tiers import DEFAULT_TIER, TIERS
+
+# この秒数以内のずれを「合っている」とみなす (LRC のタイムスタンプの許容範囲)
+DEFAULT_TOLERANCE = 0.3
+
+LRC_LINE = re.compile(r"^\[(\d+):(\d+(?:\.\d+)?)\](.*)$")
+
+
+def parse_lrc(text):
+    """LRC 文字列を (秒, 歌詞) のリストにする。[by:...] などのタグ行は無視する"""
+    lines = []
+    for line in text.splitlines():
+        match = LRC_LINE.match(line.strip())
+        if match:
+            minutes, seconds, lyric = match.groups()
+            lines.append((int(minutes) * 60 + float(seconds), lyric.strip()))
+    return lines
+
+
+def line_errors(generated, reference):
+    """
+    参照 LRC の各行について、同じ歌詞の生成行とのずれ (秒、絶対値) を求める
+
+    生成結果は参照と同じ順序で並ぶので、前から順に同じ歌詞の行を探して対応付ける。
+    (ずれのリスト, 対応する行が見つからなかった参照行の数) を返す
+    """
+    errors = []
+    missing = 0
+    pos = 0
+    for ref_time, ref_text in reference:
+        for i in range(pos, len(generated)):
+            if generated[i][1] == ref_text:
+                errors.append(abs(generated[i][0] - ref_time))
+                pos = i + 1
+                break
+        else:
+            missing += 1
+    return errors, missing
+
+
+def summarize(errors, missing, wall_times, tolerance=DEFAULT_TOLERANCE):
+    """ティア 1 つ分の計測結果をまとめる"""
+    ordered = sorted(errors)
+    p90 = ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))] if ordered else None
+    return {
+        "songs": len(wall_times),
+        "lines": len(errors),
+        "missing_lines": missing,
+        "mean_abs_error": round(statistics.fmean(errors), 3) if errors else None,
+        "median_abs_error": round(statistics.median(errors), 3) if errors else None,
+        "p90_abs_error": round(p90, 3) if p90 is not None else None,
+        f"within_{tolerance}s": (
+            round(sum(e <= tolerance for e in errors) / len(errors), 3) if errors else None
+        ),
+        "wall_time_total": round(sum(wall_times), 1),
+        "wall_time_median": round(statistics.median(wall_times), 1) if wall_times else None,
+    }
+
+
+def read_eval_manifest(manifest_path):
+    """
+    評価用マニフェスト (JSON Lines) を読み込む
+
+    各行は {"audio", "lyrics" または "lyrics_path", "reference" または "reference_path"}。
+    reference は手で合わせた正解の LRC。*_path はマニフェストからの相対パスでもよい。
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            for key in ("lyrics", "reference"):
+                if key not in entry and f"{key}_path" in entry:
+                    path = os.path.join(base_dir, entry[f"{key}_path"])
+                    with open(path, "r", encoding="utf-8") as ef:
+                        entry[key] = ef.read()
+            entry["audio"] = os.path.join(base_dir, entry["audio"])
+            entries.append(entry)
+    return entries
+
+
+def evaluate(manifest_path, tier_names, tolerance=DEFAULT_TOLERANCE):
+    """
+    マニフェストの曲を各ティアで生成し、ティアごとのタイムスタンプ誤差と処理時間を返す
+    キャッシュは使わず、ティアごとにモデルを読み込み直す (最初の曲はロード時間を含む)
+    """
+    from lrc_generator import ModelCache, generate_lrc
+
+    entries = read_eval_manifest(manifest_path)
+    report = {}
+    for name in tier_names:
+        models = ModelCache()
+        errors, missing, wall_times, failed = [], 0, [], 0
+        try:
+            for entry in entries:
+                started = time.perf_counter()
+                result = generate_lrc(
+                    entry["audio"], entry["lyrics"], models=models, tier=name
+                )
+                wall_times.append(time.perf_counter() - started)
+                reference = parse_lrc(entry["reference"])
+                if result["status"] != "success":
+                    failed += 1
+                    missing += len(reference)
+                    continue
+                song_errors, song_missing = line_errors(parse_lrc(result["lrc"]), reference)
+                errors.extend(song_errors)
+                missing += song_missing
+        finally:
+            models.unload()
+        report[name] = {**summarize(errors, missing, wall_times, tolerance), "failed": failed}
+        print(f"[Eval] {name}: {report[name]}", file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare timestamp error and wall time of LRC generation tiers"
+    )
+    parser.add_argument(
+        "manifest", help="JSON Lines of {audio, lyrics|lyrics_path, reference|reference_path}"
+    )
+    parser.add_argument(
+        "--tiers",
+        nargs="+",
+        choices=list(TIERS),
+        default=list(TIERS),
+        help=f"Tiers to evaluate (default: all; generate_lrc default is {DEFAULT_TIER})",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"Error in seconds counted as correct (default: {DEFAULT_TOLERANCE})",
+    )
+    args = parser.parse_args()
+
+    print(json.dumps(evaluate(args.manifest, args.tiers, args.tolerance), indent=2))
@@ -0,0 +1,261 @@
+import os
+import sys
+
+
+# 推論 1 秒分の音声に必要なメモリの概算 (wav2vec2-large, fp32, 勾配なし)
+BYTES_PER_AUDIO_SECOND = 12 * 1024 * 1024
+# 空きメモリのうち推論バッチに使う割合
+MEMORY_BUDGET_RATIO = 0.5
+# バッチサイズの上限
+MAX_BATCH_SIZE = 8
+# 空きメモリを取得できないデバイス (DirectML など) でのバッチサイズ
+UNKNOWN_MEMORY_BATCH_SIZE = 2
+# チャンク長 (秒) の範囲。長いほど文脈の重複は減るが、自己注意のメモリは 2 乗で増える
+MIN_CHUNK_SECONDS = 10
+MAX_CHUNK_SECONDS = 30
+
+# 推論バックエンド。coreml は torch では Apple Silicon の GPU (MPS) に対応させる
+BACKENDS = ("cuda", "directml", "coreml", "cpu")
+# 自動選択での優先順位 (速い順、最後は必ず CPU)
+BACKEND_PRIORITY = {
+    "win32": ("cuda", "directml", "cpu"),
+    "darwin": ("coreml", "cpu"),
+    "linux": ("cuda", "cpu"),
+}
+# CPU 推論の intra-op スレッド数を固定する環境変数
+CPU_THREADS_ENV = "BADWAVE_CPU_THREADS"
+
+# resource_policy が決めた計算スレッド数の上限 (None なら使える CPU 数)
+_thread_limit = None
+# torch の既定の intra-op スレッド数 (上限を外したときに戻す値)
+_torch_default_threads = None
+# torch の inter-op スレッド数を設定したか (並列処理を始める前に 1 回しか設定できない)
+_torch_interop_configured = False
+
+
+def host_available_memory():
+    """ホストの利用可能なメモリ量 (バイト) を返す。取得できない場合は None"""
+    if sys.platform == "win32":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong),
+                ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong),
+                ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong),
+                ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong),
+                ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+
+    # Linux: ページキャッシュなど解放可能な分を含む MemAvailable を使う
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_memory(device):
+    """torch デバイスの空きメモリ (バイト) を返す。取得できない場合は None"""
+    device_type = getattr(device, "type", str(device))
+    if device_type == "cuda":
+        import torch
+
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    if device_type == "cpu":
+        return host_available_memory()
+    return None
+
+
+def memory_budget(device, memory_ratio=MEMORY_BUDGET_RATIO, memory_limit=None):
+    """
+    推論に使うメモリの量 (バイト)。空きメモリの memory_ratio 倍を memory_limit で頭打ちにする
+    空きメモリを取得できず memory_limit もなければ None
+    """
+    free = available_memory(device)
+    if free is None:
+        return memory_limit
+    budget = int(free * memory_ratio)
+    return budget if memory_limit is None else min(budget, memory_limit)
+
+
+def choose_batch_size(
+    device,
+    chunk_seconds,
+    max_batch_size=MAX_BATCH_SIZE,
+    memory_ratio=MEMORY_BUDGET_RATIO,
+    memory_limit=None,
+):
+    """空きメモリ (memory_budget) から、1 回の forward にまとめるチャンク数を決める"""
+    budget = memory_budget(device, memory_ratio, memory_limit)
+    if budget is None:
+        return min(UNKNOWN_MEMORY_BATCH_SIZE, max_batch_size)
+    per_chunk = BYTES_PER_AUDIO_SECOND * chunk_seconds
+    return max(1, min(max_batch_size, int(budget // per_chunk)))
+
+
+def choose_chunk_seconds(
+    device, max_seconds=MAX_CHUNK_SECONDS, memory_ratio=MEMORY_BUDGET_RATIO, memory_limit=None
+):
+    """空きメモリ (memory_budget) から、1 チャンクの長さ (秒) を決める"""
+    budget = memory_budget(device, memory_ratio, memory_limit)
+    if budget is None:
+        return max_seconds
+    seconds = int(budget // BYTES_PER_AUDIO_SECOND)
+    return max(MIN_CHUNK_SECONDS, min(max_seconds, seconds))
+
+
+def is_out_of_memory(error):
+    """推論中の例外がデバイス (またはホスト) のメモリ不足によるものかどうか"""
+    if isinstance(error, MemoryError) or type(error).__name__ == "OutOfMemoryError":
+        return True
+    message = str(error).lower()
+    # CUDA: "CUDA out of memory", DirectML: "not enough GPU video memory" など
+    return "out of memory" in message or ("not enough" in message and "memory" in message)
+
+
+def backend_candidates(backend="auto", platform=None):
+    """試すバックエンドを優先順に返す (auto 以外はそのバックエンドだけ)"""
+    if backend != "auto":
+        if backend not in BACKENDS:
+            raise ValueError(f"不明なバックエンドです: {backend}")
+        return [backend]
+    return list(BACKEND_PRIORITY.get(platform or sys.platform, ("cpu",)))
+
+
+def usable_cpu_count():
+    """このプロセスが使える CPU 数 (アフィニティが取れる環境ではそれに従う)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def thread_limit():
+    """resource_policy が設定した計算スレッド数の上限 (設定していなければ None)"""
+    return _thread_limit
+
+
+def set_thread_limit(threads):
+    """
+    計算スレッド数の上限を設定する (None で外す)
+    torch を読み込み済みなら、その intra-op スレッド数もすぐに合わせる
+    """
+    global _thread_limit
+    _thread_limit = threads
+    if "torch" in sys.modules:
+        configure_cpu_threads()
+
+
+def configure_cpu_threads():
+    """
+    CPU 推論のスレッド数を設定し、設定した数 (intra-op) を返す
+
+    torch の既定はホストの物理コア数なので、コンテナやアフィニティで使える CPU が
+    それより少ない場合はスレッドが取り合いになる。使える CPU 数 (と thread_limit) を上限にする。
+    inter-op スレッド数は torch が並列処理を始めた後には変えられないので、最初の 1 回だけ
+    同じ数にする (それ以降に thread_limit が変わっても inter-op は変わらない)。
+    """
+    import torch
+
+    global _torch_default_threads, _torch_interop_configured
+    if _torch_default_threads is None:
+        _torch_default_threads = torch.get_num_threads()
+    threads = os.environ.get(CPU_THREADS_ENV)
+    if threads:
+        threads = int(threads)
+    else:
+        threads = min(_torch_default_threads, _thread_limit or usable_cpu_count())
+    torch.set_num_threads(max(1, threads))
+    if not _torch_interop_configured:
+        _torch_interop_configured = True
+        try:
+            torch.set_num_interop_threads(max(1, threads))
+        except RuntimeError:
+            # 既に inter-op の並列処理が始まっている (ほかのライブラリが先に設定した場合も含む)
+            pass
+    return torch.get_num_threads()
+
+
+def torch_device(backend):
+    """バックエンド名から torch デバイスを作る。使えない場合は None (パッケージは必要になってから import)"""
+    import torch
+
+    if backend == "cuda":
+        return torch.device("cuda") if torch.cuda.is_available() else None
+    if backend == "directml":
+        try:
+            import torch_directml
+        except ImportError:
+            return None
+        return torch_directml.device() if torch_directml.is_available() else None
+    if backend == "coreml":
+        mps = getattr(torch.backends, "mps", None)
+        return torch.device("mps") if mps is not None and mps.is_available() else None
+    if backend == "cpu":
+        configure_cpu_threads()
+        return torch.device("cpu")
+    raise ValueError(f"不明なバックエンドです: {backend}")
+
+
+def select_torch_device(backend="auto"):
+    """
+    優先順に使えるバックエンドを探し、(バックエンド名, torch デバイス) を返す
+    自動選択では最後に CPU を使う。指定したバックエンドが使えない場合は RuntimeError
+    """
+    for name in backend_candidates(backend):
+        device = torch_device(name)
+        if device is not None:
+            return name, device
+    raise RuntimeError(f"{backend} バックエンドは使用できません")
+
+
+def inference_precision(precision, backend="auto", engine="torch"):
+    """
+    CTC モデルを実際に推論する精度を返す ("fp16" は torch エンジンで CUDA を使う場合だけ。
+    他のデバイスやエンジンでは fp32 で読み込むので "fp32")
+    """
+    if precision != "fp16" or engine != "torch":
+        return "fp32"
+    # CUDA は自動選択でも最優先なので、最初の候補が CUDA で使える場合だけ半精度になる
+    candidates = backend_candidates(backend)
+    if not candidates or candidates[0] != "cuda":
+        return "fp32"
+    try:
+        cuda = torch_device("cuda")
+    except ImportError:
+        # torch のない環境 (モデルの事前取得だけを行う場合など) では CUDA も使えない
+        return "fp32"
+    return "fp16" if cuda is not None else "fp32"
+
+
+def inference_context(device):
+    """
+    推論用の autograd 無効化コンテキストを返す
+
+    inference_mode は no_grad よりオーバーヘッドが小さいが、DirectML (privateuseone) は
+    inference テンソルに対応していないため no_grad を使う。
+    """
+    import torch
+
+    if getattr(device, "type", str(device)) == "privateuseone":
+        return torch.no_grad()
+    return torch.inference_mode()
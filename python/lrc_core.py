@@ -0,0 +1,210 @@
+import re
+
+import numpy as np
+
+from alignment import align_segmented, merge_repeats, merge_words
+from metrics import stage
+from vad import compress_skipped, expand_path
+
+
+# 歌詞の前処理・LRC の組み立て・アライメント (標準ライブラリと NumPy のみに依存)
+#
+# モデルを使わない部分なので、torch / transformers / librosa を読み込まずに import できる。
+# lrc_generator はここの関数を再エクスポートしている。
+
+# LRCのタイムスタンプを早める秒数 (同期感を向上)
+GLOBAL_OFFSET = -0.3
+
+
+def clean_text(text):
+
+    # セクションヘッダー除外
+    lines = [line.strip() for line in text.split("\n") if line.strip()]
+    lines = [
+        line for line in lines if not (line.startswith("[") and line.endswith("]"))
+    ]
+    lines = [
+        line for line in lines if not (line.startswith("「") and line.endswith("」"))
+    ]
+
+    clean_lines = []
+    for line in lines:
+        cleaned = re.sub(r"[^a-zA-Z\s\']", "", line)
+        cleaned = re.sub(r"\s+", "|", cleaned).strip("|").upper()
+        if cleaned:
+            clean_lines.append((line, cleaned))
+    return clean_lines
+
+
+def format_lrc_timestamp(seconds):
+    minutes = int(seconds // 60)
+    secs = seconds % 60
+    return f"[{minutes:02d}:{secs:05.2f}]"
+
+
+def prepare_transcript(lyrics_text):
+    """
+    歌詞を前処理し、(clean_lines_data, padded_transcript) を返す
+    有効な行がなければ None を返す
+    """
+    clean_lines_data = clean_text(lyrics_text)
+    if not clean_lines_data:
+        return None
+
+    full_transcript = "|".join([cl for _, cl in clean_lines_data])
+    # 先頭と末尾にパディング
+    return clean_lines_data, f"|{full_transcript}|"
+
+
+def tokenize(transcript, vocab):
+    """文字列をCTCモデルの語彙でトークンIDの列に変換する"""
+    unk_id = vocab.get("<unk>", 0)
+    return [vocab.get(c, unk_id) for c in transcript]
+
+
+def token_frames(path, num_tokens):
+    """各トークンにパスが移ったフレーム (置かれなかったトークンは -1)"""
+    starts = np.flatnonzero(np.diff(path.token_index, prepend=-1))
+    frames = np.full(num_tokens, -1, dtype=np.int64)
+    frames[path.token_index[starts]] = path.frame[starts]
+    return frames
+
+
+def token_confidences(emission, path, tokens):
+    """
+    各トークンが置かれた (最初の) フレームでの、そのトークンの確率を返す (置かれなければ 0)
+
+    path.score はトレリスの累積確率で行どうしを比べられないので、emission から取り直す。
+    トレリスの t 行目は t - 1 フレームまでを消費した状態なので、トークンを出力したのは
+    パス上でそのトークンに移った点の 1 フレーム前になる。
+    """
+    tokens = np.asarray(tokens, dtype=np.int64)
+    frames = token_frames(path, len(tokens))
+    placed = np.flatnonzero(frames >= 0)
+    probs = np.zeros(len(tokens))
+    probs[placed] = np.exp(
+        np.asarray(emission, dtype=np.float32)[
+            np.maximum(frames[placed] - 1, 0), tokens[placed]
+        ]
+    )
+    return probs
+
+
+def lines_from_path(emission, path, clean_lines_data, padded_transcript, tokens):
+    """
+    アライメントのパスから行のリスト ({"text", "start", "end", "confidence"}) を作る
+
+    start は行の最初の単語の始まり、end は行の最後の文字の直後のフレーム
+    (単語が置かれなかった行は None)。end は後ろの無音を含まないので、
+    行の間の区間を求める境界に使える。confidence は行内の文字の確率の平均。
+    """
+    segments = merge_repeats(path, padded_transcript)
+    word_segments = merge_words(segments)
+    frames = token_frames(path, len(tokens))
+    probs = token_confidences(emission, path, tokens)
+
+    lines = []
+    current_word_idx = 1  # パディングの|を飛ばす
+    char_pos = 1
+    for original_line, clean_line in clean_lines_data:
+        words_in_line = clean_line.count("|") + 1
+        last_char = char_pos + len(clean_line) - 1
+        line = {"text": original_line, "start": None, "end": None}
+        if current_word_idx < len(word_segments) and frames[last_char] >= 0:
+            line["start"] = int(word_segments.start[current_word_idx])
+            line["end"] = int(frames[last_char]) + 1
+        chars = [char_pos + i for i, c in enumerate(clean_line) if c != "|"]
+        line["confidence"] = float(probs[chars].mean()) if chars else 0.0
+        lines.append(line)
+        current_word_idx += words_in_line
+        char_pos += len(clean_line) + 1
+    return lines
+
+
+def align_lines(
+    emission,
+    clean_lines_data,
+    padded_transcript,
+    tokens,
+    workers=None,
+    metrics=None,
+    skipped=None,
+):
+    """
+    emission と歌詞をアライメントし、(行のリスト, アライメント情報) を返す
+
+    行は lines_from_path の dict。
+    metrics (Metrics) を渡すと alignment (trellis / backtrack) と lrc_assembly を記録する
+    skipped は VAD で推論を飛ばしたフレーム区間 (vad.skipped_ranges)。その区間を詰めてから計算する
+    """
+    # 行の区切りをアンカーに分割して並列アライメント (分割できない場合は全体で計算)
+    # トレリスが大きい場合 (長時間の音源など) は自動で省メモリモードになる
+    line_ends = []
+    pos = 0
+    for _, clean_line in clean_lines_data[:-1]:
+        pos += len(clean_line) + 1
+        line_ends.append(pos)
+
+    # ボーカルのない区間として推論を飛ばしたフレームは詰めてからトレリスを計算する
+    compressed, kept = compress_skipped(emission, skipped)
+    timing = {}
+    with stage(metrics, "alignment", tokens=len(tokens), frames=len(compressed)):
+        path, align_info = align_segmented(
+            compressed, tokens, line_ends, workers=workers, timing=timing
+        )
+    path = expand_path(path, kept)
+    if kept is not None:
+        align_info["skipped_frames"] = len(emission) - len(kept)
+    if metrics is not None:
+        # 分割アライメントの各グループはワーカープロセスで動くので、合計の秒数だけを記録する
+        for name, seconds in timing.items():
+            metrics.add(name, parent="alignment", wall_seconds=round(seconds, 4))
+
+    with stage(metrics, "lrc_assembly"):
+        lines = lines_from_path(
+            emission, path, clean_lines_data, padded_transcript, tokens
+        )
+
+    if lines:
+        align_info["confidence"] = round(
+            sum(line["confidence"] for line in lines) / len(lines), 3
+        )
+    return lines, align_info
+
+
+def build_lrc(lines, seconds_per_frame):
+    """align_lines の行から LRC 文字列を組み立てる"""
+    lrc_lines = ["[by:BadWave AI]"]
+    for line in lines:
+        if line["start"] is not None:
+            start_time = max(0, line["start"] * seconds_per_frame + GLOBAL_OFFSET)
+            lrc_lines.append(f"{format_lrc_timestamp(start_time)}{line['text']}")
+    return "\n".join(lrc_lines)
+
+
+def align_lyrics(
+    emission,
+    seconds_per_frame,
+    clean_lines_data,
+    padded_transcript,
+    tokens,
+    workers=None,
+    metrics=None,
+    skipped=None,
+):
+    """
+    emission と歌詞をアライメントし、(LRC文字列, アライメント情報) を返す
+    モデルを使わない CPU のみの処理なので、バッチ処理ではプロセスプールで並列に実行する
+    metrics (Metrics) を渡すと alignment (trellis / backtrack) と lrc_assembly を記録する
+    skipped は align_lines を参照
+    """
+    lines, align_info = align_lines(
+        emission,
+        clean_lines_data,
+        padded_transcript,
+        tokens,
+        workers=workers,
+        metrics=metrics,
+        skipped=skipped,
+    )
+    return build_lrc(lines, seconds_per_frame), align_info
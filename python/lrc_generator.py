@@ -1,136 +1,488 @@
 import sys
 import json
-import re
 import os
 import gc
-import librosa
+import multiprocessing
+import contextlib
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import uuid
 import numpy as np
-import torch
-import torch_directml
-from transformers import AutoProcessor, AutoModelForCTC
-
-
-# CTC強制アライメントの計算
-def get_trellis(emission, tokens, blank_id=0):
-    num_frame = len(emission)
-    num_tokens = len(tokens)
-    trellis = np.full((num_frame, num_tokens), -np.inf)
-
-    # 初期条件
-    cumsum = 0
-    for t in range(num_frame):
-        cumsum += emission[t][blank_id]
-        trellis[t][0] = cumsum
-
-    for t in range(num_frame - 1):
-        p_stay = emission[t][blank_id]
-        for j in range(1, num_tokens):
-            p_change = emission[t][tokens[j]]
-            stay_score = trellis[t][j] + p_stay
-            change_score = trellis[t][j - 1] + p_change
-            trellis[t + 1][j] = max(stay_score, change_score)
-    return trellis
-
-
-def backtrack(trellis, emission, tokens, blank_id=0):
-    t, j = trellis.shape[0] - 1, trellis.shape[1] - 1
-    path = []
-
-    # 最後の点
-    path.append((j, t, np.exp(emission[t][blank_id])))
-
-    while j > 0:
-        if t <= 0:
-            break
-        p_stay = emission[t - 1][blank_id]
-        p_change = emission[t - 1][tokens[j]]
-        stay_score = trellis[t - 1][j] + p_stay
-        change_score = trellis[t - 1][j - 1] + p_change
-
-        t -= 1
-        if change_score > stay_score:
-            j -= 1
-
-        prob = np.exp(change_score if change_score > stay_score else stay_score)
-        path.append((j, t, prob))
-
-    while t > 0:
-        path.append((j, t - 1, np.exp(emission[t - 1][blank_id])))
-        t -= 1
-
-    return path[::-1]
-
-
-def merge_repeats(path, transcript):
-    i1 = 0
-    segments = []
-    while i1 < len(path):
-        i2 = i1
-        while i2 < len(path) and path[i1][0] == path[i2][0]:
-            i2 += 1
-        score = sum(p[2] for p in path[i1:i2]) / (i2 - i1)
-        segments.append(
-            {
-                "label": transcript[path[i1][0]],
-                "start": path[i1][1],
-                "end": path[i2 - 1][1] + 1,
-                "score": score,
-            }
+
+# torch / transformers / librosa は読み込みに数秒かかるため、使う関数の中で import する
+# (--server の起動直後に ping へ応答できるようにするため。tests/test_startup.py で確認している)
+from alignment import TRELLIS_MEMORY_LIMIT, trellis_nbytes
+from audio_io import StreamingAudio, audio_duration, open_audio
+from chunking import WAV2VEC2_GEOMETRY, FrameGeometry, run_chunked, seconds_to_frames
+from ctc_engine import DEFAULT_ENGINE, ENGINES, load_engine, uses_attention_mask
+from disk_cache import EmissionCache, StemCache, file_digest
+from hardware import (
+    BACKENDS,
+    BYTES_PER_AUDIO_SECOND,
+    available_memory,
+    choose_batch_size,
+    choose_chunk_seconds,
+    host_available_memory,
+    inference_context,
+    inference_precision,
+    is_out_of_memory,
+    select_torch_device,
+)
+from lrc_core import (
+    GLOBAL_OFFSET,
+    align_lines,
+    align_lyrics,
+    build_lrc,
+    clean_text,
+    format_lrc_timestamp,
+    prepare_transcript,
+    tokenize,
+)
+from lyric_session import LyricSession
+from metrics import METRICS_FILE_ENV, Metrics, append_metrics, stage
+from model_store import ModelStore, resolve_ctc, resolve_processor, set_offline
+from resource_policy import (
+    PROFILES,
+    ResourceGovernor,
+    apply_process_policy,
+    get_profile,
+    memory_limit,
+    thread_budget,
+)
+from scheduler import DEFAULT_LIMITS, JobScheduler
+from streaming_separation import WINDOW_SECONDS, StreamingSeparation
+from tiers import ALIGNER_PARAMETERS, DEFAULT_TIER, TIERS, get_tier
+from vad import skipped_ranges, skipped_rows, vocal_regions
+
+# アライメントに使う既定のCTCモデル (ティアを指定しない場合の Large モデル)
+MODEL_ID = get_tier(DEFAULT_TIER).aligner_model
+# 既定のボーカル分離モデル
+SEPARATOR_MODEL = get_tier(DEFAULT_TIER).separator_model
+# 常駐ワーカーがアイドル状態でモデルを解放するまでの秒数
+DEFAULT_IDLE_TIMEOUT = 300
+# 常駐ワーカーが保持する歌詞編集セッションの数 (超えたら古いものから閉じる)
+MAX_SESSIONS = 4
+# 常駐ワーカーの応答を待たずに返すコマンド (モデルにもディスクキャッシュにも触らない)
+# update_lyrics は差分の再アライメントで済む場合だけすぐに返す (update_lyrics_inline)
+INLINE_COMMANDS = ("ping", "cache_stats", "close_session")
+
+# ジョブのメモリの見積もり用 (estimate_job_memory)
+# CTC の語彙数 (wav2vec2-960h の文字 + 特殊トークン)
+EMISSION_VOCAB_SIZE = 32
+# ボーカル分離モデル (MDX-Net の ONNX) と onnxruntime のセッション
+SEPARATOR_BYTES = 512 * 1024 * 1024
+# 分離中に保持する音声 1 秒あたりのバイト数 (44.1kHz ステレオ float32 の原音と 2 つのステム)
+SEPARATION_BYTES_PER_SECOND = 44100 * 2 * 4 * 3
+
+# この長さ (秒) 以上の音声は、ボーカル抽出をウィンドウごとに行いながら推論する
+# (全体を分離してから推論するとメモリが曲の長さに比例して増えるため。無音区間の除外は行わない)
+STREAM_SEPARATION_SECONDS = 20 * 60
+
+# 推論時のサンプリングレート (チャンク長は空きメモリから決める)
+SAMPLE_RATE = 16000
+
+# 適応的なボーカル抽出で、元音源のままでよいとみなす行ごとの信頼度 (文字の確率の平均) の下限
+ADAPTIVE_CONFIDENCE_THRESHOLD = 0.5
+# 信頼度の低い区間が曲のこの割合以下なら、その区間だけを抽出したボーカルで推論し直す
+MAX_SPAN_RATIO = 0.3
+
+
+def release_device_memory():
+    """GCを実行し、デバイスのキャッシュを解放する"""
+    gc.collect()
+    # torch をまだ読み込んでいなければ解放するキャッシュも無い
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def infer_batch(chunks, processor, model, device):
+    """
+    複数のチャンクをパディングして 1 回の forward で推論し、
+    チャンクごとの log_softmax 出力 (フレーム数 × 語彙数) のリストを返す
+
+    attention_mask を渡すため、パディングは各チャンクの出力に影響しない。
+    パディング部分のフレームは特徴抽出の出力長で切り落とす。
+    attention_mask を受け付けないモデル (base など feat_extract_norm="group" のもの) は
+    GroupNorm がパディングの 0 も含めて正規化するので、同じ長さのチャンクごとに分けて推論する。
+    """
+    import torch
+
+    lengths = [len(c) for c in chunks]
+    if len(set(lengths)) > 1 and not uses_attention_mask(processor):
+        emissions = [None] * len(chunks)
+        for length in dict.fromkeys(lengths):
+            indices = [i for i, n in enumerate(lengths) if n == length]
+            outputs = infer_batch([chunks[i] for i in indices], processor, model, device)
+            for i, emission in zip(indices, outputs):
+                emissions[i] = emission
+        return emissions
+
+    # 長さが揃っている場合はパディングが無いので、マスクなしで 1 チャンクずつ推論した場合と同じ計算になる
+    needs_mask = len(set(lengths)) > 1
+
+    inputs = processor(
+        list(chunks),
+        sampling_rate=SAMPLE_RATE,
+        return_tensors="pt",
+        padding=True,
+        return_attention_mask=needs_mask,
+    )
+    # fp16 で読み込んだモデルには入力も同じ精度で渡す
+    input_values = inputs.input_values.to(device, dtype=model.dtype)
+
+    with inference_context(device):
+        if needs_mask:
+            logits = model(
+                input_values, attention_mask=inputs.attention_mask.to(device)
+            ).logits
+        else:
+            logits = model(input_values).logits
+
+    emissions = torch.log_softmax(logits.float(), dim=-1).cpu().numpy()
+    frame_lengths = model._get_feat_extract_output_lengths(
+        torch.tensor(lengths)
+    ).tolist()
+    return [emissions[i, :n] for i, n in enumerate(frame_lengths)]
+
+
+def frame_seconds(model, sr=SAMPLE_RATE):
+    """emission の 1 フレームあたりの秒数 (特徴抽出のホップ長)"""
+    return FrameGeometry.from_config(model.config).hop / sr
+
+
+def compute_emission(
+    audio,
+    processor,
+    model,
+    device,
+    batch_size=None,
+    chunk_seconds=None,
+    sr=SAMPLE_RATE,
+    metrics=None,
+    regions=None,
+):
+    """
+    音声全体をチャンク分割して推論し、結合した log_softmax 出力を返す
+
+    チャンクの境界はモデルの特徴抽出のホップ長に揃え、前後の文脈フレームを
+    捨ててから連結するので、出力のフレーム位置は音声全体と正確に対応する。
+    チャンクは最大 batch_size 個ずつまとめて推論する。chunk_seconds と batch_size は
+    None なら空きメモリから決め、推論がメモリ不足で失敗したら小さくして続きから再開する。
+    metrics (Metrics) を渡すと、1 回の forward ごとに inference_batch として記録する。
+    audio は配列か StreamingAudio (または StreamingSeparation)。ストリームならバッチごとに
+    必要な区間だけを読み込む (分離する)。
+    regions (フレーム区間のリスト、vad.vocal_regions) を渡すと、その区間だけを推論し、
+    それ以外のフレームは blank だけの行 (vad.skipped_rows) で埋める。
+    """
+    geometry = FrameGeometry.from_config(model.config)
+    if chunk_seconds is None:
+        chunk_seconds = choose_chunk_seconds(device)
+    if batch_size is None:
+        batch_size = choose_batch_size(device, chunk_seconds)
+
+    total = geometry.num_frames(len(audio))
+    release = getattr(audio, "release", None)
+
+    def on_backoff(new_batch_size, chunk_frames):
+        release_device_memory()
+        print(
+            f"[LRC] メモリ不足のため縮小して再開します "
+            f"(バッチサイズ: {new_batch_size}, チャンク: {chunk_frames * geometry.hop / sr:.1f}秒)",
+            file=sys.stderr,
         )
-        i1 = i2
-    return segments
-
-
-def merge_words(segments, separator="|"):
-    words = []
-    i1, i2 = 0, 0
-    while i1 < len(segments):
-        if i2 >= len(segments) or segments[i2]["label"] == separator:
-            if i1 != i2:
-                segs = segments[i1:i2]
-                word = "".join(s["label"] for s in segs)
-                word_start = segs[0]["start"]
-                word_end = segs[-1]["end"]
-                score = sum(s["score"] * (s["end"] - s["start"]) for s in segs) / (
-                    word_end - word_start
+
+    def run_region(frame_start, frame_stop):
+        # 区間の先頭はホップ長の倍数なので、区間内のフレームは全体のフレームと 1 対 1 に対応する
+        offset = frame_start * geometry.hop
+        if frame_stop >= total:
+            length = len(audio) - offset
+        else:
+            length = geometry.span_samples(frame_stop - frame_start)
+
+        def infer(chunks):
+            if release is not None:
+                # このバッチより前のサンプルは、メモリ不足からの再開を含めてもう参照しない
+                release(offset + chunks[0].start)
+            audio_seconds = sum(c.stop - c.start for c in chunks) / sr
+            with stage(
+                metrics,
+                "inference_batch",
+                chunks=len(chunks),
+                audio_seconds=round(audio_seconds, 2),
+            ):
+                return infer_batch(
+                    [audio[offset + c.start : offset + c.stop] for c in chunks],
+                    processor,
+                    model,
+                    device,
                 )
-                words.append(
-                    {"word": word, "start": word_start, "end": word_end, "score": score}
+
+        return run_chunked(
+            length,
+            infer,
+            seconds_to_frames(chunk_seconds, geometry, sr),
+            batch_size,
+            geometry,
+            is_out_of_memory=is_out_of_memory,
+            on_backoff=on_backoff,
+        )
+
+    if regions is None:
+        emissions = run_region(0, total)
+        if not emissions:
+            raise ValueError("音声が短すぎます")
+        return np.concatenate(emissions, axis=0)
+
+    emission = None
+    for frame_start, frame_stop in regions:
+        if frame_start >= total:
+            break
+        emissions = run_region(frame_start, frame_stop)
+        if not emissions:
+            continue
+        output = np.concatenate(emissions, axis=0)
+        if emission is None:
+            emission = skipped_rows(total, output.shape[1])
+        emission[frame_start : frame_start + len(output)] = output
+    if emission is None:
+        raise ValueError("音声が短すぎます")
+    return emission
+
+
+def load_processor(model_id=MODEL_ID):
+    """トークナイザを含むプロセッサだけを読み込む (emission がキャッシュにある場合)"""
+    from transformers import AutoProcessor
+
+    return AutoProcessor.from_pretrained(resolve_processor(model_id))
+
+
+def load_ctc_model(
+    model_id=MODEL_ID, precision="fp32", backend="auto", engine=DEFAULT_ENGINE
+):
+    """
+    プロセッサとCTCモデルを読み込み、(processor, model, device) を返す
+    precision="fp16" は CUDA でのみ半精度にする (他のデバイスでは fp32 のまま。
+    hardware.inference_precision と同じ判定)
+    backend が "auto" ならプラットフォームごとの優先順 (CUDA > DirectML/Core ML > CPU) で選ぶ
+    engine が "torch" 以外 (ONNX Runtime / int8 量子化) の場合は CPU で動かす
+    モデルはローカルのモデルストアの safetensors から mmap で読み込む (なければ取得して保存する)。
+    重みは実際に推論する精度のものを使う (fp16 に丸めた重みを fp32 で動かさない)
+    """
+    import torch
+    from transformers import AutoModelForCTC
+
+    if engine != "torch":
+        backend = "cpu"
+
+    backend, device = select_torch_device(backend)
+    threads = f", threads: {torch.get_num_threads()}" if backend == "cpu" else ""
+    print(f"[LRC] Using device: {device} ({backend}{threads})", file=sys.stderr)
+
+    half = (
+        engine == "torch"
+        and precision == "fp16"
+        and getattr(device, "type", None) == "cuda"
+    )
+    path = resolve_ctc(model_id, "fp16" if half else "fp32")
+    processor = load_processor(model_id)
+    model = AutoModelForCTC.from_pretrained(
+        path,
+        local_files_only=True,
+        torch_dtype=torch.float16 if half else torch.float32,
+        low_cpu_mem_usage=True,
+    ).to(device)
+    model.eval()
+    if engine != "torch":
+        print(f"[LRC] Using engine: {engine}", file=sys.stderr)
+        model = load_engine(model, processor, model_id, engine)
+    return processor, model, device
+
+
+def separate_once(
+    audio_path, stem_cache=None, model_name=SEPARATOR_MODEL, backend="auto", metrics=None
+):
+    """
+    分離モデルをロードして 1 曲分のボーカルを 16kHz モノラルの配列で返す (常駐ワーカー以外)
+    モデルは戻り値に含めないので、呼び出し側で release_device_memory() すれば解放される
+    """
+    from vocal_separator import separate_vocals
+
+    output_dir = tempfile.mkdtemp(prefix="badwave_stems_")
+    try:
+        return separate_vocals(
+            audio_path,
+            output_dir,
+            model_name,
+            backend,
+            stem_cache=stem_cache,
+            return_array=True,
+            sr=SAMPLE_RATE,
+            metrics=metrics,
+        )
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+class ModelCache:
+    """
+    常駐ワーカー (--server) で読み込み済みのモデルを保持する
+
+    CTCモデルとボーカル分離モデルをリクエスト間で使い回す。ティアの違いなどで
+    別のモデルを要求された場合は、読み込み済みのものを破棄して入れ替える。
+    unload() でモデルを破棄してデバイスメモリを解放する。
+    emission_cache / stem_cache は unload() しても残る (ディスク上のキャッシュ)。
+    sessions (歌詞編集の LyricSession) も emission を CPU メモリに持つだけなので unload() では閉じない。
+    backend は CTCモデルとボーカル分離の両方のデバイス選択に、engine は CTCモデルの推論に使う。
+    """
+
+    def __init__(
+        self, emission_cache=None, stem_cache=None, backend="auto", engine=DEFAULT_ENGINE
+    ):
+        self._ctc = None
+        self._ctc_key = None
+        self._processor = None
+        self._processor_id = None
+        self._separator = None
+        self._separator_model = None
+        self._stem_dir = None
+        self.emission_cache = emission_cache
+        self.stem_cache = stem_cache
+        self.backend = backend
+        self.engine = engine
+        self.sessions = {}
+        # スケジューラの複数のジョブから呼ばれるので、モデルの入れ替えは 1 つずつ行う
+        # (分離モデルは 1 曲ずつしか使えないので、分離の間は _separator_lock を持つ)
+        self._lock = threading.RLock()
+        self._separator_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._ctc is not None or self._separator is not None
+
+    def ctc(self, model_id=MODEL_ID, precision="fp32"):
+        with self._lock:
+            if self._ctc_key != (model_id, precision):
+                self._ctc = None
+                release_device_memory()
+                self._ctc = load_ctc_model(model_id, precision, self.backend, self.engine)
+                self._ctc_key = (model_id, precision)
+            return self._ctc
+
+    def processor(self, model_id=MODEL_ID):
+        with self._lock:
+            if self._ctc is not None and self._ctc_key[0] == model_id:
+                return self._ctc[0]
+            if self._processor_id != model_id:
+                self._processor = load_processor(model_id)
+                self._processor_id = model_id
+            return self._processor
+
+    @contextlib.contextmanager
+    def separator(self, model_name=SEPARATOR_MODEL, metrics=None):
+        """分離モデルを (必要なら読み込んで) ブロックを抜けるまで占有する"""
+        from vocal_separator import load_separator
+
+        with self._separator_lock:
+            if self._separator_model != model_name:
+                self._separator = None
+                self._separator_model = None
+                release_device_memory()
+                if self._stem_dir is None:
+                    self._stem_dir = tempfile.mkdtemp(prefix="badwave_stems_")
+                with stage(metrics, "separator_load", model=model_name):
+                    self._separator = load_separator(self._stem_dir, model_name, self.backend)
+                self._separator_model = model_name
+            yield self._separator
+
+    def separate(self, audio_path, model_name=SEPARATOR_MODEL, stem_cache=None, **kwargs):
+        from vocal_separator import separate_vocals
+
+        with contextlib.ExitStack() as stack:
+            try:
+                separator = stack.enter_context(
+                    self.separator(model_name, kwargs.get("metrics"))
                 )
-            i1 = i2 + 1
-            i2 = i1
-        else:
-            i2 += 1
-    return words
+            except Exception as e:
+                return {"status": "error", "message": str(e)}
+            return separate_vocals(
+                audio_path,
+                model_name=model_name,
+                separator=separator,
+                stem_cache=stem_cache,
+                **kwargs,
+            )
 
+    def open_session(self, session):
+        """LyricSession を登録して ID を返す"""
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self.sessions[session_id] = session
+            while len(self.sessions) > MAX_SESSIONS:
+                self.sessions.pop(next(iter(self.sessions)))
+        return session_id
 
-def clean_text(text):
+    def release_separator(self):
+        """分離モデルだけを破棄してデバイスメモリを返す (CTCモデルを読み込む前に使う)"""
+        with self._separator_lock:
+            self._separator = None
+            self._separator_model = None
+        release_device_memory()
 
-    # セクションヘッダー除外
-    lines = [line.strip() for line in text.split("\n") if line.strip()]
-    lines = [
-        line for line in lines if not (line.startswith("[") and line.endswith("]"))
-    ]
-    lines = [
-        line for line in lines if not (line.startswith("「") and line.endswith("」"))
-    ]
+    def release_ctc(self):
+        """CTCモデルだけを破棄してデバイスメモリを返す (分離モデルを読み込む前に使う)"""
+        with self._lock:
+            self._ctc = None
+            self._ctc_key = None
+        release_device_memory()
 
-    clean_lines = []
-    for line in lines:
-        cleaned = re.sub(r"[^a-zA-Z\s\']", "", line)
-        cleaned = re.sub(r"\s+", "|", cleaned).strip("|").upper()
-        if cleaned:
-            clean_lines.append((line, cleaned))
-    return clean_lines
+    def release_memory(self):
+        """モデルは保持したまま、GCとデバイスのキャッシュ解放だけを行う"""
+        release_device_memory()
+
+    def unload(self):
+        with self._lock, self._separator_lock:
+            self._ctc = None
+            self._ctc_key = None
+            self._processor = None
+            self._processor_id = None
+            self._separator = None
+            self._separator_model = None
+            if self._stem_dir:
+                shutil.rmtree(self._stem_dir, ignore_errors=True)
+                self._stem_dir = None
+        self.release_memory()
 
 
-def format_lrc_timestamp(seconds):
-    minutes = int(seconds // 60)
-    secs = seconds % 60
-    return f"[{minutes:02d}:{secs:05.2f}]"
+def _no_acquire(resource):
+    """スケジューラなしで実行する場合の acquire"""
+    return contextlib.nullcontext()
 
 
-def generate_lrc(audio_path, lyrics_text, use_vocal_separation=True):
+def generate_lrc(
+    audio_path,
+    lyrics_text,
+    use_vocal_separation=True,
+    models=None,
+    batch_size=None,
+    emission_cache=None,
+    stem_cache=None,
+    tier=None,
+    backend="auto",
+    engine=DEFAULT_ENGINE,
+    metrics_file=None,
+    skip_silence=True,
+    adaptive_separation=False,
+    confidence_threshold=ADAPTIVE_CONFIDENCE_THRESHOLD,
+    open_session=False,
+    acquire=None,
+    stream_separation=None,
+    profile=None,
+):
     """
     音声ファイルと歌詞テキストからLRCファイルを生成する
 
@@ -138,166 +490,634 @@ def generate_lrc(audio_path, lyrics_text, use_vocal_separation=True):
         audio_path: 音声ファイルのパス
         lyrics_text: 歌詞テキスト
         use_vocal_separation: ボーカル抽出を行うかどうか (デフォルト: True)
+        models: 常駐ワーカーの ModelCache (None ならその都度ロードする)
+        batch_size: 1 回の推論にまとめるチャンク数 (None なら空きメモリから決める)
+        emission_cache: EmissionCache (None ならキャッシュしない)。ヒットした場合は
+            ボーカル抽出・音声読み込み・CTC推論を省略してアライメントだけを行う
+        stem_cache: StemCache (None ならステムのファイルを作らず、ボーカルは配列で受け取る)
+        tier: ティア名または Tier (None なら既定の "accurate")。分離モデル (またはなし)、
+            アライメントモデル、チャンク長の上限、推論の精度を決める
+        backend: 推論デバイス ("auto", "cuda", "directml", "coreml", "cpu")。
+            models を渡した場合は models.backend を使う
+        engine: CTC推論のエンジン ("torch", "torch-int8", "onnx", "onnx-int8")。
+            models を渡した場合は models.engine を使う
+        metrics_file: ジョブの計測を追記する JSON Lines のファイル
+            (None なら環境変数 BADWAVE_METRICS_FILE、どちらもなければ追記しない)
+        skip_silence: ボーカル抽出した音声の無音区間 (イントロ・間奏など) を
+            CTC推論とトレリスの計算から除く (抽出しない場合は常に全体を推論する)
+        adaptive_separation: まず元音源でアライメントし、行ごとの信頼度が
+            confidence_threshold 未満の行がある場合だけボーカル抽出して推論し直す
+            (低い行の区間が短ければ、その区間だけを抽出したボーカルで推論する)
+        open_session: True なら結果の "session" に LyricSession を入れる
+            (歌詞を直したときに、変わった行だけを再アライメントできる)
+        acquire: スケジューラの資源を確保する関数 (scheduler.JobScheduler.submit が渡す)。
+            ボーカル抽出と推論は "device"、アライメントは "cpu" の資源で行う
+        stream_separation: True ならボーカル抽出を重なりのあるウィンドウごとに行い、
+            分離したボーカルを順にチャンク分割推論に流す (メモリが曲の長さによらない。
+            無音区間の除外は行わない)。None なら STREAM_SEPARATION_SECONDS 以上の音声で行う
+        profile: resource_policy のプロファイル ("foreground" / "background"、None なら既定)。
+            アライメントのワーカー数と、チャンク・バッチの大きさを決めるメモリの上限に使う
+            (スレッド数と優先度はプロセスに apply_process_policy / ResourceGovernor で適用する)
+
+    結果の "separation" に、ボーカル抽出をどう使ったか (path: "mix" / "separated" /
+    "separated_spans") と信頼度を入れる。
+    結果の "metrics" に、ステージごと (cache_lookup, separation, model_load, decode,
+    inference と各 inference_batch, alignment と trellis / backtrack, lrc_assembly) の
+    実時間・CPU 時間・ピーク RSS・ピークのデバイスメモリを入れる。
     """
-    vocal_path = None
-    instrumental_path = None
-    try:
-        # 0. ボーカル抽出（精度向上のため）- 別プロセスで実行してGPUメモリを解放
-        if use_vocal_separation:
-            print("[LRC] ボーカル抽出を開始...", file=sys.stderr)
+    metrics = Metrics()
+    job = {"command": "generate", "engine": engine}
+    result = _generate_lrc(
+        audio_path,
+        lyrics_text,
+        use_vocal_separation,
+        models,
+        batch_size,
+        emission_cache,
+        stem_cache,
+        tier,
+        backend,
+        engine,
+        skip_silence,
+        adaptive_separation,
+        confidence_threshold,
+        open_session,
+        acquire or _no_acquire,
+        stream_separation,
+        profile,
+        metrics,
+        job,
+    )
+    result["metrics"] = metrics.as_dict()
+    append_metrics({**job, "status": result["status"], **result["metrics"]}, metrics_file)
+    return result
 
-            # vocal_separator.py を別プロセスで実行（GPUメモリ解放のため）
-            import subprocess
 
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            separator_script = os.path.join(script_dir, "vocal_separator.py")
-            python_exe = sys.executable
+class _AlignerLoader:
+    """1 つのジョブの中で、CTCモデル (またはプロセッサだけ) を必要になった時に 1 回だけ読み込む"""
 
-            result = subprocess.run(
-                [python_exe, separator_script, audio_path],
-                capture_output=True,
-                text=True,
-            )
+    def __init__(self, tier, models, backend, engine, metrics, job):
+        self.tier = tier
+        self.models = models
+        self.backend = backend
+        self.engine = engine
+        self.metrics = metrics
+        self.job = job
+        self._model = None
+        self._processor = None
 
-            if result.returncode == 0:
-                try:
-                    sep_result = json.loads(result.stdout.strip())
-                    if sep_result["status"] == "success" and sep_result.get(
-                        "vocal_path"
-                    ):
-                        vocal_path = sep_result["vocal_path"]
-                        instrumental_path = sep_result.get("instrumental_path")
-                        audio_path = vocal_path
-                        print(f"[LRC] ボーカル抽出完了: {vocal_path}", file=sys.stderr)
-                    else:
-                        print(
-                            f"[LRC] ボーカル抽出失敗、元音源を使用: {sep_result.get('message', '')}",
-                            file=sys.stderr,
-                        )
-                except json.JSONDecodeError:
-                    print(
-                        "[LRC] ボーカル抽出の出力解析失敗、元音源を使用",
-                        file=sys.stderr,
+    def model(self):
+        """(processor, model, device) を返す (常駐ワーカーではロード済みのものを再利用)"""
+        if self._model is None:
+            tier = self.tier
+            with stage(self.metrics, "model_load", model=tier.aligner_model) as record:
+                if self.models is None:
+                    self._model = load_ctc_model(
+                        tier.aligner_model, tier.precision, self.backend, self.engine
                     )
-            else:
-                print("[LRC] ボーカル抽出プロセスエラー、元音源を使用", file=sys.stderr)
+                else:
+                    self._model = self.models.ctc(tier.aligner_model, tier.precision)
+                record["device"] = str(self._model[2])
+            self.job["device"] = str(self._model[2])
+            self._processor = self._model[0]
+        return self._model
 
-            # サブプロセス終了後にGCを実行
-            gc.collect()
+    def processor(self):
+        """トークナイザを含むプロセッサを返す (emission がキャッシュにある場合はモデルを読まない)"""
+        if self._processor is None:
+            tier = self.tier
+            with stage(
+                self.metrics, "model_load", model=tier.aligner_model, processor_only=True
+            ):
+                if self.models is None:
+                    self._processor = load_processor(tier.aligner_model)
+                else:
+                    self._processor = self.models.processor(tier.aligner_model)
+        return self._processor
 
-        # 1. 歌詞の前処理
-        clean_lines_data = clean_text(lyrics_text)
-        if not clean_lines_data:
-            return {"status": "error", "message": "歌詞が空または無効です"}
 
-        full_transcript = "|".join([cl for _, cl in clean_lines_data])
-        # 先頭と末尾にパディング
-        padded_transcript = f"|{full_transcript}|"
+def use_streaming_separation(audio_path, stream_separation=None):
+    """
+    ボーカル抽出をウィンドウごとに行うかどうか
+    stream_separation が None なら音声の長さ (STREAM_SEPARATION_SECONDS 以上) で決める
+    """
+    if stream_separation is not None:
+        return bool(stream_separation)
+    seconds = audio_duration(audio_path)
+    return seconds is not None and seconds >= STREAM_SEPARATION_SECONDS
 
-        # 2. モデルロード (精度向上のため Large モデルを使用)
-        model_id = "facebook/wav2vec2-large-960h-lv60-self"
-        processor = AutoProcessor.from_pretrained(model_id)
 
-        # DirectMLデバイスの設定
-        device = torch_directml.device()
-        print(f"[LRC] Using device: {device}", file=sys.stderr)
+def _track_emission(
+    audio_path,
+    separator_model,
+    tier,
+    loader,
+    batch_size,
+    emission_cache,
+    stem_cache,
+    backend,
+    skip_silence,
+    metrics,
+    job,
+    spans=None,
+    fallback_to_mix=True,
+    acquire=None,
+    stream_separation=None,
+    profile=None,
+):
+    """
+    音声 (separator_model が None なら元音源、それ以外は抽出したボーカル) の emission を求め、
+    (emission, 1 フレームあたりの秒数, ボーカル抽出できたか, VAD で推論を飛ばしたフレーム区間) を返す
+    (区間は VAD を実行しなかった場合は None。アライメントではこの区間だけを詰める)
 
-        model = AutoModelForCTC.from_pretrained(model_id).to(device)
+    spans (フレーム区間のリスト) を渡すと、その区間だけを推論して残りを blank の行で埋める
+    (区間だけの emission はキャッシュしない)
+    fallback_to_mix が False の場合、ボーカル抽出に失敗したら推論せずに (None, None, False, None) を返す
+    acquire (スケジューラ) を渡すと、キャッシュにない場合の抽出と推論を "device" の資源で行う
+    stream_separation は use_streaming_separation を参照 (区間だけの推論では使わない)
+    profile (resource_policy) はチャンクとバッチの大きさを決めるメモリの上限に使う
+    """
+    stream = (
+        separator_model is not None
+        and spans is None
+        and use_streaming_separation(audio_path, stream_separation)
+    )
+    # 2. emission キャッシュの参照 (音声の内容・モデル・ボーカル抽出の方法がキー)
+    digest = precision = None
 
-        # 3. 音声読み込み (16kHz)
-        audio, sr = librosa.load(audio_path, sr=16000)
-        duration = len(audio) / sr
+    def cache_key(model, streamed):
+        return EmissionCache.key(
+            digest,
+            tier.aligner_model,
+            model,
+            # ティアの精度ではなく実際に推論する精度 (CUDA 以外では fp16 のティアも fp32)
+            precision,
+            loader.engine,
+            vad=skip_silence and model is not None and not streamed,
+            stream=streamed,
+        )
 
-        # 4. チャンク分割推論（長い音声のGPUメモリ対策）
-        chunk_length_samples = 30 * sr  # 30秒
-        overlap_samples = 2 * sr  # 2秒オーバーラップ
+    if emission_cache is not None and spans is None:
+        with stage(metrics, "cache_lookup"):
+            precision = inference_precision(tier.precision, backend, loader.engine)
+            digest = file_digest(audio_path)
+            cached = emission_cache.get(cache_key(separator_model, stream))
+        job["emission_cache_hit"] = cached is not None
+        if cached is not None:
+            print("[LRC] emission キャッシュにヒットしました", file=sys.stderr)
+            emission, seconds_per_frame, skipped = cached
+            return emission, seconds_per_frame, separator_model is not None, skipped
 
-        all_emissions = []
-        pos = 0
+    with (acquire or _no_acquire)("device"):
+        emission, seconds_per_frame, separated, skipped = _infer_track_emission(
+            audio_path,
+            separator_model,
+            tier,
+            loader,
+            batch_size,
+            stem_cache,
+            backend,
+            skip_silence,
+            metrics,
+            job,
+            spans,
+            fallback_to_mix,
+            stream,
+            profile,
+        )
 
-        print(f"[LRC] 音声長: {duration:.1f}秒、チャンク処理開始...", file=sys.stderr)
+    if digest is not None and emission is not None:
+        # 実際に行った方法のキーで保存する (ストリーミング分離からファイル単位の分離に
+        # 切り替えた場合や、分離に失敗して元音源で推論した場合は、要求した方法と違う)
+        key = cache_key(
+            separator_model if separated else None,
+            stream and job.get("streamed_separation", False),
+        )
+        with stage(metrics, "cache_store"):
+            emission_cache.put(key, emission, seconds_per_frame, skipped)
+    return emission, seconds_per_frame, separated, skipped
 
-        while pos < len(audio):
-            end = min(pos + chunk_length_samples, len(audio))
-            chunk = audio[pos:end]
 
-            inputs = processor(
-                chunk, sampling_rate=16000, return_tensors="pt", padding=True
-            )
-            input_values = inputs.input_values.to(device)
+def _infer_track_emission(
+    audio_path,
+    separator_model,
+    tier,
+    loader,
+    batch_size,
+    stem_cache,
+    backend,
+    skip_silence,
+    metrics,
+    job,
+    spans,
+    fallback_to_mix,
+    stream=False,
+    profile=None,
+):
+    """_track_emission のうち、ボーカル抽出から推論まで (キャッシュにない場合)"""
+    models = loader.models
 
-            with torch.no_grad():
-                logits = model(input_values).logits
+    if separator_model and stream:
+        # 長い録音は、ウィンドウごとに分離したボーカルをそのままチャンク分割推論に流す
+        # (分離モデルを占有する前に CTC モデルを読み込んでおく)
+        loader.model()
+        with contextlib.ExitStack() as stack:
+            audio = _open_vocal_stream(
+                stack, audio_path, separator_model, models, backend, metrics
+            )
+            if audio is not None:
+                job["streamed_separation"] = True
+                return _infer_emission(
+                    audio_path,
+                    audio,
+                    True,
+                    tier,
+                    loader,
+                    batch_size,
+                    False,
+                    metrics,
+                    job,
+                    spans,
+                    profile,
+                )
+        # ファイル単位の分離に切り替える (キャッシュには切り替えた方法のキーで保存する)
+        job["streamed_separation"] = False
 
-            chunk_emission = torch.log_softmax(logits, dim=-1)[0].cpu().numpy()
+    # 3. ボーカル抽出（精度向上のため）
+    # 同じプロセス内で分離し、ボーカルを 16kHz モノラルの配列のまま受け取る
+    # (常駐ワーカーでは読み込み済みのモデルを使う)
+    audio = None
+    if separator_model:
+        print("[LRC] ボーカル抽出を開始...", file=sys.stderr)
 
-            # オーバーラップ部分を除去（最初のチャンク以外）
-            if pos > 0 and len(all_emissions) > 0:
-                overlap_frames = int(
-                    overlap_samples / sr * (chunk_emission.shape[0] / (len(chunk) / sr))
+        with stage(metrics, "separation", model=separator_model):
+            if models is None:
+                sep_result = separate_once(
+                    audio_path, stem_cache, separator_model, backend, metrics
+                )
+            else:
+                sep_result = models.separate(
+                    audio_path,
+                    separator_model,
+                    stem_cache=stem_cache,
+                    return_array=True,
+                    sr=SAMPLE_RATE,
+                    metrics=metrics,
                 )
-                chunk_emission = chunk_emission[overlap_frames:]
 
-            all_emissions.append(chunk_emission)
-            pos += chunk_length_samples - overlap_samples
+        if sep_result["status"] == "success":
+            audio = sep_result["vocals"]
+            hit = " (キャッシュ)" if sep_result.get("cache_hit") else ""
+            print(f"[LRC] ボーカル抽出完了{hit}", file=sys.stderr)
+        else:
+            print(
+                f"[LRC] ボーカル抽出失敗、元音源を使用: {sep_result.get('message', '')}",
+                file=sys.stderr,
+            )
+        sep_result = None
 
-            # メモリ解放
-            del input_values, logits
-            gc.collect()
+        # CTCモデルのロード前に、分離で使ったデバイスメモリを解放する
+        release_device_memory()
+        if audio is None and not fallback_to_mix:
+            return None, None, False, None
+    return _infer_emission(
+        audio_path,
+        audio,
+        audio is not None,
+        tier,
+        loader,
+        batch_size,
+        skip_silence,
+        metrics,
+        job,
+        spans,
+        profile,
+    )
 
-        # 結合
-        emission = np.concatenate(all_emissions, axis=0)
-        num_frames = emission.shape[0]
-        ratio = duration / num_frames
 
-        # 5. アライメント計算
-        vocab = processor.tokenizer.get_vocab()
-        token_to_id = {t: i for t, i in vocab.items()}
+def _open_vocal_stream(stack, audio_path, separator_model, models, backend, metrics):
+    """
+    ボーカルをウィンドウごとに分離する StreamingSeparation を開く
+    分離モデルの占有と一時ディレクトリの削除は stack に積む。開けない場合 (soundfile で
+    読めない形式、分離モデルの読み込みの失敗など) は None (ファイル単位で分離する)
+    """
+    from vocal_separator import load_separator, stream_vocals
 
-        tokens = []
-        for c in padded_transcript:
-            tid = token_to_id.get(c, token_to_id.get("<unk>", 0))
-            tokens.append(tid)
+    try:
+        if models is not None:
+            separator = stack.enter_context(models.separator(separator_model, metrics))
+        else:
+            output_dir = tempfile.mkdtemp(prefix="badwave_stems_")
+            stack.callback(shutil.rmtree, output_dir, ignore_errors=True)
+            with stage(metrics, "separator_load", model=separator_model):
+                separator = load_separator(output_dir, separator_model, backend)
+        audio = stream_vocals(audio_path, separator, sr=SAMPLE_RATE)
+    except Exception as e:
+        print(f"[LRC] ストリーミング分離を使えません: {e}", file=sys.stderr)
+        return None
+    print("[LRC] ボーカル抽出をウィンドウごとに行いながら推論します", file=sys.stderr)
+    return audio
 
-        trellis = get_trellis(emission, tokens)
-        path = backtrack(trellis, emission, tokens)
-        segments = merge_repeats(path, padded_transcript)
-        word_segments = merge_words(segments)
 
-        # 6. LRC構成
-        lrc_lines = ["[by:BadWave AI]"]
-        current_word_idx = 1  # パディングの|を飛ばす
-        global_offset = -0.3  # 300ms早める (同期感を向上)
+def _infer_emission(
+    audio_path,
+    audio,
+    separated,
+    tier,
+    loader,
+    batch_size,
+    skip_silence,
+    metrics,
+    job,
+    spans,
+    profile=None,
+):
+    """
+    音声 (audio が None なら audio_path を読み込む) の emission を推論し、
+    (emission, 1 フレームあたりの秒数, separated, VAD で推論を飛ばしたフレーム区間) を返す
+    """
+    # 4. モデルロード (常駐ワーカーではロード済みのものを再利用)
+    processor, model, device = loader.model()
 
-        for original_line, clean_line in clean_lines_data:
-            words_in_line = clean_line.count("|") + 1
-            if current_word_idx < len(word_segments):
-                start_frame = word_segments[current_word_idx]["start"]
-                start_time = max(0, start_frame * ratio + global_offset)
-                lrc_lines.append(f"{format_lrc_timestamp(start_time)}{original_line}")
-            current_word_idx += words_in_line
+    # 5. 音声読み込み (16kHz、ボーカル抽出済みなら不要)
+    # soundfile で読める形式は、推論のチャンクに合わせてブロックごとにデコードする
+    sr = SAMPLE_RATE
+    if audio is None:
+        with stage(metrics, "decode") as record:
+            audio = open_audio(audio_path, sr)
+            record["streaming"] = isinstance(audio, StreamingAudio)
+    duration = len(audio) / sr
+    job["audio_seconds"] = round(duration, 2)
 
-        return {"status": "success", "lrc": "\n".join(lrc_lines)}
+    # 5.5 無音区間の検出 (ボーカル抽出済みの配列のときだけ)
+    # 伴奏を含む元音源では RMS で歌の有無を判定できないので全体を推論する
+    regions = spans
+    skipped = None
+    if spans is None and skip_silence and separated and isinstance(audio, np.ndarray):
+        with stage(metrics, "vad") as record:
+            geometry = FrameGeometry.from_config(model.config)
+            num_frames = geometry.num_frames(len(audio))
+            regions = vocal_regions(audio, geometry.hop, num_frames, sr)
+            skipped = skipped_ranges(regions, num_frames)
+            active = (
+                num_frames
+                if regions is None
+                else sum(stop - start for start, stop in regions)
+            )
+            record["regions"] = 0 if regions is None else len(regions)
+            record["skipped_seconds"] = round(
+                (num_frames - active) * geometry.hop / sr, 2
+            )
+        job["skipped_seconds"] = record.get("skipped_seconds", 0.0)
+        if regions is not None:
+            print(
+                f"[LRC] 無音区間 {record.get('skipped_seconds', 0.0)}秒 を推論から除外します",
+                file=sys.stderr,
+            )
 
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+    # 6. チャンク分割推論（長い音声のGPUメモリ対策）
+    # プロファイルのメモリの割合 (と BADWAVE_MEMORY_LIMIT_MB) で頭打ちにする
+    profile = get_profile(profile)
+    limit = memory_limit()
+    chunk_seconds = choose_chunk_seconds(
+        device, tier.max_chunk_seconds, profile.memory_ratio, limit
+    )
+    if batch_size is None:
+        batch_size = choose_batch_size(
+            device, chunk_seconds, memory_ratio=profile.memory_ratio, memory_limit=limit
+        )
+    print(
+        f"[LRC] 音声長: {duration:.1f}秒、チャンク処理開始 (ティア: {tier.name}) "
+        f"(チャンク: {chunk_seconds}秒, バッチサイズ: {batch_size})...",
+        file=sys.stderr,
+    )
+    try:
+        with stage(
+            metrics, "inference", chunk_seconds=chunk_seconds, batch_size=batch_size
+        ):
+            emission = compute_emission(
+                audio,
+                processor,
+                model,
+                device,
+                batch_size,
+                chunk_seconds,
+                sr,
+                metrics=metrics,
+                regions=regions,
+            )
     finally:
-        # 生成したボーカル/インストゥルメンタルファイルをクリーンアップ
-        for path in [vocal_path, instrumental_path]:
-            if path and os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass  # クリーンアップ失敗は無視
+        if isinstance(audio, (StreamingAudio, StreamingSeparation)):
+            audio.close()
+            if metrics is not None:
+                # ストリーミングのデコード (と分離) は各 inference_batch の中で行われる
+                metrics.add(
+                    "stream_decode",
+                    parent="inference",
+                    wall_seconds=round(audio.decode_seconds, 4),
+                )
+                if isinstance(audio, StreamingSeparation):
+                    metrics.add(
+                        "stream_separation",
+                        parent="inference",
+                        wall_seconds=round(audio.separation_seconds, 4),
+                        windows=audio.windows,
+                    )
+    audio = None
+    return emission, frame_seconds(model, sr), separated, skipped
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print(json.dumps({"status": "error", "message": "引数が足りません"}))
-        sys.exit(1)
+def low_confidence_spans(lines, threshold, num_frames):
+    """
+    信頼度が threshold 未満の行を含む区間 [(start, stop), ...] (フレーム) を返す
+
+    信頼度の低い行は位置そのものが怪しいので、連続する低い行をまとめ、
+    前後の信頼できる行の終わりから始まりまでを区間にする
+    """
+    spans = []
+    start = 0
+    low = False
+    for line in lines:
+        if line["confidence"] < threshold:
+            low = True
+            continue
+        if line["start"] is None:
+            continue
+        if low:
+            spans.append((start, line["start"]))
+            low = False
+        start = line["end"]
+    if low:
+        spans.append((start, num_frames))
+    return [(s, e) for s, e in spans if e > s]
+
+
+def _generate_lrc(
+    audio_path,
+    lyrics_text,
+    use_vocal_separation,
+    models,
+    batch_size,
+    emission_cache,
+    stem_cache,
+    tier,
+    backend,
+    engine,
+    skip_silence,
+    adaptive_separation,
+    confidence_threshold,
+    open_session,
+    acquire,
+    stream_separation,
+    profile,
+    metrics,
+    job,
+):
+    """generate_lrc の本体 (各ステージを metrics に、ジョブの属性を job に記録する)"""
+
+    try:
+        tier = get_tier(tier)
+        profile = get_profile(profile)
+        if models is not None:
+            engine = models.engine
+        separator_model = tier.separator_model if use_vocal_separation else None
+        job.update(
+            tier=tier.name, engine=engine, separation=separator_model, profile=profile.name
+        )
+        workers = thread_budget(profile)
+
+        # 1. 歌詞の前処理
+        prepared = prepare_transcript(lyrics_text)
+        if prepared is None:
+            return {"status": "error", "message": "歌詞が空または無効です"}
+        clean_lines_data, padded_transcript = prepared
+
+        loader = _AlignerLoader(tier, models, backend, engine, metrics, job)
+        adaptive = adaptive_separation and separator_model is not None
+        first_separator = None if adaptive else separator_model
+
+        # 2-6. emission (キャッシュ、ボーカル抽出、音声読み込み、チャンク分割推論)
+        with stage(metrics if adaptive else None, "mix_pass"):
+            emission, seconds_per_frame, separated, skipped = _track_emission(
+                audio_path,
+                first_separator,
+                tier,
+                loader,
+                batch_size,
+                emission_cache,
+                stem_cache,
+                backend,
+                skip_silence,
+                metrics,
+                job,
+                acquire=acquire,
+                stream_separation=stream_separation,
+                profile=profile,
+            )
+
+        # 7. アライメント計算
+        with acquire("cpu"):
+            vocab = loader.processor().tokenizer.get_vocab()
+            tokens = tokenize(padded_transcript, vocab)
+            lines, align_info = align_lines(
+                emission,
+                clean_lines_data,
+                padded_transcript,
+                tokens,
+                workers=workers,
+                metrics=metrics,
+                skipped=skipped,
+            )
+        print(f"[LRC] アライメント: {align_info}", file=sys.stderr)
+
+        decision = {
+            "mode": "adaptive" if adaptive else "fixed",
+            "path": "separated" if separated else "mix",
+            "confidence": align_info.get("confidence"),
+        }
+        if adaptive:
+            # 8. 元音源での信頼度が低い行があれば、ボーカル抽出して推論し直す
+            low_lines = [line for line in lines if line["confidence"] < confidence_threshold]
+            decision.update(threshold=confidence_threshold, low_confidence_lines=len(low_lines))
+            if low_lines:
+                spans = low_confidence_spans(lines, confidence_threshold, len(emission))
+                span_ratio = sum(e - s for s, e in spans) / max(len(emission), 1)
+                # 区間が長い場合は全体を推論し直した方が速く、キャッシュにも残せる
+                if span_ratio > MAX_SPAN_RATIO:
+                    spans = None
+                print(
+                    f"[LRC] 信頼度の低い行が {len(low_lines)} 行あるため、ボーカル抽出して再計算します",
+                    file=sys.stderr,
+                )
+                with stage(metrics, "separated_pass", spans=len(spans or [])):
+                    vocal_emission, _, separated, vocal_skipped = _track_emission(
+                        audio_path,
+                        separator_model,
+                        tier,
+                        loader,
+                        batch_size,
+                        emission_cache,
+                        stem_cache,
+                        backend,
+                        skip_silence,
+                        metrics,
+                        job,
+                        spans=spans,
+                        fallback_to_mix=False,
+                        acquire=acquire,
+                        stream_separation=stream_separation,
+                        profile=profile,
+                    )
+                if separated:
+                    if spans is None:
+                        emission, skipped = vocal_emission, vocal_skipped
+                    else:
+                        # 区間のフレームだけをボーカルの emission で置き換える
+                        # (キャッシュから読んだ emission は読み取り専用のことがあるのでコピーする)
+                        emission = np.array(emission)
+                        for s, e in spans:
+                            e = min(e, len(vocal_emission))
+                            emission[s:e] = vocal_emission[s:e]
+                    vocal_emission = None
+                    with acquire("cpu"):
+                        lines, align_info = align_lines(
+                            emission,
+                            clean_lines_data,
+                            padded_transcript,
+                            tokens,
+                            workers=workers,
+                            metrics=metrics,
+                            skipped=skipped,
+                        )
+                    print(f"[LRC] 再アライメント: {align_info}", file=sys.stderr)
+                    decision.update(
+                        path="separated" if spans is None else "separated_spans",
+                        confidence_after=align_info.get("confidence"),
+                    )
+                    if spans is not None:
+                        decision["span_ratio"] = round(span_ratio, 3)
+                else:
+                    decision["separation_failed"] = True
+        job["separation_path"] = decision["path"]
+        job["confidence"] = decision["confidence"]
+
+        # 9. LRC構成
+        lrc = build_lrc(lines, seconds_per_frame)
+        result = {"status": "success", "lrc": lrc, "separation": decision}
+        if open_session:
+            # emission はキャッシュから読んだ場合もメモリ上の配列 (EmissionCache.get) なので、
+            # 複製せずにそのまま保持する
+            result["session"] = LyricSession(
+                emission, seconds_per_frame, vocab, clean_lines_data, lines, skipped
+            )
+        return result
 
-    audio_path = sys.argv[1]
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
 
+
+def normalize_audio_path(audio_path):
+    """file:// URL やURLエンコードされたパスを通常のパスに変換する"""
     # file:// プレフィックスの除去 (Windows/Electron対策)
     if audio_path.startswith("file://"):
         audio_path = audio_path.replace("file://", "")
@@ -305,12 +1125,499 @@ if __name__ == "__main__":
         if audio_path.startswith("/") and audio_path[2] == ":":
             audio_path = audio_path[1:]
         # URLエンコードのデコード (スペースが %20 になっている場合など)
-        import urllib.parse
-
         audio_path = urllib.parse.unquote(audio_path)
 
-    audio_path = os.path.abspath(audio_path)
-    lyrics_arg = sys.argv[2]
+    return os.path.abspath(audio_path)
+
+
+def caches(models):
+    """ModelCache が持つディスクキャッシュを名前つきで返す"""
+    return {"emission_cache": models.emission_cache, "stem_cache": models.stem_cache}
+
+
+def purge_caches(named_caches):
+    """キャッシュをすべて空にし、キャッシュごとの削除数を返す"""
+    return {
+        name: cache.purge() if cache else 0 for name, cache in named_caches.items()
+    }
+
+
+def scheduler_memory_budget(backend="auto"):
+    """
+    スケジューラの資源ごとのメモリの予算 {"device": バイト, "cpu": バイト}
+
+    device はバックエンドのデバイスの空きメモリ (CUDA なら VRAM、取得できなければ None)、
+    cpu はホストの空きメモリ。CPU で推論する場合は両方がホストのメモリを使うので半分ずつにする。
+    """
+    host = host_available_memory()
+    try:
+        _, device = select_torch_device(backend)
+    except (ImportError, RuntimeError):
+        device = None
+    if device is None or device.type == "cpu":
+        half = host // 2 if host is not None else None
+        return {"device": half, "cpu": half}
+    return {"device": available_memory(device), "cpu": host}
+
+
+def estimate_job_memory(
+    audio_path, lyrics_text="", tier=None, use_vocal_separation=True, stream_separation=None
+):
+    """
+    ジョブが資源ごとに使うメモリの概算 {"device": バイト, "cpu": バイト} を返す
+
+    device はモデルの重み・推論 1 チャンク分の作業領域・16kHz の音声・emission
+    (ボーカル抽出するならその分も。ウィンドウごとに分離する場合は数ウィンドウ分)、
+    cpu は emission とトレリス。
+    音声の長さが分からなければ {} (見積もりなしで実行を許可する)。
+    """
+    seconds = audio_duration(audio_path)
+    if seconds is None:
+        return {}
+    tier = get_tier(tier)
+    frames = WAV2VEC2_GEOMETRY.num_frames(int(seconds * SAMPLE_RATE))
+    prepared = prepare_transcript(lyrics_text)
+    num_tokens = len(prepared[1]) if prepared else 0
+    emission = frames * EMISSION_VOCAB_SIZE * 4
+
+    cpu = emission + min(trellis_nbytes(frames, num_tokens), TRELLIS_MEMORY_LIMIT)
+    weight_bytes = 2 if tier.precision == "fp16" else 4
+    device = (
+        ALIGNER_PARAMETERS.get(tier.aligner_model, max(ALIGNER_PARAMETERS.values()))
+        * weight_bytes
+        + BYTES_PER_AUDIO_SECOND * tier.max_chunk_seconds
+        + int(seconds * SAMPLE_RATE * 4)
+        + emission
+    )
+    if use_vocal_separation and tier.separator_model:
+        if stream_separation is None:
+            stream_separation = seconds >= STREAM_SEPARATION_SECONDS
+        if stream_separation:
+            # 分離中のウィンドウと、重なりを待つ前のウィンドウ
+            separation_seconds = min(seconds, 2 * WINDOW_SECONDS)
+        else:
+            separation_seconds = seconds
+        device += SEPARATOR_BYTES + int(separation_seconds * SEPARATION_BYTES_PER_SECOND)
+    return {"device": int(device), "cpu": int(cpu)}
+
+
+def request_key(request):
+    """
+    同じ結果になるリクエストをまとめるためのキー (まとめられないコマンドは None)
+
+    音声はパス・更新時刻・サイズで区別する。セッションを開く generate は、
+    リクエストごとに別のセッションが要るのでまとめない。
+    """
+    command = request.get("command", "generate")
+    if command not in ("generate", "separate") or request.get("session"):
+        return None
+    try:
+        stat = os.stat(normalize_audio_path(request.get("audio_path", "")))
+    except OSError:
+        return None
+    fields = {k: v for k, v in request.items() if k not in ("id", "priority", "profile")}
+    return json.dumps(
+        [command, stat.st_mtime_ns, stat.st_size, fields], sort_keys=True, default=str
+    )
+
+
+def request_profile(request):
+    """
+    リクエストの resource_policy のプロファイル名 (None ならワーカーの既定)
+    "profile" がなければ、"priority" が "background" のリクエストは background で実行する
+    """
+    if request.get("profile"):
+        return request["profile"]
+    return "background" if request.get("priority") == "background" else None
+
+
+def _governed(governor, request):
+    """リクエストのプロファイルでジョブを実行する with 用のコンテキスト (Profile を返す)"""
+    if governor is None:
+        return contextlib.nullcontext(get_profile(request_profile(request)))
+    return governor.job(request_profile(request))
+
+
+def update_lyrics_inline(request, models):
+    """
+    update_lyrics を差分の再アライメントだけで処理できれば、その結果を返す
+
+    全体をアライメントし直す必要がある場合 (とそのジョブが終わるまで) は None を返し、
+    呼び出し側 (run_server) はスケジューラのジョブとして handle_request に回す。
+    """
+    session = models.sessions.get(request.get("session_id"))
+    if session is None:
+        return {"status": "error", "message": "セッションが見つかりません"}
+    try:
+        update = session.update(request.get("lyrics", ""), full=False)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    if update is None:
+        return None
+    lrc, info = update
+    return {"status": "success", "lrc": lrc, "update": info}
+
+
+def handle_request(request, models, acquire=None, governor=None):
+    """
+    常駐ワーカーの 1 リクエストを処理して結果の dict を返す
+    acquire (スケジューラ) を渡すと、モデルを使う処理は "device"、アライメントは "cpu" の資源で行う
+    governor (ResourceGovernor) を渡すと、generate と separate はリクエストのプロファイル
+    (request_profile) の計算スレッド数で実行する
+    """
+    acquire = acquire or _no_acquire
+    command = request.get("command", "generate")
+    if command == "generate":
+        with _governed(governor, request) as profile:
+            result = generate_lrc(
+                normalize_audio_path(request.get("audio_path", "")),
+                request.get("lyrics", ""),
+                request.get("use_vocal_separation", True),
+                models=models,
+                batch_size=request.get("batch_size"),
+                emission_cache=models.emission_cache,
+                stem_cache=models.stem_cache,
+                tier=request.get("tier"),
+                skip_silence=request.get("skip_silence", True),
+                adaptive_separation=request.get("adaptive_separation", False),
+                confidence_threshold=request.get(
+                    "confidence_threshold", ADAPTIVE_CONFIDENCE_THRESHOLD
+                ),
+                open_session=request.get("session", False),
+                acquire=acquire,
+                stream_separation=request.get("stream_separation"),
+                profile=profile,
+            )
+        session = result.pop("session", None)
+        if session is not None:
+            result["session_id"] = models.open_session(session)
+        return result
+    if command == "update_lyrics":
+        # 歌詞編集セッションで、変わった行だけを再アライメントする
+        # (全体をアライメントし直す場合は "cpu" の資源とプロファイルのプロセス数で行う)
+        session = models.sessions.get(request.get("session_id"))
+        if session is None:
+            return {"status": "error", "message": "セッションが見つかりません"}
+        with _governed(governor, request) as profile, acquire("cpu"):
+            try:
+                lrc, info = session.update(
+                    request.get("lyrics", ""),
+                    workers=thread_budget(profile),
+                    queued=request.get("_queued", False),
+                )
+            except ValueError as e:
+                return {"status": "error", "message": str(e)}
+        return {"status": "success", "lrc": lrc, "update": info}
+    if command == "close_session":
+        models.sessions.pop(request.get("session_id"), None)
+        return {"status": "success"}
+    if command == "separate":
+        # カラオケ再生などでインストゥルメンタルを使う場合 (パスはステムのキャッシュ内)
+        with _governed(governor, request), acquire("device"):
+            return models.separate(
+                normalize_audio_path(request.get("audio_path", "")),
+                request.get("model_name", SEPARATOR_MODEL),
+                stem_cache=models.stem_cache,
+            )
+    if command == "cache_stats":
+        return {
+            "status": "success",
+            **{
+                name: cache.stats() if cache else None
+                for name, cache in caches(models).items()
+            },
+        }
+    if command == "prefetch":
+        # ティアで使うモデルをローカルのモデルストアに取得する (オフラインモードではエラー)
+        try:
+            paths = ModelStore().prefetch_tier(request.get("tier"), backend=models.backend)
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+        return {"status": "success", "models": paths}
+    # 以下は実行中のジョブが使っているキャッシュやモデルに触るので、"device" の資源を取ってから行う
+    if command == "purge_cache":
+        with acquire("device"):
+            return {"status": "success", "removed": purge_caches(caches(models))}
+    if command == "unload":
+        with acquire("device"):
+            models.unload()
+        return {"status": "success"}
+    if command == "release_memory":
+        with acquire("device"):
+            models.release_memory()
+        return {"status": "success"}
+    if command == "ping":
+        return {"status": "success", "loaded": models.loaded}
+    return {"status": "error", "message": f"不明なコマンドです: {command}"}
+
+
+def run_server(
+    idle_timeout=DEFAULT_IDLE_TIMEOUT,
+    use_cache=True,
+    backend="auto",
+    engine=DEFAULT_ENGINE,
+    limits=None,
+    profile=None,
+):
+    """
+    常駐ワーカーとして動作する
+
+    標準入力から JSON Lines でリクエスト ({"id", "command", ...}) を受け取り、
+    結果に同じ id を付けて標準出力に 1 行ずつ返す。標準入力が閉じられるか
+    shutdown コマンドで、受け付けたジョブが終わってから終了する。モデルをロードしたまま
+    idle_timeout 秒リクエストがなければ、モデルを解放してデバイスメモリを返す。
+    use_cache が True なら CTC の emission と分離済みステムをディスクにキャッシュする
+    (cache_stats / purge_cache コマンドで統計の取得と全削除ができる)。
+
+    generate などのジョブは JobScheduler で実行する。limits は資源 ("device" / "cpu") ごとの
+    同時実行数、"priority" ("interactive" / "normal" / "background") で待ち順が決まり、
+    同じ内容のリクエストは 1 回だけ実行して全員に同じ結果を返す。応答の順序は
+    リクエストの順序と一致しない (id で対応させる)。
+
+    profile (resource_policy) はワーカーの既定のプロファイルで、優先度 (nice・IO) は起動時に
+    プロセスに適用する。リクエストの "profile" で、そのジョブの計算スレッド数とメモリの上限を選べる。
+    """
+    out = sys.stdout
+    # ライブラリの print で応答行が壊れないよう、以降の標準出力は stderr に流す
+    sys.stdout = sys.stderr
+    out_lock = threading.Lock()
+
+    def respond(payload):
+        with out_lock:
+            out.write(json.dumps(payload) + "\n")
+            out.flush()
+
+    lines = queue.Queue()
+
+    def read_stdin():
+        for line in sys.stdin:
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read_stdin, daemon=True).start()
+
+    if use_cache:
+        models = ModelCache(EmissionCache(), StemCache(), backend, engine)
+    else:
+        models = ModelCache(backend=backend, engine=engine)
+    # デバイスの空きメモリは torch を読み込まないと分からないので、最初のジョブまで調べない
+    scheduler = JobScheduler(
+        limits, memory_budget=lambda: scheduler_memory_budget(backend)
+    )
+    governor = ResourceGovernor(apply_process_policy(profile))
+    try:
+        while True:
+            timeout = idle_timeout if models.loaded and idle_timeout > 0 else None
+            try:
+                line = lines.get(timeout=timeout)
+            except queue.Empty:
+                if scheduler.idle():
+                    print("[LRC] アイドル状態のためモデルを解放します", file=sys.stderr)
+                    models.unload()
+                continue
+
+            if line is None:
+                break
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                respond({"status": "error", "message": "リクエストの解析に失敗しました"})
+                continue
+
+            request_id = request.get("id")
+            command = request.get("command", "generate")
+            if command == "shutdown":
+                scheduler.wait()
+                respond({"id": request_id, "status": "success"})
+                break
+            if command in INLINE_COMMANDS:
+                result = handle_request(request, models)
+                if command == "ping":
+                    result["scheduler"] = scheduler.stats()
+                    result["resources"] = governor.stats()
+                respond({"id": request_id, **result})
+                continue
+
+            if command == "update_lyrics":
+                result = update_lyrics_inline(request, models)
+                if result is not None:
+                    respond({"id": request_id, **result})
+                    continue
+                # 全体のアライメントし直しはジョブにする (この更新が終わるまで後の更新もジョブにする)
+                session = models.sessions.get(request.get("session_id"))
+                if session is not None:
+                    session.enqueue()
+                    request = {**request, "_queued": True}
+
+            def callback(result, request_id=request_id):
+                respond({"id": request_id, **result})
+
+            memory = None
+            if command == "generate":
+                memory = estimate_job_memory(
+                    normalize_audio_path(request.get("audio_path", "")),
+                    request.get("lyrics", ""),
+                    request.get("tier"),
+                    request.get("use_vocal_separation", True),
+                    request.get("stream_separation"),
+                )
+            try:
+                get_profile(request_profile(request))
+                scheduler.submit(
+                    lambda acquire, request=request: handle_request(
+                        request, models, acquire, governor
+                    ),
+                    callback,
+                    key=request_key(request),
+                    priority=request.get("priority"),
+                    memory=memory,
+                )
+            except ValueError as e:
+                respond({"id": request_id, "status": "error", "message": str(e)})
+        scheduler.wait()
+    finally:
+        models.unload()
+
+
+if __name__ == "__main__":
+    # 配布版 (Windows) で子プロセスがこのスクリプトを起動し直した場合に備える
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="LRC generator (CTC forced alignment)")
+    parser.add_argument("audio", nargs="?", help="Path to input audio file")
+    parser.add_argument("lyrics", nargs="?", help="Lyrics text or path to a text file")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Chunks per forward pass (default: derived from free memory)",
+    )
+    parser.add_argument(
+        "--tier",
+        choices=list(TIERS),
+        default=DEFAULT_TIER,
+        help=f"Speed/quality tier (default: {DEFAULT_TIER})",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["auto", *BACKENDS],
+        default="auto",
+        help="Inference backend for separation and alignment (default: auto-detect)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=list(ENGINES),
+        default=DEFAULT_ENGINE,
+        help="CTC inference engine; non-torch engines run on CPU (default: torch)",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Run as a persistent worker reading JSON Lines requests from stdin",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help=f"Seconds of inactivity before the worker unloads models (default: {DEFAULT_IDLE_TIMEOUT}, 0=never)",
+    )
+    parser.add_argument(
+        "--device-jobs",
+        type=int,
+        default=DEFAULT_LIMITS["device"],
+        help=f"Worker jobs allowed to run separation/inference at once (default: {DEFAULT_LIMITS['device']})",
+    )
+    parser.add_argument(
+        "--cpu-jobs",
+        type=int,
+        default=DEFAULT_LIMITS["cpu"],
+        help=f"Worker jobs allowed to run alignment at once (default: {DEFAULT_LIMITS['cpu']})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not read or write the on-disk emission and stem caches",
+    )
+    parser.add_argument(
+        "--adaptive-separation",
+        action="store_true",
+        help="Align against the original mix first and separate vocals only for low-confidence lines",
+    )
+    parser.add_argument(
+        "--confidence-threshold",
+        type=float,
+        default=ADAPTIVE_CONFIDENCE_THRESHOLD,
+        help=f"Per-line confidence below which adaptive mode separates vocals (default: {ADAPTIVE_CONFIDENCE_THRESHOLD})",
+    )
+    parser.add_argument(
+        "--no-vad",
+        action="store_true",
+        help="Run CTC inference on the whole track instead of skipping silent vocal regions",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default=None,
+        help="Resource profile: thread cap, process priority and memory ceiling (default: foreground, or BADWAVE_PROFILE)",
+    )
+    parser.add_argument(
+        "--stream-separation",
+        action="store_true",
+        help=f"Separate vocals in overlapping windows while inference runs (default: only for tracks over {STREAM_SEPARATION_SECONDS // 60} min)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Append per-stage timing and memory of every job to this JSON Lines file",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never access the network; models must already be in the local model store",
+    )
+    parser.add_argument(
+        "--purge-cache",
+        action="store_true",
+        help="Delete all cached emissions and stems and exit",
+    )
+    args = parser.parse_args()
+
+    if args.offline:
+        set_offline()
+    if args.metrics_file:
+        # 常駐ワーカーとボーカル分離からも同じファイルに追記する
+        os.environ[METRICS_FILE_ENV] = os.path.abspath(args.metrics_file)
+
+    if args.purge_cache:
+        removed = purge_caches(
+            {"emission_cache": EmissionCache(), "stem_cache": StemCache()}
+        )
+        print(json.dumps({"status": "success", "removed": removed}))
+        sys.exit(0)
+
+    if args.server:
+        run_server(
+            args.idle_timeout,
+            use_cache=not args.no_cache,
+            backend=args.backend,
+            engine=args.engine,
+            limits={"device": args.device_jobs, "cpu": args.cpu_jobs},
+            profile=args.profile,
+        )
+        sys.exit(0)
+
+    if args.audio is None or args.lyrics is None:
+        print(json.dumps({"status": "error", "message": "引数が足りません"}))
+        sys.exit(1)
+
+    # スレッド数・優先度をモデルを読み込む前に決める
+    profile = apply_process_policy(args.profile)
+
+    audio_path = normalize_audio_path(args.audio)
+    lyrics_arg = args.lyrics
 
     # ファイルパスの場合は内容を読み込む
     if os.path.isfile(lyrics_arg):
@@ -319,5 +1626,19 @@ if __name__ == "__main__":
     else:
         lyrics_text = lyrics_arg
 
-    result = generate_lrc(audio_path, lyrics_text)
+    result = generate_lrc(
+        audio_path,
+        lyrics_text,
+        batch_size=args.batch_size,
+        emission_cache=None if args.no_cache else EmissionCache(),
+        stem_cache=None if args.no_cache else StemCache(),
+        tier=args.tier,
+        backend=args.backend,
+        engine=args.engine,
+        skip_silence=not args.no_vad,
+        adaptive_separation=args.adaptive_separation,
+        confidence_threshold=args.confidence_threshold,
+        stream_separation=True if args.stream_separation else None,
+        profile=profile,
+    )
     print(json.dumps(result))
@@ -0,0 +1,178 @@
+import difflib
+import threading
+import time
+
+from alignment import align
+from lrc_core import (
+    align_lines,
+    build_lrc,
+    lines_from_path,
+    prepare_transcript,
+    tokenize,
+)
+from vad import compress_skipped, expand_path
+
+
+# 歌詞の編集中の差分再アライメント (標準ライブラリと NumPy のみに依存)
+#
+# 歌詞を 1 行ずつ直す編集では emission (CTC の出力) は変わらない。LyricSession は emission と
+# 直前のアライメント結果 (各行のフレーム位置) を保持し、歌詞が変わったら clean_text の結果を
+# 行単位で比べて、変わった行だけを前後の変わっていない行の位置で挟んだ区間でアライメントし直す。
+# トレリスはその区間のフレーム数 × トークン数で済むので、曲全体を計算し直すより桁違いに速い。
+#
+# 区間に収まらず全体をアライメントし直す場合は重いので、常駐ワーカーは full=False で
+# 差分だけを試し、だめなら "cpu" 資源のジョブとしてスケジューラに回す (queued で数える)。
+
+
+class LyricSession:
+    """
+    1 曲分の emission と直前のアライメントを保持し、歌詞の変更を差分だけ再アライメントする
+
+    lines は lrc_core.lines_from_path の行 (clean_lines_data と同じ順序)。
+    vocab はトークナイザの語彙 (文字 → トークンID)。
+    skipped は VAD で推論を飛ばしたフレーム区間 (vad.skipped_ranges、VAD を実行していなければ None)。
+    """
+
+    def __init__(
+        self, emission, seconds_per_frame, vocab, clean_lines_data, lines, skipped=None
+    ):
+        self.emission = emission
+        self.skipped = skipped
+        self.seconds_per_frame = seconds_per_frame
+        self.vocab = vocab
+        self.clean_lines_data = clean_lines_data
+        self.lines = lines
+        # 更新はジョブのスレッドからも呼ばれるので 1 つずつ行う
+        self._lock = threading.Lock()
+        # スケジューラに回して、まだ終わっていない更新の数
+        self.queued = 0
+
+    @classmethod
+    def from_lyrics(
+        cls, emission, seconds_per_frame, vocab, lyrics_text, workers=None, skipped=None
+    ):
+        """歌詞全体をアライメントしてセッションを作る"""
+        clean_lines_data, padded_transcript = _prepare(lyrics_text)
+        lines, _ = align_lines(
+            emission,
+            clean_lines_data,
+            padded_transcript,
+            tokenize(padded_transcript, vocab),
+            workers=workers,
+            skipped=skipped,
+        )
+        return cls(emission, seconds_per_frame, vocab, clean_lines_data, lines, skipped)
+
+    def lrc(self):
+        return build_lrc(self.lines, self.seconds_per_frame)
+
+    def enqueue(self):
+        """スケジューラに更新を回したことを記録する (終わるまで full=False の更新は None を返す)"""
+        with self._lock:
+            self.queued += 1
+
+    def update(self, lyrics_text, workers=None, full=True, queued=False):
+        """
+        歌詞を lyrics_text に置き換えて再アライメントし、(LRC文字列, 更新の情報) を返す
+
+        変わった行の区間が前後の行の位置に収まらない場合 (行の位置が決まっていない、
+        区間のフレーム数がトークン数より少ないなど) は、全体をアライメントし直す
+        (workers はそのときのプロセス数)。full が False なら全体はアライメントし直さず、
+        何も変えずに None を返す。スケジューラに回した更新が残っている間も、順序を保つため
+        full=False では None を返す。queued は enqueue() した更新であることを表す。
+        """
+        with self._lock:
+            try:
+                if not full and self.queued:
+                    return None
+                return self._update(lyrics_text, workers, full)
+            finally:
+                if queued:
+                    self.queued -= 1
+
+    def _update(self, lyrics_text, workers, full):
+        started = time.perf_counter()
+        clean_lines_data, padded_transcript = _prepare(lyrics_text)
+        old = [cl for _, cl in self.clean_lines_data]
+        new = [cl for _, cl in clean_lines_data]
+        matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+
+        lines = []
+        info = {"mode": "incremental", "changed_lines": 0, "frames": 0}
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                # 記号などの clean_text で消える部分だけが変わった行は、表示の文字列だけ差し替える
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    lines.append({**self.lines[i], "text": clean_lines_data[j][0]})
+                continue
+            info["changed_lines"] += max(i2 - i1, j2 - j1)
+            if j1 == j2:
+                # 削除した行は取り除くだけ
+                continue
+            bounds = self._bounds(i1, i2)
+            realigned = None
+            if bounds is not None:
+                realigned = self._align_span(clean_lines_data[j1:j2], *bounds)
+            if realigned is None:
+                if not full:
+                    return None
+                info = self._realign_all(clean_lines_data, padded_transcript, workers)
+                break
+            lines.extend(realigned)
+            info["frames"] += bounds[1] - bounds[0]
+        else:
+            self.clean_lines_data = clean_lines_data
+            self.lines = lines
+
+        info["seconds"] = round(time.perf_counter() - started, 4)
+        return self.lrc(), info
+
+    def _bounds(self, i1, i2):
+        """旧い行 [i1, i2) を置き換える区間 (前の行の終わりから次の行の始まりまで)"""
+        start = 0 if i1 == 0 else self.lines[i1 - 1]["end"]
+        stop = len(self.emission) if i2 == len(self.lines) else self.lines[i2]["start"]
+        if start is None or stop is None or stop <= start:
+            return None
+        return start, stop
+
+    def _align_span(self, clean_lines_data, start, stop):
+        """emission の [start, stop) に clean_lines_data の行をアライメントする"""
+        transcript = "|" + "|".join(cl for _, cl in clean_lines_data) + "|"
+        tokens = tokenize(transcript, self.vocab)
+        emission = self.emission[start:stop]
+        # 飛ばした区間は区間の先頭からの位置に直して渡す (compress_skipped が区間内に切り詰める)
+        skipped = self.skipped and [(s - start, e - start) for s, e in self.skipped]
+        compressed, kept = compress_skipped(emission, skipped)
+        if len(compressed) < len(tokens):
+            return None
+        path = expand_path(align(compressed, tokens), kept)
+        lines = lines_from_path(emission, path, clean_lines_data, transcript, tokens)
+        for line in lines:
+            if line["start"] is not None:
+                line["start"] += start
+                line["end"] += start
+        return lines
+
+    def _realign_all(self, clean_lines_data, padded_transcript, workers=None):
+        self.lines, align_info = align_lines(
+            self.emission,
+            clean_lines_data,
+            padded_transcript,
+            tokenize(padded_transcript, self.vocab),
+            workers=workers,
+            skipped=self.skipped,
+        )
+        self.clean_lines_data = clean_lines_data
+        return {
+            "mode": "full",
+            "changed_lines": len(clean_lines_data),
+            "frames": len(self.emission),
+            "alignment": align_info,
+        }
+
+
+def _prepare(lyrics_text):
+    prepared = prepare_transcript(lyrics_text)
+    if prepared is None:
+        raise ValueError("歌詞が空または無効です")
+    return prepared
@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+
+# 処理の段階 (ステージ) ごとの計測
+#
+# 各ステージの実時間・CPU 時間・ピーク RSS・ピークのデバイスメモリ (CUDA) を記録し、
+# 結果の "metrics" として返す。環境変数 BADWAVE_METRICS_FILE (または --metrics-file) を
+# 指定すると、ジョブごとの記録を JSON Lines で追記する (多数のジョブの集計用)。
+#
+# ピーク RSS は、Linux ではステージの開始時に高水位をリセットしてステージごとの値を取る。
+# リセットできない環境ではプロセス開始からの最大値になる (as_dict の peak_rss_scope)。
+#
+# 高水位 (RSS と CUDA のピーク) はプロセスで 1 つなので、常駐ワーカーで複数のジョブが
+# 同時に計測していると、あるジョブのリセットが別のジョブのピークを消してしまう。
+# そのためリセットは計測中のジョブが 1 つだけのときに行い、ほかのジョブと重なったステージの
+# ピークはプロセス全体の値として記録する (各ステージの peak_scope が "process")。
+
+METRICS_FILE_ENV = "BADWAVE_METRICS_FILE"
+
+# ステージを計測中の Metrics (ジョブ) と、その出入りを守るロック
+_active_lock = threading.Lock()
+_active = set()
+
+
+def _windows_memory_counters():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(
+        process, ctypes.byref(counters), counters.cb
+    ):
+        return None
+    return counters
+
+
+def _proc_status(field):
+    """/proc/self/status の field (kB 単位) をバイトで返す"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """このプロセスの常駐メモリ (バイト)。取得できない場合は None"""
+    if sys.platform == "win32":
+        counters = _windows_memory_counters()
+        return counters.WorkingSetSize if counters else None
+    return _proc_status("VmRSS")
+
+
+def peak_rss():
+    """このプロセスの常駐メモリの最大値 (バイト)。取得できない場合は None"""
+    if sys.platform == "win32":
+        counters = _windows_memory_counters()
+        return counters.PeakWorkingSetSize if counters else None
+    peak = _proc_status("VmHWM")
+    if peak is not None:
+        return peak
+    try:
+        import resource
+    except ImportError:
+        return None
+    # macOS はバイト、それ以外は kB
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def reset_peak_rss():
+    """常駐メモリの高水位をリセットする (Linux のみ)。できたら True"""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _cuda():
+    """CUDA を使用中なら torch を返す (torch の読み込みや CUDA の初期化はしない)"""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch
+
+
+class Metrics:
+    """
+    ステージごとの計測値を集める
+
+    stage() は入れ子にでき、内側のステージには parent が付く。外側のステージの
+    ピーク値には内側のステージのピークも含める。各ステージの peak_scope は、ピークが
+    そのステージだけの値なら "stage"、リセットできないか他のジョブと重なったなら "process"。
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._stack = []
+        with _active_lock:
+            can_reset = reset_peak_rss() if not _active else sys.platform.startswith("linux")
+        self._peak_scope = "stage" if can_reset else "process"
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def _fold_peaks(self, frame):
+        """現在までのピークを frame に取り込む (リセットの前に呼ぶ)"""
+        frame["peak_rss"] = max(frame["peak_rss"], peak_rss() or 0)
+        torch = _cuda()
+        if torch is not None:
+            frame["peak_device"] = max(
+                frame["peak_device"], torch.cuda.max_memory_allocated()
+            )
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """with で囲んだ区間を name のステージとして計測する (info はそのまま記録する)"""
+        record = {"name": name, **info}
+        if self._stack:
+            record["parent"] = self._stack[-1]["record"]["name"]
+            self._fold_peaks(self._stack[-1])
+        self.stages.append(record)
+        frame = {"record": record, "peak_rss": 0, "peak_device": 0, "shared": False}
+        self._stack.append(frame)
+
+        with _active_lock:
+            others = _active - {self}
+            _active.add(self)
+            if others:
+                # 重なったステージの高水位には、互いのメモリが含まれる
+                frame["shared"] = True
+                for metrics in others:
+                    for other in metrics._stack:
+                        other["shared"] = True
+            else:
+                frame["shared"] = not reset_peak_rss()
+                torch = _cuda()
+                if torch is not None:
+                    torch.cuda.reset_peak_memory_stats()
+        record["rss_start"] = current_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        except BaseException:
+            record["status"] = "error"
+            raise
+        finally:
+            record["wall_seconds"] = round(time.perf_counter() - wall, 4)
+            record["cpu_seconds"] = round(time.process_time() - cpu, 4)
+            self._fold_peaks(frame)
+            record["peak_rss"] = frame["peak_rss"] or None
+            if frame["peak_device"]:
+                record["peak_device_memory"] = frame["peak_device"]
+            with _active_lock:
+                record["peak_scope"] = "process" if frame["shared"] else "stage"
+                self._stack.pop()
+                if not self._stack:
+                    _active.discard(self)
+            if self._stack:
+                parent = self._stack[-1]
+                parent["peak_rss"] = max(parent["peak_rss"], frame["peak_rss"])
+                parent["peak_device"] = max(parent["peak_device"], frame["peak_device"])
+                # 内側のステージのピークを含むので、内側が重なっていれば外側も同じ
+                parent["shared"] = parent["shared"] or frame["shared"]
+
+    def add(self, name, parent=None, **values):
+        """別の場所 (ワーカープロセスなど) で計測した値をステージとして記録する"""
+        record = {"name": name, **values}
+        if parent is not None:
+            record["parent"] = parent
+        self.stages.append(record)
+        return record
+
+    def as_dict(self):
+        return {
+            "wall_seconds": round(time.perf_counter() - self._wall, 4),
+            "cpu_seconds": round(time.process_time() - self._cpu, 4),
+            "peak_rss_scope": self._peak_scope,
+            "stages": self.stages,
+        }
+
+
+def stage(metrics, name, **info):
+    """metrics が None なら何もしない Metrics.stage"""
+    if metrics is None:
+        return contextlib.nullcontext({})
+    return metrics.stage(name, **info)
+
+
+def append_metrics(record, path=None):
+    """
+    record に時刻を付けて JSON Lines のファイルに 1 行追記する
+    path を省略すると環境変数 BADWAVE_METRICS_FILE のパスを使い、どちらもなければ何もしない
+    """
+    path = path or os.environ.get(METRICS_FILE_ENV)
+    if not path:
+        return False
+    line = json.dumps(
+        {"time": datetime.datetime.now(datetime.timezone.utc).isoformat(), **record}
+    )
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"[Metrics] 記録の追記に失敗しました: {e}", file=sys.stderr)
+        return False
+    return True
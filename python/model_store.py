@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+
+from disk_cache import DiskCache, default_cache_dir, file_digest
+from hardware import inference_precision
+from tiers import TIERS, get_tier
+
+
+# ローカルのモデルストア
+#
+# CTC モデルは safetensors (fp32 または fp16) とプロセッサの設定を、ボーカル分離モデルは
+# audio-separator がダウンロードするファイル一式を、モデルごとに 1 ディレクトリで保存する。
+# 各エントリには全ファイルのサイズと SHA-256 を書いた manifest.json を置き、
+# 書き終えてから rename で公開するので、ダウンロード途中のモデルが使われることはない。
+# 読み込み時はサイズだけを照合し (数 GB のハッシュ計算は起動を遅くするため)、
+# SHA-256 の照合は verify で行う。壊れたエントリは削除して取り直す。
+#
+# オフラインモード (環境変数 BADWAVE_OFFLINE=1 または --offline) ではネットワークに
+# 一切アクセスせず、ストアにないモデルは ModelStoreError にする。
+
+OFFLINE_ENV = "BADWAVE_OFFLINE"
+MANIFEST_FILE = "manifest.json"
+# CTC モデルを保存する精度 ("fp16" は CUDA で半精度推論する場合に使う)
+PRECISIONS = ("fp32", "fp16")
+
+
+class ModelStoreError(RuntimeError):
+    """モデルがストアになく、取得もできない場合のエラー"""
+
+
+def is_offline():
+    return os.environ.get(OFFLINE_ENV, "").lower() in ("1", "true", "yes")
+
+
+def set_offline():
+    """このプロセス (と子プロセス) をオフラインモードにする"""
+    os.environ[OFFLINE_ENV] = "1"
+    # transformers / huggingface_hub のメタデータ問い合わせも止める
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+
+def write_manifest(path, info):
+    """path 以下の全ファイルのサイズと SHA-256 を info と一緒に manifest.json に書く"""
+    files = {}
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, path).replace(os.sep, "/")
+            if rel == MANIFEST_FILE:
+                continue
+            files[rel] = {"size": os.path.getsize(full), "sha256": file_digest(full)}
+    with open(os.path.join(path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({**info, "files": files}, f, indent=2)
+
+
+def verify_manifest(path, full=False):
+    """
+    manifest.json とファイルを照合し、問題の説明のリストを返す (空なら正常)
+    full が False ならサイズだけ、True なら SHA-256 も照合する
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return ["manifest.json がないか壊れています"]
+    problems = []
+    for rel, expected in files.items():
+        full_path = os.path.join(path, *rel.split("/"))
+        try:
+            size = os.path.getsize(full_path)
+        except OSError:
+            problems.append(f"{rel}: ファイルがありません")
+            continue
+        if size != expected["size"]:
+            problems.append(f"{rel}: サイズが違います ({size} != {expected['size']})")
+        elif full and file_digest(full_path) != expected["sha256"]:
+            problems.append(f"{rel}: SHA-256 が違います")
+    return problems
+
+
+class ModelStore(DiskCache):
+    """
+    モデルのローカルストア (容量上限による削除は行わず、purge するまで残す)
+
+    エントリ名は人が見て分かるよう、種類・モデル名・精度から作る。
+    """
+
+    def __init__(self, root=None):
+        super().__init__(root or default_cache_dir("models"), max_bytes=None)
+
+    @staticmethod
+    def key(kind, name, precision=None):
+        parts = [kind, *name.replace("\\", "/").split("/")]
+        if precision:
+            parts.append(precision)
+        return "--".join(parts)
+
+    def evict(self, keep=None):
+        return 0
+
+    def get(self, key):
+        """
+        正常なエントリのディレクトリを返す (サイズを照合する)。なければ None
+        壊れていたエントリは削除する
+        """
+        path = self.lookup(key)
+        if path is None:
+            return None
+        problems = verify_manifest(path)
+        if problems:
+            print(
+                f"[Models] 壊れたエントリを削除します: {key} ({problems[0]})",
+                file=sys.stderr,
+            )
+            shutil.rmtree(path, ignore_errors=True)
+            self.hits -= 1
+            self.misses += 1
+            return None
+        return path
+
+    def publish(self, key, write, info):
+        """write(ディレクトリ) でモデルを書き込み、manifest.json を付けて公開する"""
+
+        def write_with_manifest(path):
+            write(path)
+            write_manifest(path, info)
+
+        return self.store(key, write_with_manifest)
+
+    def verify(self, full=True):
+        """全エントリを照合し、{キー: 問題のリスト} を返す"""
+        return {
+            key: verify_manifest(self._path(key), full) for _, _, key in self.entries()
+        }
+
+    # CTC モデル (transformers)
+
+    def ctc_path(self, model_id, precision="fp32"):
+        return self.get(self.key("ctc", model_id, precision))
+
+    def prefetch_ctc(self, model_id, precision="fp32"):
+        """CTC モデルを safetensors で保存し (済みならそのまま)、ディレクトリを返す"""
+        if precision not in PRECISIONS:
+            raise ValueError(f"不明な精度です: {precision} (選択肢: {', '.join(PRECISIONS)})")
+        path = self.ctc_path(model_id, precision)
+        if path is not None:
+            return path
+        if is_offline():
+            raise ModelStoreError(
+                f"オフラインモードですが {model_id} ({precision}) がストアにありません "
+                f"(先に prefetch してください)"
+            )
+        print(f"[Models] {model_id} ({precision}) を取得します...", file=sys.stderr)
+
+        def write(path):
+            import torch
+            from transformers import AutoModelForCTC, AutoProcessor
+
+            AutoProcessor.from_pretrained(model_id).save_pretrained(path)
+            dtype = torch.float16 if precision == "fp16" else torch.float32
+            model = AutoModelForCTC.from_pretrained(model_id, torch_dtype=dtype)
+            model.save_pretrained(path, safe_serialization=True)
+
+        info = {"kind": "ctc", "name": model_id, "precision": precision}
+        return self.publish(self.key("ctc", model_id, precision), write, info)
+
+    def processor_path(self, model_id):
+        """プロセッサだけを使う場合に、保存済みのどちらかの精度のエントリを返す"""
+        for precision in PRECISIONS:
+            path = self.ctc_path(model_id, precision)
+            if path is not None:
+                return path
+        return None
+
+    # ボーカル分離モデル (audio-separator)
+
+    def separator_path(self, model_name):
+        return self.get(self.key("separator", model_name))
+
+    def prefetch_separator(self, model_name):
+        """分離モデルのファイル一式を保存し (済みならそのまま)、ディレクトリを返す"""
+        path = self.separator_path(model_name)
+        if path is not None:
+            return path
+        if is_offline():
+            raise ModelStoreError(
+                f"オフラインモードですが {model_name} がストアにありません "
+                f"(先に prefetch してください)"
+            )
+        print(f"[Models] {model_name} を取得します...", file=sys.stderr)
+
+        def write(path):
+            from audio_separator.separator import Separator
+
+            # info_only ではデバイスの初期化を省略し、ダウンロードだけを行う
+            separator = Separator(output_dir=path, model_file_dir=path, info_only=True)
+            separator.download_model_files(model_name)
+
+        info = {"kind": "separator", "name": model_name}
+        return self.publish(self.key("separator", model_name), write, info)
+
+    def prefetch_tier(self, tier, precision=None, backend="auto"):
+        """
+        ティアで使うモデルをすべて取得し、{モデル名: ディレクトリ} を返す
+        precision を省略すると、このマシン (backend) で実際に推論する精度で CTC モデルを保存する
+        (fp16 のティアでも CUDA を使わなければ fp32。hardware.inference_precision を参照)
+        """
+        tier = get_tier(tier)
+        paths = {}
+        if tier.separator_model:
+            paths[tier.separator_model] = self.prefetch_separator(tier.separator_model)
+        paths[tier.aligner_model] = self.prefetch_ctc(
+            tier.aligner_model, precision or inference_precision(tier.precision, backend)
+        )
+        return paths
+
+
+def resolve_ctc(model_id, precision="fp32", store=None):
+    """
+    CTC モデルを読み込むローカルのディレクトリを返す
+    precision の重みがなければ、fp16 なら保存済みの fp32 の重みを使い (読み込み時に変換する)、
+    それもなければ取得して保存する (オフラインモードでは ModelStoreError)。
+    fp32 の代わりに fp16 に丸めた重みを使うのは、取得できないオフラインモードの場合だけ
+    """
+    store = store or ModelStore()
+    candidates = [precision]
+    if precision == "fp16" or is_offline():
+        candidates += [p for p in PRECISIONS if p != precision]
+    for candidate in candidates:
+        path = store.ctc_path(model_id, candidate)
+        if path is not None:
+            if candidate != precision:
+                print(
+                    f"[Models] {model_id} の {precision} の重みがないため {candidate} を使います",
+                    file=sys.stderr,
+                )
+            return path
+    return store.prefetch_ctc(model_id, precision)
+
+
+def resolve_processor(model_id, store=None):
+    """
+    プロセッサを読み込むローカルのディレクトリを返す
+    ストアになければ、オフラインモードでは ModelStoreError、そうでなければ model_id をそのまま返す
+    (プロセッサのためだけにモデル全体を取得しない)
+    """
+    path = (store or ModelStore()).processor_path(model_id)
+    if path is not None:
+        return path
+    if is_offline():
+        raise ModelStoreError(
+            f"オフラインモードですが {model_id} がストアにありません (先に prefetch してください)"
+        )
+    return model_id
+
+
+def resolve_separator(model_name, store=None):
+    """分離モデルのファイルがあるディレクトリ (Separator の model_file_dir) を返す"""
+    return (store or ModelStore()).prefetch_separator(model_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local model store")
+    sub = parser.add_subparsers(dest="command", required=True)
+    prefetch = sub.add_parser("prefetch", help="Download models into the store")
+    prefetch.add_argument(
+        "--tier",
+        nargs="+",
+        choices=["all", *TIERS],
+        default=["all"],
+        help="Tiers whose models are fetched (default: all)",
+    )
+    prefetch.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default=None,
+        help="Store CTC weights in this precision "
+        "(default: the precision inference uses on this machine)",
+    )
+    sub.add_parser("verify", help="Check SHA-256 checksums of every stored model")
+    sub.add_parser("list", help="List stored models and their sizes")
+    args = parser.parse_args()
+
+    store = ModelStore()
+    if args.command == "prefetch":
+        tiers = list(TIERS) if "all" in args.tier else args.tier
+        result = {}
+        try:
+            for name in tiers:
+                result.update(store.prefetch_tier(name, args.precision))
+        except Exception as e:
+            print(json.dumps({"status": "error", "message": str(e)}))
+            sys.exit(1)
+        print(json.dumps({"status": "success", "models": result}, indent=2))
+    elif args.command == "verify":
+        problems = {key: p for key, p in store.verify().items() if p}
+        print(json.dumps({"status": "error" if problems else "success", "problems": problems}))
+        sys.exit(1 if problems else 0)
+    else:
+        entries = {key: size for _, size, key in store.entries()}
+        print(json.dumps({"path": store.root, "models": entries}, indent=2))
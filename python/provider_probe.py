@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import hashlib
+import platform
+import tempfile
+
+import numpy as np
+
+from disk_cache import TMP_PREFIX, default_cache_dir
+from hardware import BACKENDS
+
+
+# onnxruntime の実行プロバイダの動作確認 (onnxruntime と onnx は必要になってから import)
+#
+# Separator を use_cuda=True などで作って失敗したら次を試す方法では、使えないバックエンドの
+# セッション構築に毎回時間がかかる。一度だけ小さな Identity モデルで各プロバイダを試し、
+# 実際に動いたバックエンドをファイルに保存しておく。onnxruntime のバージョンや
+# ハードウェアの指紋 (fingerprint) が変わったら保存した結果は使わずに試し直す。
+
+# バックエンド名 (hardware.BACKENDS) と onnxruntime の実行プロバイダ名
+ORT_PROVIDERS = {
+    "cuda": "CUDAExecutionProvider",
+    "directml": "DmlExecutionProvider",
+    "coreml": "CoreMLExecutionProvider",
+    "cpu": "CPUExecutionProvider",
+}
+# 動作確認の結果を保存するファイル (キャッシュディレクトリの下)
+PROBE_FILE = "onnxruntime_providers.json"
+# 保存形式が変わったら上げる (古い形式の結果は使わない)
+PROBE_FORMAT = 1
+# Linux の NVIDIA ドライバのバージョン (ドライバを更新したら試し直す)
+NVIDIA_DRIVER_VERSION = "/proc/driver/nvidia/version"
+
+
+def probe_path():
+    return os.path.join(default_cache_dir("probe"), PROBE_FILE)
+
+
+def hardware_fingerprint():
+    """OS・CPU・GPU ドライバを表す文字列 (安く取れる情報だけを使う)"""
+    parts = [sys.platform, platform.platform(), platform.machine(), platform.processor()]
+    parts.append(os.environ.get("CUDA_VISIBLE_DEVICES", ""))
+    try:
+        with open(NVIDIA_DRIVER_VERSION, "r") as f:
+            parts.append(f.readline().strip())
+    except OSError:
+        parts.append("")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def probe_key(ort):
+    """保存した結果が使えるかどうかを決める値 (どれかが変わったら試し直す)"""
+    return {
+        "format": PROBE_FORMAT,
+        "onnxruntime": ort.__version__,
+        "available": sorted(ort.get_available_providers()),
+        "hardware": hardware_fingerprint(),
+    }
+
+
+def _identity_model():
+    """入力をそのまま返す最小の ONNX モデル (シリアライズしたバイト列)"""
+    from onnx import TensorProto, helper
+
+    tensor = [1, 4]
+    graph = helper.make_graph(
+        [helper.make_node("Identity", ["x"], ["y"])],
+        "probe",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, tensor)],
+        [helper.make_tensor_value_info("y", TensorProto.FLOAT, tensor)],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # 古い onnxruntime でも読めるように IR バージョンを抑える
+    model.ir_version = 7
+    return model.SerializeToString()
+
+
+def provider_works(ort, provider, model=None):
+    """
+    provider だけを指定したセッションで Identity モデルを実行できるか
+
+    onnxruntime はプロバイダを読み込めないと (CUDA の DLL がないなど) 黙って CPU で
+    セッションを作るので、実際に使われているプロバイダも確かめる。
+    """
+    try:
+        session = ort.InferenceSession(
+            model or _identity_model(), providers=[provider]
+        )
+        if provider not in session.get_providers():
+            return False
+        x = np.arange(4, dtype=np.float32).reshape(1, 4)
+        (y,) = session.run(None, {"x": x})
+        return bool(np.array_equal(y, x))
+    except Exception:
+        return False
+
+
+def probe_backends(ort):
+    """各バックエンドを試し、動いたものを hardware.BACKENDS の順で返す"""
+    available = set(ort.get_available_providers())
+    model = _identity_model()
+    return [
+        name
+        for name in BACKENDS
+        if ORT_PROVIDERS[name] in available and provider_works(ort, ORT_PROVIDERS[name], model)
+    ]
+
+
+def load_probe(path, key):
+    """保存した結果を読む。ないか key が違えば None"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("key") != key:
+        return None
+    backends = data.get("backends")
+    if not isinstance(backends, list):
+        return None
+    return [name for name in backends if name in BACKENDS]
+
+
+def save_probe(path, key, backends):
+    """結果を保存する (一時ファイルに書いてから置き換えるので、読み手が壊れた内容を見ない)"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=TMP_PREFIX, suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "backends": backends}, f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def forget_probe(path=None):
+    """保存した結果を消す (次の working_backends で試し直す)"""
+    try:
+        os.remove(path or probe_path())
+    except OSError:
+        pass
+
+
+def working_backends(refresh=False, path=None):
+    """
+    このマシンの onnxruntime で動くバックエンドを返す
+
+    保存した結果が今の onnxruntime とハードウェアのものならそれを使い、なければ試して保存する。
+    refresh なら保存した結果を使わずに試し直す。onnxruntime (または onnx) が
+    入っていなければ None (呼び出し側は従来どおり順に試す)。
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return None
+    path = path or probe_path()
+    key = probe_key(ort)
+    if not refresh:
+        backends = load_probe(path, key)
+        if backends is not None:
+            return backends
+    try:
+        backends = probe_backends(ort)
+    except ImportError:
+        return None
+    try:
+        save_probe(path, key, backends)
+    except OSError as e:
+        print(f"[INFO] プロバイダの確認結果を保存できません: {e}", file=sys.stderr)
+    return backends
@@ -0,0 +1,275 @@
+import os
+import sys
+import math
+import threading
+import contextlib
+from dataclasses import dataclass
+
+from hardware import (
+    CPU_THREADS_ENV,
+    MEMORY_BUDGET_RATIO,
+    set_thread_limit,
+    thread_limit,
+    usable_cpu_count,
+)
+
+
+# LRC 生成が音楽の再生を邪魔しないための資源の使い方 (プロファイル)
+#
+# torch・onnxruntime・BLAS (NumPy/SciPy)・numba はそれぞれ既定で全コア分のスレッドを作るので、
+# 同じデスクトップで再生している音声が途切れる。プロファイルは計算スレッド数の上限、
+# プロセスの優先度 (nice・IO 優先度)、チャンクとバッチの大きさを決めるメモリの上限を決める。
+#
+# スレッド数の上限はプロセス全体の合計ではなく、スレッドプールごと (torch の intra-op と
+# inter-op・BLAS・numba・onnxruntime のセッション・アライメントのワーカー数) の上限。
+# 1 つのジョブの中では分離・推論・アライメントを順に行うので、同時に忙しいプールは 1 つだが、
+# 常駐ワーカーで "device" と "cpu" のジョブが並んで動くと、最大で上限の 2 倍になる。
+#
+# スレッド数とメモリはリクエストごとに選べる。優先度はプロセス全体にかかり、特権なしでは
+# 元に戻せないので、プロセスの起動時 (--profile) にだけ適用する。
+
+# BLAS・OpenMP・numba のスレッド数を決める環境変数 (読み込む前のライブラリと子プロセスに効く)
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+)
+# 既定のプロファイルを決める環境変数
+PROFILE_ENV = "BADWAVE_PROFILE"
+# メモリの上限 (MB) を固定する環境変数 (プロファイルの割合より小さければこちらを使う)
+MEMORY_LIMIT_ENV = "BADWAVE_MEMORY_LIMIT_MB"
+
+# Windows の優先度クラスとバックグラウンド処理モード (SetPriorityClass)
+BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
+PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000
+# Linux の ioprio_set (IO 優先度を idle クラスにする) のシステムコール番号
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+@dataclass(frozen=True)
+class Profile:
+    """LRC 生成が使う CPU・メモリ・優先度の方針"""
+
+    name: str
+    # 計算スレッドに使う CPU の割合 (使える CPU 数に対して)
+    cpu_share: float
+    # 再生などのために空けておく CPU 数
+    reserved_cpus: int
+    # プロセスの nice 値 (0 なら変えない。Windows では正なら優先度を「通常以下」にする)
+    nice: int
+    # IO 優先度を idle にする (Windows ではバックグラウンド処理モード)
+    idle_io: bool
+    # 推論のチャンクとバッチに使う空きメモリの割合
+    memory_ratio: float
+
+
+PROFILES = {
+    # ユーザーの操作で生成する場合。1 コアを再生用に空け、メモリは従来どおり
+    "foreground": Profile(
+        "foreground",
+        cpu_share=1.0,
+        reserved_cpus=1,
+        nice=0,
+        idle_io=False,
+        memory_ratio=MEMORY_BUDGET_RATIO,
+    ),
+    # 一括生成など。CPU の 1/4 だけを使い、優先度を下げ、メモリも控えめにする
+    "background": Profile(
+        "background",
+        cpu_share=0.25,
+        reserved_cpus=1,
+        nice=10,
+        idle_io=True,
+        memory_ratio=MEMORY_BUDGET_RATIO / 2,
+    ),
+}
+
+DEFAULT_PROFILE = "foreground"
+
+
+def get_profile(name=None):
+    """名前から Profile を返す (None なら BADWAVE_PROFILE か既定)。不明な名前は ValueError"""
+    if isinstance(name, Profile):
+        return name
+    name = name or os.environ.get(PROFILE_ENV) or DEFAULT_PROFILE
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"不明なプロファイルです: {name} (選択肢: {', '.join(PROFILES)})"
+        ) from None
+
+
+def thread_budget(profile, cpus=None):
+    """プロファイルで使う計算スレッド数 (BADWAVE_CPU_THREADS があればそれを使う)"""
+    threads = os.environ.get(CPU_THREADS_ENV)
+    if threads:
+        return max(1, int(threads))
+    cpus = cpus or usable_cpu_count()
+    share = math.ceil(cpus * profile.cpu_share)
+    return max(1, min(share, cpus - profile.reserved_cpus))
+
+
+def memory_limit():
+    """BADWAVE_MEMORY_LIMIT_MB によるメモリの上限 (バイト)。なければ None"""
+    mb = os.environ.get(MEMORY_LIMIT_ENV)
+    return int(float(mb) * 1024 * 1024) if mb else None
+
+
+def apply_threads(threads):
+    """
+    読み込み済みのスレッドプール (torch・BLAS・numba) の計算スレッド数を、それぞれ threads にする
+    onnxruntime のセッションは作るときに決まるので、これ以降に作るセッションから効く
+    (limit_ort_threads を参照)
+    """
+    set_thread_limit(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+
+        # 呼び出すとそのまま制限がかかる (with で使わなければ元に戻さない)
+        threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+    numba = sys.modules.get("numba")
+    if numba is not None:
+        try:
+            numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+        except Exception:
+            pass
+
+
+def lower_priority(profile):
+    """プロファイルに従ってプロセスの CPU と IO の優先度を下げる (失敗しても続ける)"""
+    if sys.platform == "win32":
+        import ctypes
+
+        kernel32 = ctypes.windll.kernel32
+        process = kernel32.GetCurrentProcess()
+        if profile.nice > 0:
+            kernel32.SetPriorityClass(process, BELOW_NORMAL_PRIORITY_CLASS)
+        if profile.idle_io:
+            kernel32.SetPriorityClass(process, PROCESS_MODE_BACKGROUND_BEGIN)
+        return
+    if profile.nice > 0:
+        try:
+            # 特権なしでは nice 値を下げられないので、今より大きい場合だけ変える
+            current = os.nice(0)
+            if current < profile.nice:
+                os.nice(profile.nice - current)
+        except OSError:
+            pass
+    if profile.idle_io and sys.platform.startswith("linux"):
+        import ctypes
+        import platform
+
+        syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if syscall is not None:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.syscall(
+                syscall, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+            )
+
+
+def apply_process_policy(profile=None):
+    """
+    プロセス全体にプロファイルを適用し、その Profile を返す (CLI と常駐ワーカーの起動時)
+
+    子プロセス (アライメントのワーカー) とまだ読み込んでいないライブラリ用に環境変数も設定する。
+    """
+    profile = get_profile(profile)
+    threads = thread_budget(profile)
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    apply_threads(threads)
+    lower_priority(profile)
+    return profile
+
+
+# limit_ort_threads で InferenceSession を差し替えたか (プロセスで 1 回だけ差し替える)
+_ort_patch_lock = threading.Lock()
+_ort_patched = False
+
+
+def limit_ort_threads():
+    """
+    これ以降に作られる onnxruntime のセッションの intra-op スレッド数を thread_limit に合わせる
+
+    audio-separator は SessionOptions を外から渡せないので、InferenceSession の初期化を
+    プロセスで 1 回だけ差し替える (元に戻さないので、並行するジョブが差し替えを取り合わない)。
+    スレッド数はセッションを作る時点の hardware.thread_limit を使い、上限がないか、
+    呼び出し側が SessionOptions でスレッド数を指定していれば何もしない。
+    onnxruntime が入っていなければ何もしない。
+    """
+    global _ort_patched
+    with _ort_patch_lock:
+        if _ort_patched:
+            return
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            return
+        original = ort.InferenceSession.__init__
+
+        def __init__(self, path_or_bytes, sess_options=None, *args, **kwargs):
+            threads = thread_limit()
+            if threads is not None and (
+                sess_options is None or sess_options.intra_op_num_threads == 0
+            ):
+                sess_options = sess_options or ort.SessionOptions()
+                sess_options.intra_op_num_threads = threads
+                sess_options.inter_op_num_threads = 1
+            original(self, path_or_bytes, sess_options, *args, **kwargs)
+
+        ort.InferenceSession.__init__ = __init__
+        _ort_patched = True
+
+
+class ResourceGovernor:
+    """
+    常駐ワーカーで実行中のジョブのプロファイルから、プロセス全体の計算スレッド数を決める
+
+    スレッドプールはプロセスで 1 つなので、実行中のジョブのうち最も多く使えるプロファイルに
+    合わせる (前面のジョブがバックグラウンドのジョブに引きずられて遅くならないように)。
+    ジョブがなければ既定のプロファイルに戻す。
+    """
+
+    def __init__(self, default=None):
+        self.default = get_profile(default)
+        self._lock = threading.Lock()
+        self._active = []
+        self.threads = None
+        self._apply()
+
+    @contextlib.contextmanager
+    def job(self, profile=None):
+        """with の間、profile (None なら既定) のジョブを実行中として数え、その Profile を返す"""
+        profile = get_profile(profile) if profile is not None else self.default
+        with self._lock:
+            self._active.append(profile)
+            self._apply()
+        try:
+            yield profile
+        finally:
+            with self._lock:
+                self._active.remove(profile)
+                self._apply()
+
+    def _apply(self):
+        threads = max(thread_budget(p) for p in self._active or [self.default])
+        if threads != self.threads:
+            apply_threads(threads)
+            self.threads = threads
+
+    def stats(self):
+        with self._lock:
+            return {
+                "default": self.default.name,
+                "active": [p.name for p in self._active],
+                "threads": self.threads,
+            }
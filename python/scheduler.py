@@ -0,0 +1,228 @@
+import contextlib
+import itertools
+import threading
+import time
+
+
+# 常駐ワーカーのジョブスケジューラ (標準ライブラリのみに依存)
+#
+# 各ジョブは専用のスレッドで動き、処理の段ごとに資源 ("device": 分離・CTC推論、
+# "cpu": アライメント) を acquire() で確保する。資源ごとの同時実行数と、ジョブごとに
+# 見積もったメモリの合計で実行を許可し、待っているジョブは優先度 → 到着順に進める。
+# メモリの予算は資源ごとに別に持つ ("device" は GPU のメモリ、"cpu" はホストのメモリ)。
+# 同じ内容のジョブが待機中・実行中なら新しく実行せず、結果を共有する。
+#
+# メモリの見積もりが予算を超えて待たされているジョブがあれば、同じ資源を待つ後ろのジョブは
+# 追い越さない (小さいジョブが続いて大きいジョブが永遠に始まらないのを防ぐ)。
+# 別の資源を待つジョブは、メモリの予算も別なので先に進める。
+# 何も実行していなければ、予算を超えるジョブでも 1 つは実行する。
+
+PRIORITIES = {"interactive": 0, "normal": 5, "background": 10}
+DEFAULT_PRIORITY = "normal"
+DEFAULT_LIMITS = {"device": 1, "cpu": 1}
+
+
+def priority_value(priority):
+    """優先度の名前または数値を数値にする (小さいほど先に実行する)"""
+    if priority is None:
+        return PRIORITIES[DEFAULT_PRIORITY]
+    if isinstance(priority, (int, float)) and not isinstance(priority, bool):
+        return priority
+    try:
+        return PRIORITIES[priority]
+    except KeyError:
+        raise ValueError(
+            f"不明な優先度です: {priority} (選択肢: {', '.join(PRIORITIES)})"
+        ) from None
+
+
+class Job:
+    """スケジューラの 1 ジョブ (同じ key で合流したリクエストの callback をまとめて持つ)"""
+
+    def __init__(self, run, key, priority, memory, seq):
+        self.run = run
+        self.key = key
+        self.priority = priority
+        # 資源ごとのメモリの見積もり (バイト)
+        self.memory = memory
+        self.seq = seq
+        self.callbacks = []
+        self.wait_seconds = 0.0
+        self.holding = None
+
+
+class JobScheduler:
+    """
+    資源ごとの同時実行数とメモリの予算でジョブを実行する
+
+    limits は資源ごとの同時実行数、memory_budget は資源ごとのメモリの見積もりの合計の上限
+    {資源: バイト} (None か含まれない資源は制限しない)。memory_budget に関数を渡すと、
+    最初に資源を確保するときに 1 回だけ呼んでその戻り値を使う (予算を調べるのに torch の
+    読み込みが必要な場合に、ワーカーの起動を遅くしないため)。関数は _cond の外で呼ぶので、
+    その間も stats() などは待たされない。
+    """
+
+    def __init__(self, limits=None, memory_budget=None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._budget = memory_budget
+        self._budget_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._active = set()
+        self._waiting = []
+        self._running = {name: 0 for name in self.limits}
+        self._memory_in_use = {name: 0 for name in self.limits}
+
+    def submit(self, run, callback, key=None, priority=None, memory=None):
+        """
+        run(acquire) を新しいスレッドで実行し、戻り値を callback に渡す
+
+        acquire(resource) は資源を確保する with 用のコンテキストマネージャ。
+        key が同じジョブが待機中・実行中なら合流して True を返す
+        (優先度はどちらか高い方になる)。key が None なら合流しない。
+        """
+        priority = priority_value(priority)
+        with self._cond:
+            job = self._jobs.get(key) if key is not None else None
+            if job is not None:
+                job.callbacks.append(callback)
+                if priority < job.priority:
+                    job.priority = priority
+                    self._cond.notify_all()
+                return True
+            job = Job(run, key, priority, memory or {}, next(self._seq))
+            job.callbacks.append(callback)
+            if key is not None:
+                self._jobs[key] = job
+            self._active.add(job)
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return False
+
+    def _run(self, job):
+        try:
+            result = job.run(lambda resource: self._acquire(job, resource))
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+        with self._cond:
+            if job.key is not None:
+                self._jobs.pop(job.key, None)
+            callbacks = job.callbacks
+        if isinstance(result, dict):
+            result.setdefault("queue_seconds", round(job.wait_seconds, 3))
+        for callback in callbacks:
+            callback(result)
+        with self._cond:
+            self._active.discard(job)
+            self._cond.notify_all()
+
+    def _admissible(self, entry):
+        """
+        待っているジョブを優先度順に資源へ割り当てたとき、entry に順番が回るか
+
+        資源が空いていないジョブは飛ばす (他の資源のジョブの邪魔をしない)。
+        メモリが足りないジョブがあれば、同じ資源を待つそれより後ろのジョブには割り当てない。
+        """
+        running = dict(self._running)
+        memory_in_use = dict(self._memory_in_use)
+        # メモリが足りないジョブが先に待っている資源
+        blocked = set()
+        for waiting in sorted(self._waiting, key=lambda e: (e[0].priority, e[0].seq)):
+            job, resource = waiting
+            memory = job.memory.get(resource, 0)
+            if resource in blocked or running[resource] >= self.limits[resource]:
+                if waiting is entry:
+                    return False
+                continue
+            if not self._fits(resource, memory_in_use[resource], memory):
+                if waiting is entry:
+                    return False
+                blocked.add(resource)
+                continue
+            if waiting is entry:
+                return True
+            # entry より先に、このジョブが資源を取る
+            running[resource] += 1
+            memory_in_use[resource] += memory
+        return False
+
+    @property
+    def memory_budget(self):
+        """資源ごとのメモリの予算 (関数で渡してまだ呼んでいなければ None)"""
+        return None if callable(self._budget) else self._budget
+
+    def _resolve_budget(self):
+        """memory_budget に渡された関数を 1 回だけ呼ぶ (呼んでいる間も _cond は取らない)"""
+        if not callable(self._budget):
+            return
+        with self._budget_lock:
+            if callable(self._budget):
+                budget = self._budget()
+                with self._cond:
+                    self._budget = budget
+
+    def _fits(self, resource, memory_in_use, memory):
+        budget = (self.memory_budget or {}).get(resource)
+        if budget is None or memory == 0 or memory_in_use == 0:
+            return True
+        return memory_in_use + memory <= budget
+
+    @contextlib.contextmanager
+    def _acquire(self, job, resource):
+        if resource not in self.limits:
+            raise ValueError(f"不明な資源です: {resource}")
+        if job.holding is not None:
+            raise RuntimeError(
+                f"資源 {job.holding} を確保したまま {resource} を確保しようとしました"
+            )
+        memory = job.memory.get(resource, 0)
+        entry = (job, resource)
+        started = time.perf_counter()
+        self._resolve_budget()
+        with self._cond:
+            self._waiting.append(entry)
+            try:
+                while not self._admissible(entry):
+                    self._cond.wait()
+            finally:
+                self._waiting.remove(entry)
+            self._running[resource] += 1
+            self._memory_in_use[resource] += memory
+            job.holding = resource
+            # 他の待っているジョブにも、自分が取ったあとの状態で判定し直させる
+            self._cond.notify_all()
+        job.wait_seconds += time.perf_counter() - started
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running[resource] -= 1
+                self._memory_in_use[resource] -= memory
+                job.holding = None
+                self._cond.notify_all()
+
+    def idle(self):
+        """待機中・実行中のジョブがないか"""
+        with self._cond:
+            return not self._active
+
+    def stats(self):
+        with self._cond:
+            return {
+                "jobs": len(self._active),
+                "waiting": len(self._waiting),
+                "running": dict(self._running),
+                "memory_in_use": dict(self._memory_in_use),
+                "memory_budget": self.memory_budget,
+            }
+
+    def wait(self, timeout=None):
+        """すべてのジョブが終わるまで待つ。終わったら True"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._active:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
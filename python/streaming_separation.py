@@ -0,0 +1,196 @@
+import time
+
+import numpy as np
+
+from audio_io import READ_BLOCK_FRAMES, SAMPLE_RATE, SampleBuffer, StreamingUnsupported
+
+
+# 長い録音のボーカル分離をウィンドウごとに行うストリーム
+#
+# Separator.separate は入力全体をデコードし、元音声とボーカル・インストの全長の波形を
+# 持ったまま最後に MP3 に書き出すので、1 時間のライブ録音では数 GB になる。
+# StreamingSeparation は元音声を重なりのあるウィンドウで読み、分離モデルに 1 つずつ通して
+# 重なりを線形のクロスフェードでつなぎ (overlap-add)、ボーカルだけを返す。
+# StreamingAudio と同じく配列のようにスライスでき、スライスされた区間までしか分離しないので、
+# チャンク分割推論は最初のウィンドウが終わった時点で始まる。使い終わった区間は release() で
+# 捨てるので、保持するサンプルは曲の長さによらずウィンドウ数個分になる。
+
+# 1 回に分離するウィンドウの長さ (秒)
+WINDOW_SECONDS = 30
+# 隣のウィンドウと重ねてクロスフェードする長さ (秒)
+OVERLAP_SECONDS = 2
+
+
+class OverlapAdd:
+    """
+    重なりのあるウィンドウを順に受け取り、重なりをクロスフェードでつないだ列を返す
+
+    ウィンドウ k は列全体の [k * step, k * step + window) (step = window - overlap)。
+    push() はつなぎ終わった (次のウィンドウと重ならない) 部分を返す。
+    最後のウィンドウは last=True で渡すと末尾まで返す。
+    """
+
+    def __init__(self, overlap):
+        self.overlap = overlap
+        # 重なりの中心で 0.5 になる、次のウィンドウ側の重み (前のウィンドウ側は 1 から引く)
+        self._fade_in = (np.arange(overlap, dtype=np.float32) + 0.5) / max(overlap, 1)
+        self._tail = None
+
+    def push(self, window, last=False):
+        window = np.asarray(window, dtype=np.float32)
+        if self._tail is not None:
+            n = min(len(self._tail), len(window))
+            fade = self._fade_in[:n].reshape((n,) + (1,) * (window.ndim - 1))
+            head = window[:n] * fade + self._tail[:n] * (1 - fade)
+            window = np.concatenate([head, window[n:]])
+        if last:
+            self._tail = None
+            return window
+        keep = min(self.overlap, len(window))
+        self._tail = window[len(window) - keep :]
+        return window[: len(window) - keep]
+
+
+class StreamingSeparation:
+    """
+    音声ファイルのボーカルをウィンドウごとに分離し、配列のようにスライスできるストリーム
+
+    separate_window は (サンプル数, 2) のステレオ (model_sr) を受け取り、同じ形のボーカルを
+    返す関数 (vocal_separator.window_separator)。出力は sr のサンプリングレートで、
+    mono なら 1 次元、そうでなければ (サンプル数, 2)。len() は元のフレーム数から求めた
+    出力のサンプル数で、分離の結果がずれた場合は末尾を 0 で埋めるか切り詰める。
+    decode_seconds は元音声のデコードとリサンプル、separation_seconds は分離モデルの
+    実行にかかった秒数の合計。
+    """
+
+    def __init__(
+        self,
+        path,
+        separate_window,
+        model_sr,
+        sr=SAMPLE_RATE,
+        mono=True,
+        window_seconds=WINDOW_SECONDS,
+        overlap_seconds=OVERLAP_SECONDS,
+        block_frames=READ_BLOCK_FRAMES,
+    ):
+        if overlap_seconds >= window_seconds:
+            raise ValueError("重なりはウィンドウより短くしてください")
+        try:
+            import soundfile
+            import soxr
+        except ImportError as e:
+            raise StreamingUnsupported(str(e)) from e
+        try:
+            self._file = soundfile.SoundFile(path)
+        except Exception as e:
+            raise StreamingUnsupported(str(e)) from e
+        if self._file.frames <= 0:
+            self._file.close()
+            raise StreamingUnsupported("長さが分からないストリームです")
+
+        self.sr = sr or model_sr
+        self.mono = mono
+        self.source_sr = self._file.samplerate
+        self._separate_window = separate_window
+        self._block_frames = block_frames
+        self._window = int(window_seconds * model_sr)
+        self._step = self._window - int(overlap_seconds * model_sr)
+        self._overlap_add = OverlapAdd(self._window - self._step)
+
+        # 元音声 → model_sr のステレオ、分離したボーカル → sr
+        self._input_resampler = None
+        if self.source_sr != model_sr:
+            self._input_resampler = soxr.ResampleStream(
+                self.source_sr, model_sr, 2, dtype="float32", quality="HQ"
+            )
+        self._output_resampler = None
+        if self.sr != model_sr:
+            self._output_resampler = soxr.ResampleStream(
+                model_sr, self.sr, 1 if mono else 2, dtype="float32", quality="HQ"
+            )
+        self._input_length = int(round(self._file.frames * model_sr / self.source_sr))
+        self._length = int(round(self._file.frames * self.sr / self.source_sr))
+        self._input = SampleBuffer()
+        self._output = SampleBuffer()
+        self._eof = False
+        self._next_start = 0
+        self._done = False
+        self.windows = 0
+        self.decode_seconds = 0.0
+        self.separation_seconds = 0.0
+
+    def __len__(self):
+        return self._length
+
+    def _read_block(self):
+        started = time.perf_counter()
+        data = self._file.read(self._block_frames, dtype="float32", always_2d=True)
+        last = len(data) < self._block_frames
+        # 分離モデルはステレオを前提にするので、モノラルは複製し、3ch 以上は先頭の 2ch を使う
+        stereo = np.repeat(data, 2, axis=1) if data.shape[1] == 1 else data[:, :2]
+        if self._input_resampler is not None:
+            stereo = self._input_resampler.resample_chunk(stereo, last=last)
+        self._input.append(stereo)
+        if last:
+            self._eof = True
+            self._file.close()
+            if self._input.end < self._input_length:
+                self._input.append(
+                    np.zeros((self._input_length - self._input.end, 2), np.float32)
+                )
+            self._input.truncate(self._input_length)
+        self.decode_seconds += time.perf_counter() - started
+
+    def _separate_next(self):
+        """次のウィンドウを分離し、つなぎ終わった部分を出力に追加する"""
+        start = self._next_start
+        stop = min(start + self._window, self._input_length)
+        while self._input.end < stop and not self._eof:
+            self._read_block()
+        window = self._input.slice(start, stop)
+        last = stop >= self._input_length
+        self._next_start = start + self._step
+        # 次のウィンドウより前の元音声はもう参照しない
+        self._input.release(self._next_start)
+
+        started = time.perf_counter()
+        vocals = self._separate_window(window)
+        self.separation_seconds += time.perf_counter() - started
+        self.windows += 1
+
+        block = self._overlap_add.push(vocals, last)
+        if self.mono:
+            block = block.mean(axis=1)
+        if self._output_resampler is not None:
+            block = self._output_resampler.resample_chunk(block, last=last)
+        self._output.append(block)
+        if last:
+            self._done = True
+            if self._output.end < self._length:
+                shape = (self._length - self._output.end,) + block.shape[1:]
+                self._output.append(np.zeros(shape, np.float32))
+            self._output.truncate(self._length)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("StreamingSeparation は連続したスライスだけに対応しています")
+        start, stop, _ = key.indices(self._length)
+        stop = max(start, stop)
+        while self._output.end < stop and not self._done:
+            self._separate_next()
+        return self._output.slice(start, stop)
+
+    def release(self, before):
+        """before より前のサンプルはもう参照しない (メモリを解放する)"""
+        self._output.release(before)
+
+    def held_samples(self):
+        """保持している元音声と出力のサンプル数 (出力のサンプリングレートに換算しない合計)"""
+        return self._input.held() + self._output.held()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        self._input = SampleBuffer()
+        self._output = SampleBuffer()
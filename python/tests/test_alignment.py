@@ -0,0 +1,277 @@
+import numpy as np
+import pytest
+
+from alignment import (
+    CheckpointedTrellis,
+    align,
+    align_segmented,
+    backtrack,
+    get_trellis,
+    merge_repeats,
+    merge_words,
+    shared_pool,
+    trellis_nbytes,
+)
+
+
+# 旧実装 (二重ループ版) をそのまま参照実装として残し、配列版と突き合わせる
+def reference_get_trellis(emission, tokens, blank_id=0):
+    num_frame = len(emission)
+    num_tokens = len(tokens)
+    trellis = np.full((num_frame, num_tokens), -np.inf)
+
+    cumsum = 0
+    for t in range(num_frame):
+        cumsum += emission[t][blank_id]
+        trellis[t][0] = cumsum
+
+    for t in range(num_frame - 1):
+        p_stay = emission[t][blank_id]
+        for j in range(1, num_tokens):
+            p_change = emission[t][tokens[j]]
+            stay_score = trellis[t][j] + p_stay
+            change_score = trellis[t][j - 1] + p_change
+            trellis[t + 1][j] = max(stay_score, change_score)
+    return trellis
+
+
+def reference_backtrack(trellis, emission, tokens, blank_id=0):
+    t, j = trellis.shape[0] - 1, trellis.shape[1] - 1
+    path = []
+    path.append((j, t, np.exp(emission[t][blank_id])))
+
+    while j > 0:
+        if t <= 0:
+            break
+        p_stay = emission[t - 1][blank_id]
+        p_change = emission[t - 1][tokens[j]]
+        stay_score = trellis[t - 1][j] + p_stay
+        change_score = trellis[t - 1][j - 1] + p_change
+
+        t -= 1
+        if change_score > stay_score:
+            j -= 1
+
+        prob = np.exp(change_score if change_score > stay_score else stay_score)
+        path.append((j, t, prob))
+
+    while t > 0:
+        path.append((j, t - 1, np.exp(emission[t - 1][blank_id])))
+        t -= 1
+
+    return path[::-1]
+
+
+def reference_merge_repeats(path, transcript):
+    i1 = 0
+    segments = []
+    while i1 < len(path):
+        i2 = i1
+        while i2 < len(path) and path[i1][0] == path[i2][0]:
+            i2 += 1
+        score = sum(p[2] for p in path[i1:i2]) / (i2 - i1)
+        segments.append(
+            {
+                "label": transcript[path[i1][0]],
+                "start": path[i1][1],
+                "end": path[i2 - 1][1] + 1,
+                "score": score,
+            }
+        )
+        i1 = i2
+    return segments
+
+
+def reference_merge_words(segments, separator="|"):
+    words = []
+    i1, i2 = 0, 0
+    while i1 < len(segments):
+        if i2 >= len(segments) or segments[i2]["label"] == separator:
+            if i1 != i2:
+                segs = segments[i1:i2]
+                word = "".join(s["label"] for s in segs)
+                word_start = segs[0]["start"]
+                word_end = segs[-1]["end"]
+                score = sum(s["score"] * (s["end"] - s["start"]) for s in segs) / (
+                    word_end - word_start
+                )
+                words.append(
+                    {"word": word, "start": word_start, "end": word_end, "score": score}
+                )
+            i1 = i2 + 1
+            i2 = i1
+        else:
+            i2 += 1
+    return words
+
+
+def make_case(seed, num_frames, transcript, vocab_size=32):
+    """ランダムな log_softmax 出力 (float32) と、対応するトークン列を作る"""
+    rng = np.random.default_rng(seed)
+    logits = rng.normal(size=(num_frames, vocab_size)).astype(np.float32)
+    # 文字トークンが時間順に現れるよう、対角付近を持ち上げる
+    chars = sorted(set(transcript))
+    token_of = {c: i + 1 for i, c in enumerate(chars)}
+    tokens = [token_of[c] for c in transcript]
+    for j, tid in enumerate(tokens):
+        t = int(j * num_frames / len(tokens))
+        logits[t, tid] += 4.0
+    logits -= logits.max(axis=1, keepdims=True)
+    emission = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+    return emission.astype(np.float32), tokens
+
+
+CASES = [
+    (0, 300, "|HELLO|WORLD|"),
+    (1, 500, "|BAD|WAVE|IS|A|MUSIC|PLAYER|"),
+    (2, 40, "|I'M|HOME|"),
+    (3, 12, "|LONG|TRANSCRIPT|"),
+]
+
+
+@pytest.mark.parametrize("seed,num_frames,transcript", CASES)
+def test_alignment_matches_reference(seed, num_frames, transcript):
+    emission, tokens = make_case(seed, num_frames, transcript)
+
+    expected_trellis = reference_get_trellis(emission, tokens)
+    trellis = get_trellis(emission, tokens)
+    assert trellis.dtype == expected_trellis.dtype
+    assert np.array_equal(trellis, expected_trellis)
+
+    expected_path = reference_backtrack(expected_trellis, emission, tokens)
+    path = backtrack(trellis, emission, tokens)
+    assert path.token_index.tolist() == [p[0] for p in expected_path]
+    assert path.frame.tolist() == [p[1] for p in expected_path]
+    assert path.score.tolist() == [float(p[2]) for p in expected_path]
+
+    # スコアの合計は旧実装では float32/float64 が混在した逐次加算だったため、
+    # 区間境界とラベルは完全一致、スコアのみ丸め誤差の範囲で比較する
+    expected_segments = reference_merge_repeats(expected_path, transcript)
+    segments = merge_repeats(path, transcript)
+    assert segments.label.tolist() == [s["label"] for s in expected_segments]
+    assert segments.start.tolist() == [s["start"] for s in expected_segments]
+    assert segments.end.tolist() == [s["end"] for s in expected_segments]
+    np.testing.assert_allclose(
+        segments.score, [s["score"] for s in expected_segments], rtol=1e-6
+    )
+
+    expected_words = reference_merge_words(expected_segments)
+    words = merge_words(segments)
+    assert words.label.tolist() == [w["word"] for w in expected_words]
+    assert words.start.tolist() == [w["start"] for w in expected_words]
+    assert words.end.tolist() == [w["end"] for w in expected_words]
+    np.testing.assert_allclose(
+        words.score, [w["score"] for w in expected_words], rtol=1e-6
+    )
+
+
+def test_merge_words_skips_empty_words():
+    transcript = "||AB||C|"
+    emission, tokens = make_case(5, 60, transcript)
+    trellis = get_trellis(emission, tokens)
+    segments = merge_repeats(backtrack(trellis, emission, tokens), transcript)
+    assert merge_words(segments).label.tolist() == ["AB", "C"]
+
+
+@pytest.mark.parametrize("interval", [None, 1, 7, 1000])
+@pytest.mark.parametrize("seed,num_frames,transcript", CASES)
+def test_checkpointed_trellis_matches_full(seed, num_frames, transcript, interval):
+    emission, tokens = make_case(seed, num_frames, transcript)
+    trellis = get_trellis(emission, tokens)
+    checkpointed = CheckpointedTrellis(emission, tokens, interval=interval)
+
+    assert checkpointed.shape == trellis.shape
+    for t in reversed(range(num_frames)):
+        assert np.array_equal(checkpointed[t], trellis[t])
+
+    expected = backtrack(trellis, emission, tokens)
+    path = backtrack(
+        CheckpointedTrellis(emission, tokens, interval=interval), emission, tokens
+    )
+    assert np.array_equal(path.token_index, expected.token_index)
+    assert np.array_equal(path.frame, expected.frame)
+    assert np.array_equal(path.score, expected.score)
+
+
+def test_align_switches_to_low_memory_above_limit():
+    emission, tokens = make_case(1, 500, CASES[1][2])
+    expected = backtrack(get_trellis(emission, tokens), emission, tokens)
+
+    path = align(emission, tokens, memory_limit=trellis_nbytes(500, len(tokens)) - 1)
+    assert np.array_equal(path.frame, expected.frame)
+    assert np.array_equal(path.token_index, expected.token_index)
+    assert np.array_equal(path.score, expected.score)
+
+
+def make_song(num_frames=6000, repeat=3):
+    lines = [
+        "HELLO|WORLD",
+        "BAD|WAVE|IS|HERE",
+        "MUSIC|PLAYER|FOR|YOU",
+        "SING|ALONG|TONIGHT",
+        "ANOTHER|LINE",
+        "LAST|LINE|OF|SONG",
+    ] * repeat
+    transcript = "|" + "|".join(lines) + "|"
+    emission, tokens = make_case(7, num_frames, transcript)
+    line_ends = []
+    pos = 0
+    for line in lines[:-1]:
+        pos += len(line) + 1
+        line_ends.append(pos)
+    return emission, tokens, line_ends
+
+
+def _token_onset_error(path, num_frames, num_tokens):
+    """make_case で持ち上げたフレームと、各トークンに入ったフレームの差の平均"""
+    first = np.array([path.frame[path.token_index == j][0] for j in range(num_tokens)])
+    truth = np.array([int(j * num_frames / num_tokens) + 1 for j in range(num_tokens)])
+    return np.abs(first - truth).mean()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_align_segmented_is_as_accurate_as_global(workers):
+    emission, tokens, line_ends = make_song()
+    path, info = align_segmented(emission, tokens, line_ends, workers=workers)
+    assert info["mode"] == "segmented"
+    assert info["groups"] >= 2
+
+    # 全フレームを 1 回ずつ覆い、トークン位置は単調増加
+    assert path.frame.tolist() == list(range(len(emission)))
+    assert np.all(np.diff(path.token_index) >= 0)
+    assert path.token_index[0] == 0 and path.token_index[-1] == len(tokens) - 1
+
+    expected = _token_onset_error(align(emission, tokens), len(emission), len(tokens))
+    actual = _token_onset_error(path, len(emission), len(tokens))
+    assert actual <= expected + 1.0
+
+
+def test_align_segmented_falls_back_on_low_confidence():
+    emission, tokens, line_ends = make_song()
+    path, info = align_segmented(
+        emission, tokens, line_ends, workers=1, min_confidence=1.1
+    )
+    assert info["mode"] == "global"
+    assert info["reason"] == "low_confidence"
+    assert np.array_equal(path.frame, align(emission, tokens).frame)
+    assert np.array_equal(path.token_index, align(emission, tokens).token_index)
+
+
+def test_align_segmented_falls_back_on_short_audio():
+    emission, tokens, line_ends = make_song(num_frames=600, repeat=1)
+    _, info = align_segmented(emission, tokens, line_ends, workers=4)
+    assert info == {"mode": "global", "reason": "too_short"}
+
+
+def test_align_segmented_reuses_one_spawned_pool():
+    emission, tokens, line_ends = make_song()
+    first, _ = align_segmented(emission, tokens, line_ends, workers=2)
+    pool = shared_pool(2)
+    # 常駐ワーカーのスレッドを fork で複製しないよう、子プロセスは spawn で作る
+    assert pool._mp_context.get_start_method() == "spawn"
+
+    second, info = align_segmented(emission, tokens, line_ends, workers=2)
+    assert info["mode"] == "segmented"
+    assert shared_pool(2) is pool and shared_pool(1) is pool
+    assert np.array_equal(first.frame, second.frame)
+    assert np.array_equal(first.token_index, second.token_index)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from audio_io import SampleBuffer, StreamingUnsupported
+from chunking import plan_chunks
+
+
+def filled_buffer(sizes):
+    buffer = SampleBuffer()
+    pos = 0
+    for size in sizes:
+        buffer.append(np.arange(pos, pos + size, dtype=np.float32))
+        pos += size
+    return buffer
+
+
+def test_slice_spans_blocks():
+    buffer = filled_buffer([5, 3, 7])
+    np.testing.assert_array_equal(buffer.slice(4, 10), np.arange(4, 10))
+    assert len(buffer.slice(6, 6)) == 0
+
+
+def test_release_drops_whole_blocks_only():
+    buffer = filled_buffer([5, 3, 7])
+    buffer.release(6)
+    # 6 を含むブロック [5, 8) は残す
+    assert buffer.offset == 5 and buffer.held() == 10
+    np.testing.assert_array_equal(buffer.slice(6, 9), [6, 7, 8])
+    with pytest.raises(IndexError):
+        buffer.slice(4, 6)
+
+
+def test_truncate():
+    buffer = filled_buffer([5, 3, 7])
+    buffer.truncate(7)
+    assert buffer.end == 7
+    np.testing.assert_array_equal(buffer.slice(0, 7), np.arange(7))
+
+
+def test_streaming_matches_whole_file_resample(tmp_path):
+    soundfile = pytest.importorskip("soundfile")
+    soxr = pytest.importorskip("soxr")
+    from audio_io import StreamingAudio
+
+    source_sr = 44100
+    t = np.arange(source_sr * 20) / source_sr
+    stereo = np.stack(
+        [0.3 * np.sin(2 * np.pi * 220 * t), 0.3 * np.sin(2 * np.pi * 330 * t)], axis=1
+    ).astype(np.float32)
+    path = tmp_path / "song.flac"
+    soundfile.write(path, stereo, source_sr)
+    expected = soxr.resample(stereo.mean(axis=1), source_sr, 16000, quality="HQ")
+
+    audio = StreamingAudio(str(path), block_frames=8192)
+    assert abs(len(audio) - len(expected)) <= 1
+    peak_held = 0
+    pieces = []
+    for chunk in plan_chunks(len(audio), 250):
+        audio.release(chunk.start)
+        pieces.append((chunk.start, audio[chunk.start : chunk.stop]))
+        peak_held = max(peak_held, audio.held_samples())
+    audio.close()
+
+    # 保持するサンプルは 1 チャンクとブロック数個分に収まる
+    assert peak_held < 16000 * 8
+    for start, piece in pieces:
+        n = min(len(piece), len(expected) - start)
+        np.testing.assert_allclose(piece[:n], expected[start : start + n], atol=1e-3)
+
+
+def test_unsupported_format_is_reported(tmp_path):
+    pytest.importorskip("soundfile")
+    pytest.importorskip("soxr")
+    from audio_io import StreamingAudio
+
+    path = tmp_path / "video.mkv"
+    path.write_bytes(b"\x1a\x45\xdf\xa3 not really matroska")
+    with pytest.raises(StreamingUnsupported):
+        StreamingAudio(str(path))
@@ -0,0 +1,169 @@
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import batch_lrc
+from lrc_generator import SAMPLE_RATE
+
+
+class FakeModels:
+    """ModelCache の代わりに、モデルの読み込みと解放の順番を記録する"""
+
+    events = []
+
+    def __init__(self, backend="auto"):
+        self.events.clear()
+
+    def separate(self, audio_path, model_name, **kwargs):
+        self.events.append("separate")
+        return {"status": "success", "vocals": np.zeros(SAMPLE_RATE * 2, dtype=np.float32)}
+
+    def release_separator(self):
+        self.events.append("release_separator")
+
+    def ctc(self, model_id, precision):
+        self.events.append("ctc")
+        processor = SimpleNamespace(tokenizer=SimpleNamespace(get_vocab=lambda: {"a": 1}))
+        return processor, SimpleNamespace(config=SimpleNamespace()), "cpu"
+
+    def release_ctc(self):
+        self.events.append("release_ctc")
+
+    def unload(self):
+        self.events.append("unload")
+
+
+def write_manifest(path, count):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            f.write(json.dumps({"id": str(i), "audio": f"{i}.wav", "lyrics": "a"}) + "\n")
+
+
+def failing_inference(*args):
+    raise RuntimeError("推論に失敗しました")
+
+
+def test_separator_is_released_before_ctc_is_loaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_lrc, "ModelCache", FakeModels)
+    monkeypatch.setattr(batch_lrc, "infer_batch", failing_inference)
+    # 1 曲 2 秒なので、2 曲ずつのグループになる
+    monkeypatch.setattr(batch_lrc, "GROUP_AUDIO_SECONDS", 3)
+    manifest, output = tmp_path / "manifest.jsonl", tmp_path / "out.jsonl"
+    write_manifest(manifest, 3)
+
+    summary = batch_lrc.run_batch(str(manifest), str(output), workers=1)
+
+    assert summary["failed"] == 3
+    assert FakeModels.events == [
+        "separate",
+        "separate",
+        "release_separator",
+        "ctc",
+        "release_ctc",
+        "separate",
+        "release_separator",
+        "ctc",
+        "unload",
+    ]
+    results = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [r["id"] for r in results] == ["0", "1", "2"]
+
+
+def test_models_are_unloaded_when_the_batch_aborts(tmp_path, monkeypatch):
+    def broken_ctc(self, model_id, precision):
+        raise RuntimeError("モデルを読み込めません")
+
+    monkeypatch.setattr(batch_lrc, "ModelCache", FakeModels)
+    monkeypatch.setattr(FakeModels, "ctc", broken_ctc)
+    manifest, output = tmp_path / "manifest.jsonl", tmp_path / "out.jsonl"
+    write_manifest(manifest, 1)
+
+    with pytest.raises(RuntimeError):
+        batch_lrc.run_batch(str(manifest), str(output), workers=1)
+    assert FakeModels.events[-1] == "unload"
+
+
+def test_batches_only_hold_chunks_of_the_same_length(tmp_path, monkeypatch):
+    lengths = []
+
+    def record_lengths(chunks, *args):
+        lengths.append({len(c) for c in chunks})
+        raise RuntimeError("推論に失敗しました")
+
+    monkeypatch.setattr(batch_lrc, "ModelCache", FakeModels)
+    monkeypatch.setattr(batch_lrc, "infer_batch", record_lengths)
+    monkeypatch.setattr(
+        batch_lrc, "load_audio", lambda path, sr: np.zeros(int(SAMPLE_RATE * 75.3), np.float32)
+    )
+    manifest, output = tmp_path / "manifest.jsonl", tmp_path / "out.jsonl"
+    write_manifest(manifest, 3)
+
+    batch_lrc.run_batch(
+        str(manifest), str(output), batch_size=4, workers=1, use_vocal_separation=False
+    )
+    assert lengths and all(len(batch) == 1 for batch in lengths)
+
+
+def emission_as_lrc(emission, *args):
+    """align_lyrics の代わりに、受け取った emission をそのまま結果にする (ワーカープロセスで実行)"""
+    return emission.tolist(), None
+
+
+def test_batch_matches_single_song_emission_for_group_norm_model(tmp_path, monkeypatch):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    pytest.importorskip("librosa")
+    from test_batched_inference import make_tiny_model
+
+    from lrc_generator import compute_emission
+    from resource_policy import get_profile, memory_limit
+    from tiers import Tier
+
+    # base モデル (attention_mask を使わない group norm) と同じ構成のティア
+    processor, model = make_tiny_model(norm="group")
+    processor.tokenizer = SimpleNamespace(get_vocab=lambda: {"a": 1})
+    tier = Tier("base", None, "tiny", max_chunk_seconds=10, precision="fp32")
+
+    class TinyModels(FakeModels):
+        def ctc(self, model_id, precision):
+            return processor, model, torch.device("cpu")
+
+    rng = np.random.default_rng(5)
+    songs = {
+        f"{i}.wav": rng.normal(scale=0.1, size=int(SAMPLE_RATE * seconds)).astype(np.float32)
+        for i, seconds in enumerate((25.3, 13.7, 31.1))
+    }
+    monkeypatch.setattr(batch_lrc, "ModelCache", TinyModels)
+    monkeypatch.setattr(batch_lrc, "load_audio", lambda path, sr: songs[os.path.basename(path)])
+    monkeypatch.setattr(batch_lrc, "align_lyrics", emission_as_lrc)
+    manifest, output = tmp_path / "manifest.jsonl", tmp_path / "out.jsonl"
+    write_manifest(manifest, len(songs))
+
+    batch_lrc.run_batch(
+        str(manifest),
+        str(output),
+        batch_size=4,
+        workers=1,
+        use_vocal_separation=False,
+        tier=tier,
+    )
+
+    results = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    chunk_seconds = batch_lrc.choose_chunk_seconds(
+        torch.device("cpu"), tier.max_chunk_seconds, get_profile().memory_ratio, memory_limit()
+    )
+    for result in results:
+        assert result["status"] == "success", result
+        single = compute_emission(
+            songs[result["audio"]],
+            processor,
+            model,
+            torch.device("cpu"),
+            batch_size=1,
+            chunk_seconds=chunk_seconds,
+        )
+        # 同じ長さのチャンクだけを束ねるので、バッチの大きさによる加算順序の差しか残らない
+        np.testing.assert_allclose(np.array(result["lrc"]), single, rtol=0, atol=1e-5)
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("librosa")
+
+from chunking import FrameGeometry, plan_chunks, seconds_to_frames
+from lrc_generator import SAMPLE_RATE, compute_emission, infer_batch
+
+
+def make_tiny_model(norm="layer"):
+    """
+    ダウンロード不要な小さい wav2vec2
+
+    norm="layer" は large-lv60 と同じ layer norm 構成 (attention_mask を使う)、
+    norm="group" は base と同じ group norm 構成 (attention_mask を使わない)
+    """
+    torch.manual_seed(0)
+    config = transformers.Wav2Vec2Config(
+        vocab_size=32,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        conv_dim=(16, 16, 16, 16, 16, 16, 16),
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=2,
+        feat_extract_norm=norm,
+        do_stable_layer_norm=norm == "layer",
+    )
+    model = transformers.Wav2Vec2ForCTC(config).eval()
+    processor = transformers.Wav2Vec2FeatureExtractor(
+        sampling_rate=SAMPLE_RATE, do_normalize=True, return_attention_mask=norm == "layer"
+    )
+    return processor, model
+
+
+def full_emission(audio, processor, model):
+    """音声全体を 1 回の forward で推論した出力"""
+    inputs = processor(audio, sampling_rate=SAMPLE_RATE, return_tensors="pt")
+    with torch.no_grad():
+        logits = model(inputs.input_values).logits
+    return torch.log_softmax(logits, dim=-1)[0].numpy()
+
+
+def test_single_chunk_matches_full_pass():
+    processor, model = make_tiny_model()
+    rng = np.random.default_rng(2)
+    audio = rng.normal(scale=0.1, size=SAMPLE_RATE * 12 + 57).astype(np.float32)
+
+    emission = compute_emission(
+        audio, processor, model, torch.device("cpu"), batch_size=1, chunk_seconds=30
+    )
+    assert np.array_equal(emission, full_emission(audio, processor, model))
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 4])
+def test_chunked_emission_is_frame_exact(batch_size):
+    processor, model = make_tiny_model()
+    rng = np.random.default_rng(0)
+    audio = rng.normal(scale=0.1, size=int(SAMPLE_RATE * 95.5)).astype(np.float32)
+
+    # フレーム数は音声全体を 1 回で推論した場合と一致し、継ぎ目でずれない
+    emission = compute_emission(
+        audio,
+        processor,
+        model,
+        torch.device("cpu"),
+        batch_size=batch_size,
+        chunk_seconds=10,
+    )
+    expected_frames = int(model._get_feat_extract_output_lengths(len(audio)))
+    assert emission.shape == (expected_frames, model.config.vocab_size)
+
+    baseline = compute_emission(
+        audio, processor, model, torch.device("cpu"), batch_size=1, chunk_seconds=10
+    )
+    if batch_size == 1:
+        assert np.array_equal(emission, baseline)
+        return
+    # バッチ 2 以上では行列積のブロック分割 (BLAS がバッチの形で選ぶ) が変わり、
+    # fp32 の加算順序が変わるので完全には一致しない。差は数 ulp の累積で、
+    # log_softmax (絶対値は 1〜10 程度) に対して 1e-5 あれば十分小さい
+    np.testing.assert_allclose(emission, baseline, rtol=0, atol=1e-5)
+    # アライメントが使うフレームごとの最尤トークンは変わらない
+    assert np.array_equal(emission.argmax(axis=-1), baseline.argmax(axis=-1))
+
+
+class OutOfMemoryModel(torch.nn.Module):
+    """バッチ 2 以上の forward で CUDA のメモリ不足と同じ例外を出すモデル"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+        self.dtype = model.dtype
+        self.calls = []
+
+    def _get_feat_extract_output_lengths(self, lengths):
+        return self.model._get_feat_extract_output_lengths(lengths)
+
+    def forward(self, input_values, **kwargs):
+        self.calls.append(input_values.shape[0])
+        if input_values.shape[0] > 1:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return self.model(input_values, **kwargs)
+
+
+def test_compute_emission_backs_off_on_out_of_memory():
+    processor, model = make_tiny_model()
+    rng = np.random.default_rng(3)
+    audio = rng.normal(scale=0.1, size=SAMPLE_RATE * 45).astype(np.float32)
+    expected = compute_emission(
+        audio, processor, model, torch.device("cpu"), batch_size=1, chunk_seconds=10
+    )
+
+    flaky = OutOfMemoryModel(model)
+    emission = compute_emission(
+        audio, processor, flaky, torch.device("cpu"), batch_size=4, chunk_seconds=10
+    )
+    assert np.array_equal(emission, expected)
+    assert flaky.calls[:3] == [4, 2, 1]
+
+
+def test_padded_batch_ignores_padding():
+    processor, model = make_tiny_model()
+    rng = np.random.default_rng(1)
+    audio = rng.normal(scale=0.1, size=SAMPLE_RATE * 40).astype(np.float32)
+    geometry = FrameGeometry.from_config(model.config)
+    chunks = [
+        audio[c.start : c.stop]
+        for c in plan_chunks(len(audio), seconds_to_frames(30, geometry), geometry)
+    ]
+    assert len(chunks) == 2 and len(chunks[0]) != len(chunks[1])
+
+    batched = infer_batch(chunks, processor, model, torch.device("cpu"))
+    for chunk, emission in zip(chunks, batched):
+        (single,) = infer_batch([chunk], processor, model, torch.device("cpu"))
+        assert emission.shape == single.shape
+        # attention_mask でパディングは無視されるが、パディングしたバッチでは行列積の形が
+        # 変わるので加算順序の差が残る。さらに位置埋め込みの畳み込みとマスク付き softmax を
+        # 2 層通る分だけ誤差が増えるので、上のバッチ比較より 1 桁緩くする
+        np.testing.assert_allclose(emission, single, rtol=0, atol=1e-4)
+
+
+def test_group_norm_model_is_never_padded():
+    processor, model = make_tiny_model(norm="group")
+    rng = np.random.default_rng(4)
+    # 曲の最後のチャンクのように長さの違うチャンクを、同じ長さのものと混ぜてバッチにする
+    chunks = [
+        rng.normal(scale=0.1, size=n).astype(np.float32)
+        for n in (SAMPLE_RATE * 10, SAMPLE_RATE * 4 + 321, SAMPLE_RATE * 10)
+    ]
+
+    batched = infer_batch(chunks, processor, model, torch.device("cpu"))
+    for chunk, emission in zip(chunks, batched):
+        (single,) = infer_batch([chunk], processor, model, torch.device("cpu"))
+        assert emission.shape == single.shape
+        # GroupNorm はパディングの 0 も正規化に含めるので、同じ長さのものだけをまとめて推論する
+        # (バッチ 2 の forward と単独の forward の加算順序の差だけが残る)
+        np.testing.assert_allclose(emission, single, rtol=0, atol=1e-5)
@@ -0,0 +1,53 @@
+from benchmark_alignment import Scenario, build_case, compare, measure, steps
+
+
+def test_synthetic_case_aligns_segmented():
+    from alignment import align_segmented
+
+    case = build_case(Scenario("tiny", 60, 1))
+    assert case["transcript"].startswith("|") and case["transcript"].endswith("|")
+    assert len(case["line_ends"]) >= 2
+    path, info = align_segmented(
+        case["emission"], case["tokens"], case["line_ends"], workers=1
+    )
+    assert info["mode"] == "segmented"
+    assert path.token_index[-1] == len(case["tokens"]) - 1
+
+
+def test_steps_run_in_order():
+    case = build_case(Scenario("tiny", 30, 1))
+    names = []
+    # 後の関数は前の関数の結果 (トレリス・パス・セグメント) を使う
+    for name, fn in steps(case):
+        fn()
+        names.append(name)
+    assert names[:3] == ["clean_text", "get_trellis", "backtrack"]
+    assert names[-2:] == ["merge_repeats", "merge_words"]
+    seconds, peak = measure(lambda: bytearray(4 * 1024 * 1024), 2)
+    assert seconds >= 0 and peak >= 4 * 1024 * 1024
+
+
+def test_compare_flags_regressions_above_threshold():
+    baseline = {
+        "results": {
+            "pop": {
+                "align": {"seconds": 1.0, "peak_bytes": 100 * 1024 * 1024},
+                "clean_text": {"seconds": 0.0001, "peak_bytes": 1000},
+            }
+        }
+    }
+    report = {
+        "results": {
+            "pop": {
+                "align": {"seconds": 1.1, "peak_bytes": 200 * 1024 * 1024},
+                # 誤差の範囲の差 (割合は大きくても絶対値が小さい) は無視する
+                "clean_text": {"seconds": 0.0003, "peak_bytes": 3000},
+                "merge_words": {"seconds": 9.0, "peak_bytes": 0},
+            }
+        }
+    }
+    regressions = compare(report, baseline, threshold=0.2)
+    assert [(r["function"], r["metric"]) for r in regressions] == [
+        ("align", "peak_bytes")
+    ]
+    assert compare(report, baseline, threshold=0.05)[0]["metric"] == "seconds"
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from chunking import (
+    WAV2VEC2_GEOMETRY,
+    FrameGeometry,
+    plan_chunks,
+    run_chunked,
+    seconds_to_frames,
+)
+
+
+def test_wav2vec2_geometry():
+    assert WAV2VEC2_GEOMETRY.hop == 320
+    assert WAV2VEC2_GEOMETRY.receptive_field == 400
+    for n in [0, 399, 400, 719, 720, 16000, 16000 * 30 + 123]:
+        expected = max(0, (n - 400) // 320 + 1)
+        assert WAV2VEC2_GEOMETRY.num_frames(n) == expected
+    for frames in [1, 2, 1499]:
+        span = WAV2VEC2_GEOMETRY.span_samples(frames)
+        assert WAV2VEC2_GEOMETRY.num_frames(span) == frames
+        assert WAV2VEC2_GEOMETRY.num_frames(span - 1) == frames - 1
+
+
+def conv_model(audio, geometry):
+    """受容野内のサンプルだけで各フレームが決まる、畳み込みのみのモデル"""
+    n = geometry.num_frames(len(audio))
+    starts = np.arange(n) * geometry.hop
+    windows = audio[starts[:, None] + np.arange(geometry.receptive_field)]
+    return np.stack([windows.sum(axis=1), windows.max(axis=1)], axis=1)
+
+
+@pytest.mark.parametrize("num_samples", [400, 16000 * 7 + 37, 16000 * 95 + 8000])
+@pytest.mark.parametrize("chunk_seconds", [3, 10, 30])
+def test_plan_covers_every_frame_once(num_samples, chunk_seconds):
+    geometry = WAV2VEC2_GEOMETRY
+    chunks = plan_chunks(num_samples, seconds_to_frames(chunk_seconds), geometry)
+
+    assert chunks[0].frame_start == 0
+    assert chunks[-1].frame_stop == geometry.num_frames(num_samples)
+    for prev, cur in zip(chunks, chunks[1:]):
+        assert cur.frame_start == prev.frame_stop
+    for c in chunks:
+        assert c.start % geometry.hop == 0
+        assert c.start + c.keep_start * geometry.hop == c.frame_start * geometry.hop
+        assert geometry.num_frames(c.stop - c.start) >= c.keep_stop
+        assert c.stop <= num_samples
+    # 音声の端にかからないチャンクは同じ長さ
+    inner = [c for c in chunks if c.start > 0 and c.stop < num_samples]
+    assert len({c.stop - c.start for c in inner}) <= 1
+
+
+def test_stitched_frames_match_full_pass():
+    geometry = WAV2VEC2_GEOMETRY
+    audio = np.random.default_rng(0).normal(size=16000 * 65 + 111)
+    expected = conv_model(audio, geometry)
+
+    def infer(chunks):
+        return [conv_model(audio[c.start : c.stop], geometry) for c in chunks]
+
+    kept = run_chunked(len(audio), infer, seconds_to_frames(10), batch_size=3)
+    assert np.array_equal(np.concatenate(kept), expected)
+
+
+def test_run_chunked_backs_off_on_out_of_memory():
+    geometry = FrameGeometry((10, 3, 3, 3, 3, 2, 2), (5, 2, 2, 2, 2, 2, 2), 8)
+    audio = np.random.default_rng(1).normal(size=16000 * 40)
+    expected = conv_model(audio, geometry)
+    calls = []
+    backoffs = []
+
+    def infer(chunks):
+        calls.append(len(chunks))
+        # バッチ 2 以上、または 200 フレームを超えるチャンクはメモリ不足
+        if len(chunks) > 1 or chunks[0].stop - chunks[0].start > geometry.span_samples(200):
+            raise MemoryError
+        return [conv_model(audio[c.start : c.stop], geometry) for c in chunks]
+
+    kept = run_chunked(
+        len(audio),
+        infer,
+        chunk_frames=800,
+        batch_size=4,
+        geometry=geometry,
+        is_out_of_memory=lambda e: isinstance(e, MemoryError),
+        on_backoff=lambda b, f: backoffs.append((b, f)),
+    )
+    assert np.array_equal(np.concatenate(kept), expected)
+    assert backoffs == [(2, 800), (1, 800), (1, 400), (1, 200)]
+
+
+def test_run_chunked_reraises_other_errors_and_gives_up_at_minimum():
+    audio_len = 16000 * 20
+
+    def fail(chunks):
+        raise MemoryError
+
+    with pytest.raises(MemoryError):
+        run_chunked(audio_len, fail, seconds_to_frames(10), 1)
+    with pytest.raises(MemoryError):
+        run_chunked(
+            audio_len,
+            fail,
+            seconds_to_frames(10),
+            2,
+            is_out_of_memory=lambda e: True,
+            min_chunk_frames=seconds_to_frames(10),
+        )
@@ -0,0 +1,53 @@
+import numpy as np
+
+from benchmark_alignment import Scenario, build_case
+from lrc_core import align_lines, align_lyrics, build_lrc, prepare_transcript
+from lrc_generator import ADAPTIVE_CONFIDENCE_THRESHOLD, low_confidence_spans
+
+
+def test_line_confidence_drops_where_the_voice_is_masked():
+    case = build_case(Scenario("tiny", 60, 1))
+    clean_lines_data, _ = prepare_transcript(case["lyrics"])
+    args = (clean_lines_data, case["transcript"], case["tokens"])
+    lines, info = align_lines(case["emission"], *args, workers=1)
+    assert min(line["confidence"] for line in lines) > 0.9
+    assert info["confidence"] > 0.9
+
+    # 3 行目の区間を、伴奏で声が埋もれたような平らな出力に置き換える
+    masked = case["emission"].copy()
+    start, end = lines[2]["start"], lines[2]["end"]
+    masked[start:end] = np.log(1 / masked.shape[1])
+    masked_lines, _ = align_lines(masked, *args, workers=1)
+    confidences = [line["confidence"] for line in masked_lines]
+    # 隣の行は境界の文字がずれる程度で、閾値を下回るのは埋もれた行だけ
+    assert confidences[2] < ADAPTIVE_CONFIDENCE_THRESHOLD
+    assert all(
+        c > ADAPTIVE_CONFIDENCE_THRESHOLD for i, c in enumerate(confidences) if i != 2
+    )
+
+
+def test_build_lrc_matches_align_lyrics():
+    case = build_case(Scenario("tiny", 30, 1))
+    clean_lines_data, _ = prepare_transcript(case["lyrics"])
+    args = (clean_lines_data, case["transcript"], case["tokens"])
+    lrc, _ = align_lyrics(case["emission"], 0.02, *args, workers=1)
+    lines, _ = align_lines(case["emission"], *args, workers=1)
+    assert build_lrc(lines, 0.02) == lrc
+    assert lrc.count("\n") == len(lines)
+
+
+def line(start, end, confidence):
+    return {"text": "", "start": start, "end": end, "confidence": confidence}
+
+
+def test_low_confidence_spans_use_neighbouring_confident_lines():
+    lines = [
+        line(100, 200, 0.9),
+        line(210, 300, 0.2),
+        line(290, 350, 0.3),
+        line(400, 500, 0.8),
+        line(520, 600, 0.1),
+    ]
+    assert low_confidence_spans(lines, 0.5, 700) == [(200, 400), (500, 700)]
+    assert low_confidence_spans(lines, 0.05, 700) == []
+    assert low_confidence_spans([line(0, 50, 0.1)], 0.5, 80) == [(0, 80)]
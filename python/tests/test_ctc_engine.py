@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from ctc_engine import emission_parity, parity_ok, token_start_frames
+
+
+def make_emission(starts, num_frames=60, vocab=5, blank_id=0):
+    """tokens[i] が starts[i] フレームから 3 フレーム立つ emission"""
+    probs = np.full((num_frames, vocab), 0.01)
+    probs[:, blank_id] = 1.0
+    for token, start in enumerate(starts, start=1):
+        probs[start : start + 3, token] = 5.0
+    probs /= probs.sum(axis=1, keepdims=True)
+    return np.log(probs).astype(np.float32)
+
+
+def test_token_start_frames():
+    emission = make_emission([10, 25, 40])
+    # 先頭のトークンは先頭の blank を含むので 0 から、以降は立ち上がりの次のフレームから
+    assert list(token_start_frames(emission, [1, 2, 3])) == [0, 26, 41]
+
+
+def test_identical_emissions_pass():
+    emission = make_emission([10, 25, 40])
+    parity = emission_parity(emission, emission.copy(), [1, 2, 3])
+    assert parity["max_prob_diff"] == 0.0 and parity["max_frame_shift"] == 0
+    assert parity_ok(parity, "onnx")
+
+
+def test_shifted_token_fails_even_if_close_in_probability():
+    reference = make_emission([10, 25, 40])
+    shifted = make_emission([10, 30, 40])
+    parity = emission_parity(reference, shifted, [1, 2, 3])
+    assert parity["max_frame_shift"] == 5
+    assert not parity_ok(parity, "onnx-int8")
+
+
+def test_small_noise_is_within_int8_tolerance():
+    reference = make_emission([10, 25, 40])
+    rng = np.random.default_rng(0)
+    noisy = reference + rng.normal(scale=0.01, size=reference.shape).astype(np.float32)
+    parity = emission_parity(reference, noisy)
+    assert "max_frame_shift" not in parity
+    assert parity_ok(parity, "onnx-int8")
+    assert not parity_ok(parity, "onnx")
+
+
+def test_length_mismatch_is_not_comparable():
+    parity = emission_parity(make_emission([10], 60), make_emission([10], 59))
+    assert not parity["comparable"] and not parity_ok(parity, "onnx")
+
+
+def test_onnx_export_roundtrip(tmp_path):
+    pytest.importorskip("onnxruntime")
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from ctc_engine import OnnxCTCModel, export_onnx
+
+    config = transformers.Wav2Vec2Config(
+        vocab_size=8,
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=64,
+        conv_dim=(16,) * 7,
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=2,
+    )
+    torch.manual_seed(0)
+    model = transformers.Wav2Vec2ForCTC(config).eval()
+    path = str(tmp_path / "model.onnx")
+    export_onnx(model, path)
+
+    audio = torch.randn(2, 16000 * 2)
+    mask = torch.ones(audio.shape, dtype=torch.long)
+    with torch.no_grad():
+        expected = model(audio, attention_mask=mask).logits.numpy()
+    onnx_model = OnnxCTCModel(path, config)
+    np.testing.assert_allclose(
+        onnx_model(audio).logits.numpy(), expected, rtol=1e-3, atol=1e-4
+    )
+    assert onnx_model._get_feat_extract_output_lengths([32000]).tolist() == [
+        int(model._get_feat_extract_output_lengths(32000))
+    ]
+
+
+def test_line_frame_shift_gates_the_engine():
+    from benchmark_alignment import VOCAB, Scenario, build_case
+    from ctc_engine import line_frame_shift
+
+    case = build_case(Scenario("parity", 30, 1))
+    emission = case["emission"]
+    assert line_frame_shift(emission, emission.copy(), VOCAB, case["lyrics"]) == 0
+
+    # 出力が 6 フレーム遅れると、LRC の行の位置も同じだけずれる
+    delayed = np.concatenate([np.repeat(emission[:1], 6, axis=0), emission[:-6]])
+    shift = line_frame_shift(emission, delayed, VOCAB, case["lyrics"])
+    assert shift >= 5
+    parity = {"comparable": True, "max_prob_diff": 0.0, "max_line_shift": shift}
+    assert not parity_ok(parity, "onnx-int8")
+    assert not parity_ok({**parity, "max_line_shift": None}, "onnx-int8")
+    assert parity_ok({**parity, "max_line_shift": 1}, "onnx-int8")
+
+
+@pytest.mark.parametrize("norm", ["layer", "group"])
+def test_onnx_parity_runs_a_padded_batch_like_production(tmp_path, norm):
+    ort = pytest.importorskip("onnxruntime")
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    pytest.importorskip("librosa")
+    from types import SimpleNamespace
+
+    from benchmark_alignment import VOCAB
+    from ctc_engine import OnnxCTCModel, check_parity, export_onnx, uses_attention_mask
+    from test_batched_inference import make_tiny_model
+
+    processor, model = make_tiny_model(norm)
+    processor.tokenizer = SimpleNamespace(get_vocab=lambda: VOCAB)
+    path = str(tmp_path / "model.onnx")
+    export_onnx(model, path, attention_mask=uses_attention_mask(processor))
+
+    # group norm (base) のモデルには attention_mask の入力を作らない
+    inputs = [i.name for i in ort.InferenceSession(path).get_inputs()]
+    assert inputs == (["input_values", "attention_mask"] if norm == "layer" else ["input_values"])
+
+    parity = check_parity(model, OnnxCTCModel(path, model.config), processor)
+    assert parity_ok(parity, "onnx"), parity
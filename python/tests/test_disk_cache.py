@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+import pytest
+
+from disk_cache import DiskCache, EmissionCache, StemCache, file_digest
+
+
+def write_bytes(size):
+    def write(path):
+        with open(os.path.join(path, "data.bin"), "wb") as f:
+            f.write(b"\0" * size)
+
+    return write
+
+
+def test_file_digest_depends_on_content_only(tmp_path):
+    a = tmp_path / "a.mp3"
+    b = tmp_path / "b.mp3"
+    a.write_bytes(b"same audio")
+    b.write_bytes(b"same audio")
+    assert file_digest(a) == file_digest(b)
+    b.write_bytes(b"other audio")
+    assert file_digest(a) != file_digest(b)
+
+
+def test_emission_roundtrip_and_stats(tmp_path):
+    cache = EmissionCache(tmp_path)
+    rng = np.random.default_rng(0)
+    emission = np.log(rng.dirichlet(np.ones(32), size=500)).astype(np.float32)
+    key = EmissionCache.key("digest", "model", True)
+
+    assert cache.get(key) is None
+    cache.put(key, emission, 0.02)
+    loaded, seconds_per_frame, skipped = cache.get(key)
+
+    assert loaded.dtype == np.float32 and loaded.shape == emission.shape
+    # ファイルから切り離したメモリ上の配列を返す
+    assert not isinstance(loaded, np.memmap) and loaded.flags.writeable
+    np.testing.assert_allclose(loaded, emission, rtol=1e-3, atol=1e-2)
+    assert seconds_per_frame == 0.02 and skipped is None
+    assert cache.get(EmissionCache.key("digest", "model", False)) is None
+
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["hits"] == 1 and stats["misses"] == 2
+    # float16 で保存するので、元の半分程度のサイズになる
+    assert stats["bytes"] < emission.nbytes
+
+
+def test_emission_keeps_the_ranges_vad_skipped(tmp_path):
+    cache = EmissionCache(tmp_path)
+    emission = np.zeros((500, 8), dtype=np.float32)
+    key = EmissionCache.key("digest", "model", True, vad=True)
+    cache.put(key, emission, 0.02, skipped=[(0, 100), (400, 500)])
+    assert cache.get(key)[2] == [(0, 100), (400, 500)]
+
+def test_lru_eviction_keeps_recently_used(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=250)
+    for i, key in enumerate(["a", "b"]):
+        path = cache.store(key, write_bytes(100))
+        os.utime(path, (i, i))
+
+    # a を参照すると b の方が古くなり、容量超過で b が消える
+    assert cache.lookup("a") is not None
+    cache.store("c", write_bytes(100))
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") is not None and cache.lookup("c") is not None
+
+
+def test_oversized_entry_is_kept_until_next_store(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=50)
+    cache.store("big", write_bytes(100))
+    assert cache.lookup("big") is not None
+    cache.store("next", write_bytes(10))
+    assert cache.lookup("big") is None
+
+
+def test_failed_write_leaves_no_entry(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=1000)
+
+    def write(path):
+        write_bytes(10)(path)
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        cache.store("a", write)
+    assert cache.lookup("a") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_store_keeps_existing_entry(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=1000)
+    first = cache.store("a", write_bytes(10))
+    second = cache.store("a", write_bytes(20))
+    assert first == second
+    assert os.path.getsize(os.path.join(first, "data.bin")) == 10
+    assert [name for name in os.listdir(tmp_path)] == ["a"]
+
+
+def test_purge(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=1000)
+    cache.store("a", write_bytes(10))
+    cache.store("b", write_bytes(10))
+    assert cache.purge() == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_stem_cache_moves_outputs_into_entry(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    vocals = out / "song_(Vocals)_model.mp3"
+    instrumental = out / "song_(Instrumental)_model.mp3"
+    vocals.write_bytes(b"v")
+    instrumental.write_bytes(b"i")
+
+    cache = StemCache(tmp_path / "stems", max_bytes=1000)
+    key = StemCache.key("digest", "UVR-MDX-NET-Voc_FT.onnx")
+    assert cache.get(key) is None
+    stems = cache.put(
+        key, {StemCache.VOCALS: str(vocals), StemCache.INSTRUMENTAL: str(instrumental)}
+    )
+
+    assert not vocals.exists() and not instrumental.exists()
+    assert cache.get(key) == stems
+    with open(stems[StemCache.VOCALS], "rb") as f:
+        assert f.read() == b"v"
+    assert stems[StemCache.INSTRUMENTAL].endswith("instrumental.mp3")
+    assert cache.get(StemCache.key("digest", "other.onnx")) is None
+
+
+def test_stem_cache_keeps_vocal_arrays_losslessly(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    vocals = out / "song_(Vocals)_model.mp3"
+    vocals.write_bytes(b"v")
+    cache = StemCache(tmp_path / "stems", max_bytes=10 * 1024 * 1024)
+    key = StemCache.key("digest", "UVR-MDX-NET-Voc_FT.onnx")
+    cache.put(key, {StemCache.VOCALS: str(vocals)})
+    assert cache.get_array(key, 16000) is None
+
+    array = np.random.default_rng(0).normal(size=16000).astype(np.float32)
+    cache.put_array(key, array, 16000, 16000)
+    loaded, sample_rate = cache.get_array(key, 16000)
+    assert sample_rate == 16000 and loaded.dtype == np.float32
+    assert np.array_equal(loaded, array)
+    # サンプリングレートやチャンネル数の違う配列は別に持つ
+    assert cache.get_array(key, 22050) is None
+    assert cache.get_array(key, 16000, mono=False) is None
+    # 配列はステムのファイルとしては返さない
+    assert set(cache.get(key)) == {StemCache.VOCALS, StemCache.INSTRUMENTAL}
+
+
+def test_stem_cache_budget_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("BADWAVE_STEM_CACHE_MB", "3")
+    assert StemCache(tmp_path).max_bytes == 3 * 1024 * 1024
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hardware import (
+    backend_candidates,
+    inference_precision,
+    is_out_of_memory,
+    usable_cpu_count,
+)
+
+
+def test_backend_candidates_follow_platform_priority():
+    assert backend_candidates("auto", "win32") == ["cuda", "directml", "cpu"]
+    assert backend_candidates("auto", "darwin") == ["coreml", "cpu"]
+    assert backend_candidates("auto", "linux") == ["cuda", "cpu"]
+    assert backend_candidates("auto", "freebsd") == ["cpu"]
+    assert backend_candidates("cpu", "win32") == ["cpu"]
+    with pytest.raises(ValueError):
+        backend_candidates("tpu")
+
+
+def test_half_precision_is_only_used_on_cuda():
+    # CPU や DirectML、ONNX Runtime では fp16 のティアでも fp32 で推論する
+    assert inference_precision("fp32", "cuda") == "fp32"
+    assert inference_precision("fp16", "cpu") == "fp32"
+    assert inference_precision("fp16", "directml") == "fp32"
+    assert inference_precision("fp16", "cuda", engine="onnx") == "fp32"
+
+
+def test_usable_cpu_count():
+    assert usable_cpu_count() >= 1
+
+
+def test_is_out_of_memory():
+    assert is_out_of_memory(MemoryError())
+    assert is_out_of_memory(RuntimeError("CUDA out of memory. Tried to allocate"))
+    assert is_out_of_memory(RuntimeError("Not enough GPU video memory"))
+    assert not is_out_of_memory(ValueError("bad input"))
+
+
+def test_cpu_device_uses_available_cores(monkeypatch):
+    torch = pytest.importorskip("torch")
+    from hardware import select_torch_device
+
+    monkeypatch.setenv("BADWAVE_CPU_THREADS", "1")
+    backend, device = select_torch_device("cpu")
+    assert backend == "cpu" and device.type == "cpu"
+    assert torch.get_num_threads() == 1
+
+
+def test_cpu_device_caps_interop_threads():
+    pytest.importorskip("torch")
+    # inter-op はプロセスで最初の 1 回しか設定できないので、新しいプロセスで確かめる
+    code = (
+        "from hardware import select_torch_device; import torch; "
+        "select_torch_device('cpu'); print(torch.get_num_interop_threads())"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env={**os.environ, "BADWAVE_CPU_THREADS": "2"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert int(result.stdout) == 2
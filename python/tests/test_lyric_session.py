@@ -0,0 +1,114 @@
+from benchmark_alignment import VOCAB, Scenario, build_case
+from lrc_core import align_lyrics, prepare_transcript, tokenize
+from lyric_session import LyricSession
+
+CASE = build_case(Scenario("session", 120, 1))
+
+
+def lyric_lines():
+    return CASE["lyrics"].split("\n")
+
+
+def sung_index(n):
+    """n 番目の (セクション見出しでない) 歌詞行の位置"""
+    return [i for i, line in enumerate(lyric_lines()) if not line.startswith("[")][n]
+
+
+def full_lrc(lyrics):
+    clean_lines_data, padded = prepare_transcript(lyrics)
+    lrc, _ = align_lyrics(
+        CASE["emission"],
+        0.02,
+        clean_lines_data,
+        padded,
+        tokenize(padded, VOCAB),
+        workers=1,
+    )
+    return lrc
+
+
+def open_session(lyrics):
+    return LyricSession.from_lyrics(CASE["emission"], 0.02, VOCAB, lyrics, workers=1)
+
+
+def test_fixing_a_line_realigns_only_its_span():
+    lines = lyric_lines()
+    lines[sung_index(5)] = "Completely wrong words here"
+    session = open_session("\n".join(lines))
+
+    lrc, info = session.update(CASE["lyrics"])
+    assert info["mode"] == "incremental" and info["changed_lines"] == 1
+    assert 0 < info["frames"] < len(CASE["emission"]) // 10
+    assert lrc == full_lrc(CASE["lyrics"])
+
+
+def test_punctuation_only_change_keeps_positions():
+    session = open_session(CASE["lyrics"])
+    before = session.lines
+    lines = lyric_lines()
+    lines[sung_index(2)] += "!"
+    lrc, info = session.update("\n".join(lines))
+    assert info["changed_lines"] == 0 and info["frames"] == 0
+    assert [line["start"] for line in session.lines] == [line["start"] for line in before]
+    assert lines[sung_index(2)] in lrc
+
+
+def test_deleting_and_restoring_a_line():
+    session = open_session(CASE["lyrics"])
+    lines = lyric_lines()
+    del lines[sung_index(3)]
+    lrc, info = session.update("\n".join(lines))
+    assert info["mode"] == "incremental" and info["frames"] == 0
+    assert lrc.count("\n") == len(session.lines)
+
+    lrc, info = session.update(CASE["lyrics"])
+    assert info["mode"] == "incremental" and info["frames"] > 0
+    assert lrc == full_lrc(CASE["lyrics"])
+
+
+def test_worker_session_commands():
+    from lrc_generator import MAX_SESSIONS, ModelCache, handle_request
+
+    models = ModelCache()
+    session_id = models.open_session(open_session(CASE["lyrics"]))
+    result = handle_request(
+        {"command": "update_lyrics", "session_id": session_id, "lyrics": CASE["lyrics"]},
+        models,
+    )
+    assert result["status"] == "success" and result["update"]["changed_lines"] == 0
+
+    handle_request({"command": "close_session", "session_id": session_id}, models)
+    result = handle_request(
+        {"command": "update_lyrics", "session_id": session_id, "lyrics": ""}, models
+    )
+    assert result["status"] == "error"
+
+    ids = [models.open_session(object()) for _ in range(MAX_SESSIONS + 1)]
+    assert ids[0] not in models.sessions and ids[-1] in models.sessions
+
+
+def test_full_realignment_is_left_to_the_scheduler():
+    from lrc_generator import ModelCache, handle_request, update_lyrics_inline
+
+    session = open_session(CASE["lyrics"])
+    lines = lyric_lines()
+    # 隣り合う行の間の区間には収まらないほど長い歌詞を挿入すると、全体をアライメントし直す
+    index = sung_index(3)
+    lines[index:index] = ["a very long inserted line with lots of words to sing"] * 40
+    lyrics = "\n".join(lines)
+    before = session.lrc()
+    assert session.update(lyrics, full=False) is None
+    assert session.lrc() == before
+
+    models = ModelCache()
+    session_id = models.open_session(session)
+    request = {"command": "update_lyrics", "session_id": session_id, "lyrics": lyrics}
+    assert update_lyrics_inline(request, models) is None
+
+    # スケジューラに回した更新が終わるまで、後の更新も差分では処理しない
+    session.enqueue()
+    assert update_lyrics_inline({**request, "lyrics": CASE["lyrics"]}, models) is None
+    result = handle_request({**request, "_queued": True}, models)
+    assert result["status"] == "success" and result["update"]["mode"] == "full"
+    assert session.queued == 0
+    assert update_lyrics_inline({**request, "lyrics": CASE["lyrics"]}, models) is not None
@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+import pytest
+
+from metrics import Metrics, append_metrics, current_rss, stage
+
+
+def test_nested_stages_record_parent_and_peaks():
+    metrics = Metrics()
+    with metrics.stage("inference", batch_size=2):
+        with metrics.stage("inference_batch", chunks=2):
+            block = np.ones(32 * 1024 * 1024, dtype=np.uint8)
+            del block
+    inner, outer = (
+        next(s for s in metrics.stages if s["name"] == name)
+        for name in ("inference_batch", "inference")
+    )
+    assert inner["parent"] == "inference" and inner["chunks"] == 2
+    assert outer["batch_size"] == 2 and "parent" not in outer
+    assert outer["wall_seconds"] >= inner["wall_seconds"] >= 0
+    if current_rss() is not None:
+        # 外側のピークは内側のピークを含む
+        assert outer["peak_rss"] >= inner["peak_rss"] >= inner["rss_start"]
+        if metrics.as_dict()["peak_rss_scope"] == "stage":
+            assert inner["peak_rss"] - inner["rss_start"] >= 16 * 1024 * 1024
+
+
+def test_overlapping_jobs_do_not_reset_each_others_peaks(monkeypatch):
+    import metrics as metrics_module
+
+    resets = []
+    monkeypatch.setattr(metrics_module, "reset_peak_rss", lambda: resets.append(1) or True)
+    first, second = Metrics(), Metrics()
+    resets.clear()
+    with first.stage("separation"):
+        assert len(resets) == 1
+        # 別のジョブのステージはリセットせず、どちらのピークもプロセス全体の値になる
+        with second.stage("alignment"):
+            pass
+        assert len(resets) == 1
+    with first.stage("inference"):
+        pass
+    assert len(resets) == 2
+    scopes = {s["name"]: s["peak_scope"] for s in first.stages + second.stages}
+    assert scopes == {"separation": "process", "alignment": "process", "inference": "stage"}
+
+
+def test_failed_stage_is_marked():
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.stage("decode"):
+            raise ValueError("broken file")
+    assert metrics.stages[0]["status"] == "error"
+    assert "wall_seconds" in metrics.stages[0]
+
+
+def test_stage_without_metrics_is_noop():
+    with stage(None, "alignment") as record:
+        record["device"] = "cpu"
+
+
+def test_append_metrics(tmp_path, monkeypatch):
+    path = tmp_path / "logs" / "metrics.jsonl"
+    monkeypatch.delenv("BADWAVE_METRICS_FILE", raising=False)
+    assert not append_metrics({"status": "success"})
+    assert append_metrics({"status": "success"}, str(path))
+    monkeypatch.setenv("BADWAVE_METRICS_FILE", str(path))
+    assert append_metrics({"status": "error"})
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r["status"] for r in records] == ["success", "error"]
+    assert all("time" in r for r in records)
+
+
+def test_align_lyrics_records_alignment_stages():
+    from benchmark_alignment import Scenario, build_case
+    from lrc_core import align_lyrics, prepare_transcript
+
+    case = build_case(Scenario("tiny", 30, 1))
+    clean_lines_data, _ = prepare_transcript(case["lyrics"])
+    metrics = Metrics()
+    lrc, _ = align_lyrics(
+        case["emission"],
+        0.02,
+        clean_lines_data,
+        case["transcript"],
+        case["tokens"],
+        workers=1,
+        metrics=metrics,
+    )
+    assert lrc.startswith("[by:BadWave AI]")
+    names = [s["name"] for s in metrics.stages]
+    assert names[0] == "alignment" and names[-1] == "lrc_assembly"
+    assert {"trellis", "backtrack"} <= set(names)
+    assert all(
+        s["parent"] == "alignment" for s in metrics.stages if s["name"] == "trellis"
+    )
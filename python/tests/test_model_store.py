@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from model_store import (
+    ModelStore,
+    ModelStoreError,
+    resolve_ctc,
+    resolve_processor,
+    verify_manifest,
+)
+
+
+def write_weights(path):
+    with open(os.path.join(path, "model.safetensors"), "wb") as f:
+        f.write(b"\1" * 1024)
+    os.makedirs(os.path.join(path, "tokenizer"))
+    with open(os.path.join(path, "tokenizer", "vocab.json"), "w") as f:
+        f.write('{"|": 4}')
+
+
+def publish_ctc(store, model_id="org/model", precision="fp32"):
+    info = {"kind": "ctc", "name": model_id, "precision": precision}
+    return store.publish(store.key("ctc", model_id, precision), write_weights, info)
+
+
+def test_key_is_readable():
+    assert ModelStore.key("ctc", "facebook/wav2vec2-base-960h", "fp16") == (
+        "ctc--facebook--wav2vec2-base-960h--fp16"
+    )
+    assert ModelStore.key("separator", "UVR-MDX-NET-Voc_FT.onnx") == (
+        "separator--UVR-MDX-NET-Voc_FT.onnx"
+    )
+
+
+def test_publish_writes_manifest_and_verifies(tmp_path):
+    store = ModelStore(tmp_path)
+    path = publish_ctc(store)
+    assert verify_manifest(path, full=True) == []
+    assert store.ctc_path("org/model") == path
+    assert store.verify() == {store.key("ctc", "org/model", "fp32"): []}
+
+
+def test_checksum_catches_same_size_corruption(tmp_path):
+    store = ModelStore(tmp_path)
+    path = publish_ctc(store)
+    with open(os.path.join(path, "model.safetensors"), "r+b") as f:
+        f.write(b"\2")
+    # 読み込み時のサイズ照合では分からないが、verify の SHA-256 で検出する
+    assert store.ctc_path("org/model") == path
+    assert verify_manifest(path, full=True) == ["model.safetensors: SHA-256 が違います"]
+
+
+def test_truncated_entry_is_removed(tmp_path):
+    store = ModelStore(tmp_path)
+    path = publish_ctc(store)
+    with open(os.path.join(path, "model.safetensors"), "r+b") as f:
+        f.truncate(100)
+    assert store.ctc_path("org/model") is None
+    assert not os.path.exists(path)
+
+
+def test_failed_write_is_not_published(tmp_path):
+    store = ModelStore(tmp_path)
+
+    def interrupted(path):
+        write_weights(path)
+        raise ConnectionError("download interrupted")
+
+    with pytest.raises(ConnectionError):
+        store.publish(store.key("ctc", "org/model", "fp32"), interrupted, {})
+    assert store.entries() == []
+
+
+def test_resolve_falls_back_to_full_precision(tmp_path):
+    store = ModelStore(tmp_path)
+    path = publish_ctc(store, precision="fp32")
+    assert resolve_ctc("org/model", "fp16", store) == path
+    assert resolve_processor("org/model", store) == path
+
+
+def test_rounded_weights_are_only_used_offline(tmp_path, monkeypatch):
+    store = ModelStore(tmp_path)
+    path = publish_ctc(store, precision="fp16")
+    fetched = []
+    monkeypatch.setattr(store, "prefetch_ctc", lambda *args: fetched.append(args) or "fetched")
+    # fp32 で推論するときに fp16 に丸めた重みを使うと結果が変わるので、取得し直す
+    monkeypatch.delenv("BADWAVE_OFFLINE", raising=False)
+    assert resolve_ctc("org/model", "fp32", store) == "fetched"
+    assert fetched == [("org/model", "fp32")]
+    monkeypatch.setenv("BADWAVE_OFFLINE", "1")
+    assert resolve_ctc("org/model", "fp32", store) == path
+
+
+def test_offline_mode_never_fetches(tmp_path, monkeypatch):
+    monkeypatch.setenv("BADWAVE_OFFLINE", "1")
+    store = ModelStore(tmp_path)
+    with pytest.raises(ModelStoreError):
+        resolve_ctc("org/missing", "fp32", store)
+    with pytest.raises(ModelStoreError):
+        resolve_processor("org/missing", store)
+    with pytest.raises(ModelStoreError):
+        store.prefetch_separator("missing.onnx")
+
+
+def test_online_processor_falls_back_to_hub_id(tmp_path, monkeypatch):
+    monkeypatch.delenv("BADWAVE_OFFLINE", raising=False)
+    assert resolve_processor("org/missing", ModelStore(tmp_path)) == "org/missing"
@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUILD_SCRIPT = os.path.join(os.path.dirname(PYTHON_DIR), "scripts", "build-python.js")
+# Electron から起動するエントリポイント
+ENTRY_POINTS = ("lrc_generator", "vocal_separator", "batch_lrc")
+
+COPY = "require({script}).copyPythonScripts({src}, {dest})"
+
+PROBE = """
+import importlib, json
+try:
+    importlib.import_module({module!r})
+    print(json.dumps(None))
+except ModuleNotFoundError as e:
+    print(json.dumps(e.name))
+"""
+
+
+def package_scripts(dest):
+    node = shutil.which("node")
+    if node is None:
+        pytest.skip("node がありません")
+    code = COPY.format(
+        script=json.dumps(BUILD_SCRIPT), src=json.dumps(PYTHON_DIR), dest=json.dumps(dest)
+    )
+    subprocess.run([node, "-e", code], check=True)
+
+
+def missing_module(directory, module):
+    """directory だけを置いた状態で module を import し、見つからなかったモジュール名を返す"""
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONPATH"}
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        cwd=directory,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def test_packaged_entry_points_find_their_modules(tmp_path):
+    dest = str(tmp_path / "python-dist")
+    package_scripts(dest)
+    packaged = {name[:-3] for name in os.listdir(dest) if name.endswith(".py")}
+    assert set(ENTRY_POINTS) <= packaged
+    assert not any(name.startswith(("test_", "benchmark_")) for name in packaged)
+
+    local = {name[:-3] for name in os.listdir(PYTHON_DIR) if name.endswith(".py")}
+    for module in ENTRY_POINTS:
+        # 依存パッケージ (audio_separator など) がこの環境にないのはよいが、
+        # このリポジトリのモジュールが配布に含まれていないのはビルドの誤り
+        missing = missing_module(dest, module)
+        assert missing is None or missing.split(".")[0] not in local, (module, missing)
@@ -0,0 +1,58 @@
+import pytest
+
+from provider_probe import (
+    forget_probe,
+    hardware_fingerprint,
+    load_probe,
+    save_probe,
+    working_backends,
+)
+
+KEY = {
+    "format": 1,
+    "onnxruntime": "1.17.0",
+    "available": ["CPUExecutionProvider"],
+    "hardware": "x",
+}
+
+
+def test_saved_probe_is_used_only_with_the_same_key(tmp_path):
+    path = str(tmp_path / "probe" / "providers.json")
+    assert load_probe(path, KEY) is None
+
+    save_probe(path, KEY, ["cuda", "cpu"])
+    assert load_probe(path, KEY) == ["cuda", "cpu"]
+    assert load_probe(path, {**KEY, "onnxruntime": "1.18.0"}) is None
+    assert load_probe(path, {**KEY, "hardware": "y"}) is None
+    # 一時ファイルは残らない
+    assert [p.name for p in (tmp_path / "probe").iterdir()] == ["providers.json"]
+
+    forget_probe(path)
+    assert load_probe(path, KEY) is None
+
+
+def test_broken_probe_file_is_ignored(tmp_path):
+    path = tmp_path / "providers.json"
+    path.write_text("{not json")
+    assert load_probe(str(path), KEY) is None
+    path.write_text('{"key": null, "backends": ["cpu"]}')
+    assert load_probe(str(path), None) == ["cpu"]
+
+
+def test_hardware_fingerprint_follows_visible_devices(monkeypatch):
+    monkeypatch.setenv("CUDA_VISIBLE_DEVICES", "0")
+    first = hardware_fingerprint()
+    assert hardware_fingerprint() == first
+    monkeypatch.setenv("CUDA_VISIBLE_DEVICES", "1")
+    assert hardware_fingerprint() != first
+
+
+def test_working_backends_probes_once(tmp_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    path = str(tmp_path / "providers.json")
+    backends = working_backends(path=path)
+    assert "cpu" in backends
+    assert (tmp_path / "providers.json").exists()
+    assert working_backends(path=path) == backends
+    assert working_backends(refresh=True, path=path) == backends
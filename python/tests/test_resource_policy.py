@@ -0,0 +1,98 @@
+import pytest
+
+import resource_policy
+from hardware import (
+    BYTES_PER_AUDIO_SECOND,
+    MIN_CHUNK_SECONDS,
+    UNKNOWN_MEMORY_BATCH_SIZE,
+    choose_batch_size,
+    choose_chunk_seconds,
+    memory_budget,
+)
+from resource_policy import ResourceGovernor, get_profile, thread_budget
+
+
+@pytest.fixture(autouse=True)
+def clean_environment(monkeypatch):
+    for name in ("BADWAVE_CPU_THREADS", "BADWAVE_PROFILE", "BADWAVE_MEMORY_LIMIT_MB"):
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_thread_budget_leaves_cores_for_playback(monkeypatch):
+    foreground, background = get_profile("foreground"), get_profile("background")
+    assert thread_budget(foreground, cpus=8) == 7
+    assert thread_budget(background, cpus=8) == 2
+    assert thread_budget(foreground, cpus=1) == thread_budget(background, cpus=1) == 1
+
+    monkeypatch.setenv("BADWAVE_CPU_THREADS", "3")
+    assert thread_budget(background, cpus=8) == 3
+
+
+def test_get_profile(monkeypatch):
+    assert get_profile().name == "foreground"
+    monkeypatch.setenv("BADWAVE_PROFILE", "background")
+    assert get_profile().name == "background"
+    with pytest.raises(ValueError):
+        get_profile("turbo")
+
+
+def test_memory_ceiling_shrinks_chunks_and_batches():
+    # 12 秒分のメモリしかなければ、チャンクは 12 秒、バッチは 1 つになる
+    limit = BYTES_PER_AUDIO_SECOND * 12
+    assert choose_chunk_seconds("cpu", 30, memory_limit=limit) == 12
+    assert choose_batch_size("cpu", 12, memory_limit=limit) == 1
+    assert choose_chunk_seconds("cpu", 30, memory_limit=1) == MIN_CHUNK_SECONDS
+    assert choose_batch_size("cpu", 10, memory_limit=BYTES_PER_AUDIO_SECOND * 25) == 2
+
+    # 空きメモリが分からないデバイスでは、上限があればそれを使う
+    assert memory_budget("privateuseone", memory_limit=limit) == limit
+    assert choose_batch_size("privateuseone", 10) == UNKNOWN_MEMORY_BATCH_SIZE
+
+
+def test_governor_follows_the_most_permissive_running_job(monkeypatch):
+    applied = []
+    monkeypatch.setattr(resource_policy, "apply_threads", applied.append)
+    monkeypatch.setattr(resource_policy, "usable_cpu_count", lambda: 8)
+
+    governor = ResourceGovernor("background")
+    assert applied == [2]
+    with governor.job("background"):
+        with governor.job("foreground") as profile:
+            assert profile.name == "foreground"
+            assert governor.threads == 7
+        assert governor.stats()["active"] == ["background"]
+        assert governor.threads == 2
+    assert applied == [2, 7, 2]
+
+
+def test_request_profile():
+    from lrc_generator import request_key, request_profile
+
+    assert request_profile({}) is None
+    assert request_profile({"priority": "background"}) == "background"
+    assert request_profile({"priority": "background", "profile": "foreground"}) == "foreground"
+    # プロファイルだけが違うリクエストは同じ結果なのでまとめる
+    assert request_key({"audio_path": __file__, "profile": "background"}) == request_key(
+        {"audio_path": __file__}
+    )
+
+
+def test_ort_thread_limit_is_installed_once(monkeypatch):
+    ort = pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    from provider_probe import _identity_model
+
+    monkeypatch.setattr(resource_policy, "thread_limit", lambda: 2)
+    resource_policy.limit_ort_threads()
+    patched = ort.InferenceSession.__init__
+    resource_policy.limit_ort_threads()
+    assert ort.InferenceSession.__init__ is patched
+
+    model = _identity_model()
+    session = ort.InferenceSession(model, providers=["CPUExecutionProvider"])
+    assert session.get_session_options().intra_op_num_threads == 2
+    # 呼び出し側が指定したスレッド数はそのまま使う
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = 3
+    session = ort.InferenceSession(model, options, providers=["CPUExecutionProvider"])
+    assert session.get_session_options().intra_op_num_threads == 3
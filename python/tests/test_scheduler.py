@@ -0,0 +1,247 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from scheduler import JobScheduler, priority_value
+
+TIMEOUT = 10
+
+
+class Recorder:
+    """ジョブが資源を取った順序と、各ジョブの結果を記録する"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.results = {}
+
+    def job(self, name, resource, release=None, runs=None):
+        def run(acquire):
+            if runs is not None:
+                runs.append(name)
+            with acquire(resource):
+                with self.lock:
+                    self.events.append(("start", name))
+                if release is not None:
+                    assert release.wait(TIMEOUT)
+                with self.lock:
+                    self.events.append(("end", name))
+            return {"status": "success", "name": name}
+
+        return run
+
+    def callback(self, name):
+        def callback(result):
+            with self.lock:
+                self.results.setdefault(name, []).append(result)
+
+        return callback
+
+    def started(self):
+        with self.lock:
+            return [name for kind, name in self.events if kind == "start"]
+
+
+def wait_until(predicate):
+    for _ in range(TIMEOUT * 100):
+        if predicate():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("timed out")
+
+
+def test_device_jobs_run_one_at_a_time_but_cpu_runs_alongside():
+    scheduler = JobScheduler({"device": 1, "cpu": 1})
+    rec = Recorder()
+    gate = threading.Event()
+    scheduler.submit(rec.job("a", "device", gate), rec.callback("a"))
+    wait_until(lambda: rec.started() == ["a"])
+    scheduler.submit(rec.job("b", "device"), rec.callback("b"))
+    scheduler.submit(rec.job("c", "cpu"), rec.callback("c"))
+    wait_until(lambda: "c" in rec.results)
+    assert "b" not in rec.started()
+
+    gate.set()
+    assert scheduler.wait(TIMEOUT)
+    assert rec.started() == ["a", "c", "b"]
+    assert rec.results["b"][0]["queue_seconds"] >= 0
+
+
+def test_interactive_job_jumps_ahead_of_background():
+    scheduler = JobScheduler({"device": 1})
+    rec = Recorder()
+    gate = threading.Event()
+    scheduler.submit(rec.job("running", "device", gate), rec.callback("running"))
+    wait_until(lambda: rec.started() == ["running"])
+    for i in range(3):
+        scheduler.submit(
+            rec.job(f"backfill{i}", "device"), rec.callback(i), priority="background"
+        )
+    wait_until(lambda: scheduler.stats()["waiting"] == 3)
+    scheduler.submit(rec.job("user", "device"), rec.callback("user"), priority="interactive")
+    wait_until(lambda: scheduler.stats()["waiting"] == 4)
+
+    gate.set()
+    assert scheduler.wait(TIMEOUT)
+    assert rec.started() == ["running", "user", "backfill0", "backfill1", "backfill2"]
+
+
+def test_identical_requests_are_coalesced():
+    scheduler = JobScheduler()
+    rec = Recorder()
+    gate = threading.Event()
+    runs = []
+    assert not scheduler.submit(
+        rec.job("song", "device", gate, runs), rec.callback("first"), key="song"
+    )
+    assert scheduler.submit(
+        rec.job("song", "device", gate, runs), rec.callback("second"), key="song"
+    )
+    gate.set()
+    assert scheduler.wait(TIMEOUT)
+    assert runs == ["song"]
+    assert rec.results["first"] == rec.results["second"]
+
+    # 終わったジョブとは合流しない
+    assert not scheduler.submit(rec.job("song", "device"), rec.callback("third"), key="song")
+    assert scheduler.wait(TIMEOUT)
+
+
+def test_memory_budget_holds_back_jobs_that_do_not_fit():
+    scheduler = JobScheduler({"device": 1, "cpu": 3}, memory_budget={"cpu": 100})
+    rec = Recorder()
+    gate = threading.Event()
+    scheduler.submit(rec.job("big", "cpu", gate), rec.callback("big"), memory={"cpu": 80})
+    wait_until(lambda: rec.started() == ["big"])
+    scheduler.submit(rec.job("wide", "cpu"), rec.callback("w"), memory={"cpu": 50})
+    scheduler.submit(rec.job("small", "cpu"), rec.callback("s"), memory={"cpu": 10})
+    wait_until(lambda: scheduler.stats()["waiting"] == 2)
+    # small は収まるが、先に待っている wide を追い越さない
+    assert rec.started() == ["big"]
+
+    # big が終われば wide と small は一緒に収まるので、どちらが先に動き出すかは決まらない
+    gate.set()
+    assert scheduler.wait(TIMEOUT)
+    assert rec.started()[0] == "big"
+    assert sorted(rec.started()[1:]) == ["small", "wide"]
+
+    # 何も実行していなければ、予算を超えるジョブも実行する
+    scheduler.submit(rec.job("huge", "device"), rec.callback("h"), memory={"device": 500})
+    assert scheduler.wait(TIMEOUT)
+    assert "huge" in rec.started()
+
+
+def test_device_and_host_memory_are_budgeted_separately():
+    budgets = []
+
+    def budget():
+        budgets.append(1)
+        return {"device": 100, "cpu": 1000}
+
+    scheduler = JobScheduler({"device": 2, "cpu": 1}, memory_budget=budget)
+    assert scheduler.memory_budget is None
+    rec = Recorder()
+    cpu_gate, device_gate = threading.Event(), threading.Event()
+    scheduler.submit(rec.job("align", "cpu", cpu_gate), rec.callback("a"), memory={"cpu": 900})
+    wait_until(lambda: rec.started() == ["align"])
+    # ホストのメモリを使い切っていても、GPU のジョブは VRAM の予算で判断する
+    scheduler.submit(
+        rec.job("gpu1", "device", device_gate), rec.callback("g1"), memory={"device": 80}
+    )
+    wait_until(lambda: rec.started() == ["align", "gpu1"])
+    # VRAM が足りない GPU のジョブは、同時実行数に空きがあっても待つ
+    scheduler.submit(rec.job("gpu2", "device"), rec.callback("g2"), memory={"device": 80})
+    wait_until(lambda: scheduler.stats()["waiting"] == 1)
+    assert rec.started() == ["align", "gpu1"]
+    assert scheduler.stats()["memory_in_use"] == {"device": 80, "cpu": 900}
+
+    device_gate.set()
+    cpu_gate.set()
+    assert scheduler.wait(TIMEOUT)
+    assert rec.started()[-1] == "gpu2"
+    # 予算は最初に資源を確保するときに 1 回だけ調べる
+    assert budgets == [1] and scheduler.memory_budget == {"device": 100, "cpu": 1000}
+
+
+def test_memory_blocked_job_only_holds_back_its_own_resource():
+    scheduler = JobScheduler({"device": 2, "cpu": 1}, memory_budget={"device": 100})
+    rec = Recorder()
+    gate = threading.Event()
+    scheduler.submit(rec.job("sep1", "device", gate), rec.callback("s1"), memory={"device": 80})
+    wait_until(lambda: rec.started() == ["sep1"])
+    scheduler.submit(rec.job("sep2", "device"), rec.callback("s2"), memory={"device": 80})
+    wait_until(lambda: scheduler.stats()["waiting"] == 1)
+    # VRAM を待つ分離のジョブがあっても、後から来た CPU だけのアライメントは先に進む
+    scheduler.submit(rec.job("align", "cpu"), rec.callback("a"))
+    wait_until(lambda: "a" in rec.results)
+    assert rec.started() == ["sep1", "align"]
+
+    gate.set()
+    assert scheduler.wait(TIMEOUT)
+    assert rec.started()[-1] == "sep2"
+
+
+def test_budget_is_resolved_without_blocking_stats():
+    probing, release = threading.Event(), threading.Event()
+
+    def budget():
+        # torch の読み込みとメモリの問い合わせに時間がかかる場合
+        probing.set()
+        assert release.wait(TIMEOUT)
+        return {"device": 100}
+
+    scheduler = JobScheduler(memory_budget=budget)
+    rec = Recorder()
+    scheduler.submit(rec.job("gpu", "device"), rec.callback("g"), memory={"device": 10})
+    assert probing.wait(TIMEOUT)
+
+    answered = threading.Event()
+    threading.Thread(target=lambda: (scheduler.stats(), answered.set()), daemon=True).start()
+    assert answered.wait(TIMEOUT)
+
+    release.set()
+    assert scheduler.wait(TIMEOUT)
+    assert rec.started() == ["gpu"] and scheduler.memory_budget == {"device": 100}
+
+
+def test_job_errors_are_reported():
+    scheduler = JobScheduler()
+    results = []
+
+    def fail(acquire):
+        with acquire("gpu"):
+            pass
+
+    scheduler.submit(fail, results.append)
+    assert scheduler.wait(TIMEOUT)
+    assert results[0]["status"] == "error"
+    with pytest.raises(ValueError):
+        priority_value("urgent")
+
+
+def test_worker_routes_requests_through_the_scheduler(tmp_path):
+    audio = tmp_path / "song.mp3"
+    audio.write_bytes(b"\0" * 1024)
+    requests = [
+        {"id": 1, "command": "generate", "audio_path": str(audio), "lyrics": ""},
+        {"id": 2, "command": "ping"},
+        {"id": 3, "command": "generate", "audio_path": str(audio), "priority": "urgent"},
+        {"id": 4, "command": "shutdown"},
+    ]
+    script = os.path.join(os.path.dirname(os.path.dirname(__file__)), "lrc_generator.py")
+    proc = subprocess.run(
+        [sys.executable, script, "--server", "--no-cache"],
+        input="".join(json.dumps(r) + "\n" for r in requests),
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    responses = {r["id"]: r for r in map(json.loads, proc.stdout.splitlines())}
+    assert responses[1]["status"] == "error"
+    assert responses[2]["status"] == "success" and "scheduler" in responses[2]
+    assert "優先度" in responses[3]["message"]
+    assert responses[4]["status"] == "success"
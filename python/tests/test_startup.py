@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+# 軽量な部分 (歌詞の前処理・アライメント・ワーカーの起動) の import にかける時間の上限 (秒)
+IMPORT_BUDGET_SECONDS = 1.0
+# 起動時に読み込んではいけない重いモジュール
+HEAVY_MODULES = ("torch", "torch_directml", "transformers", "librosa", "audio_separator")
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def cold_import(module):
+    """新しいプロセスで module を import し、(秒数, 読み込まれたモジュール) を返す"""
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        cwd=PYTHON_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    report = json.loads(result.stdout)
+    return report["seconds"], set(report["modules"])
+
+
+def test_lightweight_imports_skip_heavy_modules():
+    for module in ("lrc_core", "lrc_generator", "batch_lrc"):
+        _, loaded = cold_import(module)
+        assert not loaded & set(HEAVY_MODULES), module
+
+
+def test_import_time_budget():
+    # 初回はバイトコードのコンパイルやディスクキャッシュの影響を受けるので最小値で見る
+    for module in ("lrc_core", "lrc_generator"):
+        seconds = min(cold_import(module)[0] for _ in range(3))
+        assert seconds < IMPORT_BUDGET_SECONDS, f"{module}: {seconds:.2f}s"
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+from disk_cache import EmissionCache
+from streaming_separation import OverlapAdd
+
+
+def windows(signal, window, overlap):
+    step = window - overlap
+    starts = range(0, len(signal), step)
+    for start in starts:
+        stop = min(start + window, len(signal))
+        yield signal[start:stop], stop == len(signal)
+        if stop == len(signal):
+            break
+
+
+def overlap_add(signal, window, overlap, process=lambda w, k: w):
+    joined = OverlapAdd(overlap)
+    out = [
+        joined.push(process(w, k), last)
+        for k, (w, last) in enumerate(windows(signal, window, overlap))
+    ]
+    return np.concatenate(out)
+
+
+def test_overlap_add_reassembles_the_signal():
+    signal = np.random.default_rng(0).standard_normal((1000, 2)).astype(np.float32)
+    for window, overlap in [(100, 20), (300, 1), (999, 50), (2000, 10)]:
+        np.testing.assert_allclose(overlap_add(signal, window, overlap), signal, atol=1e-6)
+
+
+def test_overlap_add_crossfades_between_windows():
+    signal = np.ones(250, dtype=np.float32)
+    # 偶数番目のウィンドウは 0、奇数番目は 1 にする
+    out = overlap_add(signal, 100, 20, lambda w, k: w * (k % 2))
+    assert len(out) == 250
+    np.testing.assert_array_equal(out[:80], 0)
+    # 重なりの区間 [80, 100) で 0 から 1 に単調に変わる
+    fade = out[80:100]
+    assert np.all(np.diff(fade) > 0) and 0 < fade[0] < 0.1 and 0.9 < fade[-1] < 1
+    np.testing.assert_array_equal(out[100:160], 1)
+
+
+def test_streaming_separation_matches_whole_file_and_stays_bounded(tmp_path):
+    soundfile = pytest.importorskip("soundfile")
+    pytest.importorskip("soxr")
+    from audio_io import load_audio
+    from streaming_separation import StreamingSeparation
+
+    source_sr = 44100
+    t = np.arange(source_sr * 40) / source_sr
+    stereo = np.stack(
+        [0.3 * np.sin(2 * np.pi * 220 * t), 0.3 * np.sin(2 * np.pi * 330 * t)], axis=1
+    ).astype(np.float32)
+    path = tmp_path / "live.flac"
+    soundfile.write(path, stereo, source_sr)
+
+    calls = []
+
+    def separate_window(window):
+        # 分離モデルの代わりに入力をそのまま返す (ステレオ、モデルのサンプリングレート)
+        assert window.ndim == 2 and window.shape[1] == 2
+        calls.append(len(window))
+        return window
+
+    stream = StreamingSeparation(
+        str(path), separate_window, source_sr, window_seconds=6, overlap_seconds=1
+    )
+    expected = load_audio(str(path))
+    assert len(stream) == len(expected)
+
+    # 先頭だけを読んだ時点では、最初のウィンドウしか分離しない
+    stream[:16000]
+    assert len(calls) == 1
+
+    block = 16000 * 5
+    held = []
+    pieces = []
+    for start in range(0, len(stream), block):
+        pieces.append(stream[start : start + block])
+        stream.release(start + block)
+        held.append(stream.held_samples())
+    stream.close()
+
+    np.testing.assert_allclose(np.concatenate(pieces), expected, atol=1e-3)
+    assert stream.windows == len(calls) == 8
+    # 保持するサンプルは曲の長さによらず、ウィンドウ数個分に収まる
+    assert max(held) < 3 * 6 * source_sr
+
+
+def test_emission_cache_key_with_stream():
+    args = ("digest", "model", "UVR-MDX-NET-Voc_FT.onnx")
+    assert EmissionCache.key(*args) == EmissionCache.key(*args, stream=False)
+    assert EmissionCache.key(*args, stream=True) != EmissionCache.key(*args)
+
+
+@pytest.mark.parametrize(
+    "streamed, separated, expected",
+    [
+        (True, True, {"stream": True}),
+        # ストリーミング分離を使えず、ファイル単位で分離した
+        (False, True, {"vad": True}),
+        # 分離そのものに失敗して、元音源で推論した
+        (False, False, {"separation": None}),
+    ],
+)
+def test_emission_is_cached_under_the_path_that_ran(
+    tmp_path, monkeypatch, streamed, separated, expected
+):
+    import types
+
+    import lrc_generator
+    from disk_cache import file_digest
+    from tiers import get_tier
+
+    audio = tmp_path / "live.flac"
+    audio.write_bytes(b"\0" * 1024)
+    emission = np.zeros((10, 4), dtype=np.float32)
+
+    def infer(*args):
+        args[9]["streamed_separation"] = streamed
+        return emission, 0.02, separated, None
+
+    monkeypatch.setattr(lrc_generator, "_infer_track_emission", infer)
+    cache = EmissionCache(str(tmp_path / "cache"))
+    tier = get_tier()
+    job = {}
+    lrc_generator._track_emission(
+        str(audio),
+        tier.separator_model,
+        tier,
+        types.SimpleNamespace(engine="torch"),
+        None,
+        cache,
+        None,
+        "cpu",
+        True,
+        None,
+        job,
+        stream_separation=True,
+    )
+    assert job["emission_cache_hit"] is False
+    fields = {"separation": tier.separator_model, "vad": False, "stream": False}
+    fields.update(expected)
+    key = EmissionCache.key(
+        file_digest(str(audio)),
+        tier.aligner_model,
+        fields["separation"],
+        tier.precision,
+        "torch",
+        vad=fields["vad"],
+        stream=fields["stream"],
+    )
+    assert cache.get(key) is not None
@@ -0,0 +1,34 @@
+import pytest
+
+from evaluate_tiers import line_errors, parse_lrc, summarize
+from tiers import DEFAULT_TIER, TIERS, get_tier
+
+
+def test_get_tier():
+    assert get_tier().name == DEFAULT_TIER
+    assert get_tier("fast").separator_model is None
+    assert get_tier(TIERS["balanced"]) is TIERS["balanced"]
+    with pytest.raises(ValueError):
+        get_tier("ultra")
+
+
+def test_parse_lrc_skips_tags():
+    lrc = "[by:BadWave AI]\n[00:01.50]Hello world\n[01:02.25]Bad wave\n"
+    assert parse_lrc(lrc) == [(1.5, "Hello world"), (62.25, "Bad wave")]
+
+
+def test_line_errors_matches_lines_in_order():
+    reference = [(1.0, "A"), (2.0, "B"), (3.0, "A"), (4.0, "C")]
+    generated = [(1.1, "A"), (2.5, "B"), (2.9, "A")]
+    errors, missing = line_errors(generated, reference)
+    assert errors == pytest.approx([0.1, 0.5, 0.1])
+    assert missing == 1
+
+
+def test_summarize():
+    summary = summarize([0.1, 0.2, 0.5, 1.0], 1, [3.0, 1.0, 2.0])
+    assert summary["lines"] == 4 and summary["missing_lines"] == 1
+    assert summary["median_abs_error"] == pytest.approx(0.35)
+    assert summary["within_0.3s"] == 0.5
+    assert summary["wall_time_median"] == 2.0
+    assert summarize([], 0, [])["mean_abs_error"] is None
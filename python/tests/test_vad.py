@@ -0,0 +1,101 @@
+import numpy as np
+
+from alignment import align, merge_repeats
+from benchmark_alignment import Scenario, build_case
+from disk_cache import EmissionCache
+from lrc_core import align_lyrics, prepare_transcript
+from vad import (
+    KEEP_SKIPPED_FRAMES,
+    compress_skipped,
+    expand_path,
+    skipped_ranges,
+    skipped_rows,
+    vocal_regions,
+)
+
+SR = 16000
+HOP = 320
+
+
+def tone(seconds, amplitude=0.3):
+    t = np.arange(int(seconds * SR)) / SR
+    return (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+
+def silence(seconds):
+    rng = np.random.default_rng(0)
+    return (1e-5 * rng.standard_normal(int(seconds * SR))).astype(np.float32)
+
+
+def test_vocal_regions_skip_intro_and_interlude():
+    audio = np.concatenate([silence(10), tone(20), silence(15), tone(20), silence(5)])
+    num_frames = len(audio) // HOP
+    regions = vocal_regions(audio, HOP, num_frames, SR)
+    assert len(regions) == 2
+    (s1, e1), (s2, e2) = regions
+    # 有声区間の前後に 0.5 秒 (25 フレーム) の余白が付く
+    assert s1 == 10 * 50 - 25 and e1 == 30 * 50 + 25
+    assert s2 == 45 * 50 - 25 and e2 == 65 * 50 + 25
+
+
+def test_vocal_regions_none_without_long_silence():
+    audio = np.concatenate([tone(20), silence(1), tone(20)])
+    assert vocal_regions(audio, HOP, len(audio) // HOP, SR) is None
+    # ほぼ無音 (検出の失敗) も全体を推論する
+    assert vocal_regions(silence(30), HOP, 30 * 50, SR) is None
+
+
+def test_compress_and_expand_roundtrip():
+    rng = np.random.default_rng(0)
+    emission = np.log(rng.dirichlet(np.ones(8), size=300)).astype(np.float32)
+    emission[50:250] = skipped_rows(200, 8)
+    skipped = skipped_ranges([(0, 50), (250, 300)], 300)
+    assert skipped == [(50, 250)]
+    compressed, kept = compress_skipped(emission, skipped)
+    assert len(compressed) == 300 - (200 - 2 * KEEP_SKIPPED_FRAMES)
+    np.testing.assert_array_equal(emission[kept], compressed)
+    assert compress_skipped(emission[:60], skipped)[1] is None
+
+
+def test_blank_rows_are_only_compressed_where_vad_ran():
+    # 元音源の推論やキャッシュした emission にも、blank だけの行が長く続くことはある
+    emission = np.concatenate([skipped_rows(200, 8), skipped_rows(200, 8)])
+    assert compress_skipped(emission, None)[1] is None
+    _, kept = compress_skipped(emission, [(200, 400)])
+    assert kept[0] == 0 and len(kept) == 200 + 2 * KEEP_SKIPPED_FRAMES
+
+
+def test_compressed_alignment_matches_full_alignment():
+    case = build_case(Scenario("tiny", 30, 1))
+    emission, tokens = case["emission"], case["tokens"]
+    vocab = emission.shape[1]
+    # イントロ・アウトロの無音を推論せずに埋めた emission
+    padded = np.concatenate(
+        [skipped_rows(600, vocab), emission, skipped_rows(400, vocab)]
+    )
+    expected = align(padded, tokens)
+    skipped = [(0, 600), (len(padded) - 400, len(padded))]
+    compressed, kept = compress_skipped(padded, skipped)
+    path = expand_path(align(compressed, tokens), kept)
+    # 詰めた区間に掛かるトークンの終わり以外 (LRC が使う開始位置) は全体で計算した場合と同じ
+    segments = merge_repeats(path, case["transcript"])
+    expected_segments = merge_repeats(expected, case["transcript"])
+    np.testing.assert_array_equal(segments.label, expected_segments.label)
+    np.testing.assert_array_equal(segments.start, expected_segments.start)
+
+    clean_lines_data, _ = prepare_transcript(case["lyrics"])
+    _, info = align_lyrics(
+        padded, 0.02, clean_lines_data, case["transcript"], tokens, workers=1, skipped=skipped
+    )
+    assert info["skipped_frames"] == 1000 - 4 * KEEP_SKIPPED_FRAMES
+    # 飛ばした区間を渡さなければ (VAD を実行していなければ) 詰めない
+    _, info = align_lyrics(
+        padded, 0.02, clean_lines_data, case["transcript"], tokens, workers=1
+    )
+    assert "skipped_frames" not in info
+
+
+def test_emission_cache_key_with_vad():
+    args = ("digest", "model", "UVR", "fp16", "torch")
+    assert EmissionCache.key(*args) == EmissionCache.key(*args, vad=False)
+    assert EmissionCache.key(*args, vad=True) != EmissionCache.key(*args)
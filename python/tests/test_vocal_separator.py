@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("audio_separator")
+pytest.importorskip("librosa")
+
+from metrics import Metrics
+from vocal_separator import capture_stems, stem_to_array
+
+
+class FakeModel:
+    sample_rate = 44100
+
+    def __init__(self):
+        self.written = []
+
+    def final_process(self, stem_path, source, stem_name):
+        self.written.append(stem_path)
+        return {stem_name: source}
+
+    def separate(self, audio_file_path):
+        stereo = np.ones((self.sample_rate, 2), dtype=np.float32)
+        self.final_process("out_(Instrumental).mp3", -stereo, "Instrumental")
+        self.final_process("out_(Vocals).mp3", stereo, "Vocals")
+        return ["out_(Instrumental).mp3", "out_(Vocals).mp3"]
+
+
+class FakeSeparator:
+    def __init__(self):
+        self.model_instance = FakeModel()
+
+    def separate(self, audio_file_path):
+        return self.model_instance.separate(audio_file_path)
+
+
+@pytest.mark.parametrize("write_files", [True, False])
+def test_capture_stems(write_files):
+    separator = FakeSeparator()
+    with capture_stems(separator, write_files) as captured:
+        separator.separate("song.mp3")
+
+    assert set(captured) == {"Vocals", "Instrumental"}
+    assert captured["Vocals"].shape == (44100, 2)
+    assert len(separator.model_instance.written) == (2 if write_files else 0)
+    # 差し替えはブロックを抜けると元に戻る
+    assert "final_process" not in vars(separator.model_instance)
+
+
+def test_stem_to_array_resamples_to_mono():
+    stereo = np.stack(
+        [np.full(44100, 0.2), np.full(44100, 0.4)], axis=1
+    ).astype(np.float32)
+    y = stem_to_array(stereo, 44100, sr=16000)
+    assert y.dtype == np.float32 and y.ndim == 1
+    assert abs(len(y) - 16000) <= 1
+    np.testing.assert_allclose(y[1000:-1000], 0.3, atol=1e-3)
+
+
+class FileWritingModel(FakeModel):
+    """ステムをファイル (中身はダミー) に書き出すモデル"""
+
+    def __init__(self, output_dir):
+        super().__init__()
+        self.output_dir = output_dir
+        self.separations = 0
+
+    def final_process(self, stem_path, source, stem_name):
+        with open(os.path.join(self.output_dir, stem_path), "wb") as f:
+            f.write(b"mp3")
+        return super().final_process(stem_path, source, stem_name)
+
+    def separate(self, audio_file_path):
+        self.separations += 1
+        rng = np.random.default_rng(0)
+        stereo = rng.normal(scale=0.1, size=(self.sample_rate, 2)).astype(np.float32)
+        self.final_process("out_(Instrumental).mp3", -stereo, "Instrumental")
+        self.final_process("out_(Vocals).mp3", stereo, "Vocals")
+        return ["out_(Instrumental).mp3", "out_(Vocals).mp3"]
+
+
+def test_cached_stems_give_the_same_vocals_as_separation(tmp_path):
+    from disk_cache import StemCache
+    from vocal_separator import separate_vocals
+
+    audio = tmp_path / "song.wav"
+    audio.write_bytes(b"audio")
+    out = tmp_path / "out"
+    out.mkdir()
+    separator = FakeSeparator()
+    separator.model_instance = FileWritingModel(str(out))
+    separator.output_dir = str(out)
+    cache = StemCache(tmp_path / "stems")
+
+    def separate(return_array=True):
+        return separate_vocals(
+            str(audio),
+            separator=separator,
+            stem_cache=cache,
+            return_array=return_array,
+            sr=16000,
+            metrics=Metrics(),
+        )
+
+    # ファイルだけを保存したエントリでは、MP3 をデコードせずに分離し直して配列を追加する
+    assert not separate(return_array=False)["cache_hit"]
+    miss = separate()
+    assert not miss["cache_hit"] and separator.model_instance.separations == 2
+
+    hit = separate()
+    assert hit["cache_hit"] and separator.model_instance.separations == 2
+    assert hit["sample_rate"] == miss["sample_rate"] == 16000
+    assert np.array_equal(hit["vocals"], miss["vocals"])
@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+
+
+# 速度と精度のトレードオフを、分離モデル・アライメントモデル・チャンク長・精度の組で選ぶ
+# (どのマシンでどの段を使うかは evaluate_tiers.py の計測結果で決める)
+
+
+@dataclass(frozen=True)
+class Tier:
+    """generate_lrc の処理段の設定をまとめたもの"""
+
+    name: str
+    # audio-separator のモデル名 (None ならボーカル抽出を行わない)
+    separator_model: object
+    # CTC アライメントに使う transformers のモデル ID
+    aligner_model: str
+    # 1 チャンクの最大秒数 (実際の長さは空きメモリからこれ以下で決める)
+    max_chunk_seconds: int
+    # "fp32" または "fp16" (fp16 は CUDA でのみ有効、それ以外のデバイスでは fp32)
+    precision: str
+
+
+TIERS = {
+    # 分離なし + base モデル (約 95M パラメータ)。CPU のみのマシン向け
+    "fast": Tier(
+        "fast",
+        separator_model=None,
+        aligner_model="facebook/wav2vec2-base-960h",
+        max_chunk_seconds=20,
+        precision="fp16",
+    ),
+    # 分離あり + base モデル。分離で伴奏の影響を除き、アライメントは軽くする
+    "balanced": Tier(
+        "balanced",
+        separator_model="UVR-MDX-NET-Voc_FT.onnx",
+        aligner_model="facebook/wav2vec2-base-960h",
+        max_chunk_seconds=30,
+        precision="fp16",
+    ),
+    # 分離あり + large モデル (約 315M パラメータ)。従来の既定の構成
+    "accurate": Tier(
+        "accurate",
+        separator_model="UVR-MDX-NET-Voc_FT.onnx",
+        aligner_model="facebook/wav2vec2-large-960h-lv60-self",
+        max_chunk_seconds=30,
+        precision="fp32",
+    ),
+}
+
+DEFAULT_TIER = "accurate"
+
+# アライメントモデルのパラメータ数 (常駐ワーカーのメモリの見積もり用)
+ALIGNER_PARAMETERS = {
+    "facebook/wav2vec2-base-960h": 95_000_000,
+    "facebook/wav2vec2-large-960h-lv60-self": 315_000_000,
+}
+
+
+def get_tier(name=None):
+    """名前から Tier を返す (None なら既定)。不明な名前は ValueError"""
+    if isinstance(name, Tier):
+        return name
+    name = name or DEFAULT_TIER
+    try:
+        return TIERS[name]
+    except KeyError:
+        raise ValueError(
+            f"不明なティアです: {name} (選択肢: {', '.join(TIERS)})"
+        ) from None
@@ -0,0 +1,134 @@
+import numpy as np
+
+from alignment import AlignmentPath
+
+
+# 分離済みボーカルの有声区間検出と、無音区間の emission の扱い (NumPy のみに依存)
+#
+# ボーカル抽出後の音声はイントロ・間奏・アウトロがほぼ無音になるので、フレーム (ホップ長)
+# ごとの RMS で有声区間を求め、そこだけを CTC モデルで推論する。飛ばした区間の emission は
+# blank だけが確率 1 の行 (skipped_rows) で埋めるので、フレーム位置とタイムスタンプは変わらない。
+# アライメントでは、飛ばした区間 (skipped_ranges) のうち長いものを前後の数フレームを残して
+# 詰めてからトレリスを計算し、パスのフレーム位置を元に戻す (compress_skipped / expand_path)。
+# 詰める区間は emission の値からは推測せず、VAD を実行したときの区間を明示的に受け取る。
+
+# 基準の音量 (上位 5% のフレームの RMS) からこの dB 以上小さいフレームは無音とみなす
+VAD_THRESHOLD_DB = 35.0
+# 絶対的な無音の下限 (dBFS)
+VAD_FLOOR_DB = -60.0
+REFERENCE_PERCENTILE = 95
+# 有声区間の前後に付ける余白 (秒)
+VAD_PAD_SECONDS = 0.5
+# これより短い無音は飛ばさない (推論のバッチが細切れになるだけで得がない)
+MIN_SKIP_SECONDS = 2.0
+# 有声の割合がこれ未満なら検出に失敗したとみなして全体を推論する
+MIN_ACTIVE_RATIO = 0.05
+
+# 飛ばした区間の blank 以外のトークンの log 確率
+SKIPPED_LOG_PROB = -30.0
+# 詰めるときに、飛ばした区間の前後に残すフレーム数
+KEEP_SKIPPED_FRAMES = 25
+
+
+def frame_rms_db(audio, hop):
+    """hop サンプルごとの RMS (dBFS)"""
+    audio = np.asarray(audio, dtype=np.float32)
+    n = len(audio) // hop
+    if n == 0:
+        return np.zeros(0)
+    blocks = audio[: n * hop].reshape(n, hop).astype(np.float64)
+    rms = np.sqrt(np.mean(blocks * blocks, axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+
+def _runs(mask):
+    """mask が True の区間の (start, stop) のリスト"""
+    padded = np.concatenate([[False], mask, [False]])
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def vocal_regions(
+    audio,
+    hop,
+    num_frames,
+    sr=16000,
+    threshold_db=VAD_THRESHOLD_DB,
+    pad_seconds=VAD_PAD_SECONDS,
+    min_skip_seconds=MIN_SKIP_SECONDS,
+):
+    """
+    推論するフレーム区間 [(start, stop), ...] を返す (num_frames はモデルの出力フレーム数)
+
+    飛ばす区間がない場合や、有声の割合が MIN_ACTIVE_RATIO 未満 (検出の失敗) の場合は None
+    """
+    db = frame_rms_db(audio, hop)[:num_frames]
+    if len(db) == 0:
+        return None
+    threshold = max(np.percentile(db, REFERENCE_PERCENTILE) - threshold_db, VAD_FLOOR_DB)
+    active = np.zeros(num_frames, dtype=bool)
+    active[: len(db)] = db > threshold
+    if active.mean() < MIN_ACTIVE_RATIO:
+        return None
+
+    # 有声フレームの前後に余白を付ける
+    pad = int(round(pad_seconds * sr / hop))
+    padded = np.zeros(num_frames, dtype=bool)
+    for start, stop in _runs(active):
+        padded[max(start - pad, 0) : min(stop + pad, num_frames)] = True
+
+    # 短い無音は推論する側に含める
+    min_skip = int(round(min_skip_seconds * sr / hop))
+    for start, stop in _runs(~padded):
+        if stop - start < min_skip:
+            padded[start:stop] = True
+
+    regions = _runs(padded)
+    if regions == [(0, num_frames)]:
+        return None
+    return regions
+
+
+def skipped_rows(num_frames, vocab_size, blank_id=0):
+    """飛ばした区間の emission (blank の log 確率が 0、それ以外は SKIPPED_LOG_PROB)"""
+    rows = np.full((num_frames, vocab_size), SKIPPED_LOG_PROB, dtype=np.float32)
+    rows[:, blank_id] = 0.0
+    return rows
+
+
+def skipped_ranges(regions, num_frames):
+    """vocal_regions の推論する区間以外 (skipped_rows で埋めた区間) [(start, stop), ...] を返す"""
+    if regions is None:
+        return None
+    inferred = np.zeros(num_frames, dtype=bool)
+    for start, stop in regions:
+        inferred[start:stop] = True
+    return _runs(~inferred)
+
+
+def compress_skipped(emission, skipped, keep=KEEP_SKIPPED_FRAMES):
+    """
+    飛ばした区間 (skipped_ranges) のうち 2 * keep より長いものを、前後 keep フレームだけ残して詰める
+
+    (詰めた emission, 残したフレームの元の位置) を返す。
+    skipped が None (VAD を実行していない) か詰める区間がなければ (emission, None)
+    """
+    emission = np.asarray(emission)
+    if not skipped:
+        return emission, None
+    drop = np.zeros(len(emission), dtype=bool)
+    for start, stop in skipped:
+        start, stop = max(start, 0), min(stop, len(emission))
+        if stop - start > 2 * keep:
+            drop[start + keep : stop - keep] = True
+    if not drop.any():
+        return emission, None
+    kept = np.flatnonzero(~drop)
+    return emission[kept], kept
+
+
+def expand_path(path, kept):
+    """compress_skipped で詰めた emission に対するパスのフレーム位置を元に戻す"""
+    if kept is None:
+        return path
+    return AlignmentPath(path.token_index, kept[path.frame], path.score)
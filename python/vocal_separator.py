@@ -2,193 +2,433 @@ import os
 import sys
 import json
 import argparse
+import contextlib
 import traceback
 import urllib.parse
+
+import numpy as np
 from audio_separator.separator import Separator
 
+from audio_io import StreamingUnsupported
+from disk_cache import StemCache, file_digest
+from hardware import backend_candidates
+from metrics import Metrics, append_metrics, stage
+from model_store import resolve_separator, set_offline
+from provider_probe import forget_probe, working_backends
+from resource_policy import PROFILES, apply_process_policy, limit_ort_threads
+from streaming_separation import OVERLAP_SECONDS, WINDOW_SECONDS, StreamingSeparation
+
+
+# バックエンド名 (hardware.BACKENDS) と Separator の引数、ログ用の説明
+SEPARATOR_BACKENDS = {
+    "cuda": ("use_cuda", "CUDA backend (NVIDIA GPU)"),
+    "directml": ("use_directml", "DirectML backend (AMD/Intel GPU)"),
+    "coreml": ("use_coreml", "Core ML backend (Apple Silicon)"),
+    "cpu": ("use_cpu", "CPU backend"),
+}
+
 
-def get_optimal_separator(output_dir: str, backend: str = "auto") -> Separator:
+def get_optimal_separator(
+    output_dir: str, backend: str = "auto", model_file_dir: str = None
+) -> Separator:
     """
     プラットフォームと利用可能なハードウェアに基づいて最適なSeparatorを初期化する
 
-    【Windows専用の現状】
-    - 現在は use_directml=True で固定（Windows + AMD/Intel GPU専用）
-    - CUDAやMacでは動作しない
-
-    【拡張方法: クロスプラットフォーム対応】
     audio-separatorは以下のバックエンドをサポート:
     1. CUDA (NVIDIA GPU) -> use_cuda=True
     2. DirectML (Windows AMD/Intel GPU) -> use_directml=True
     3. Core ML (Apple Silicon Mac) -> use_coreml=True
     4. CPU (フォールバック) -> use_cpu=True
 
-    優先順位の例:
+    優先順位は lrc_generator の CTC モデルと共通 (hardware.backend_candidates):
     - Windows: CUDA > DirectML > CPU
     - macOS: Core ML > CPU
     - Linux: CUDA > CPU
+    backend を指定した場合はそのバックエンドだけを使う。
+    model_file_dir を指定すると、モデルのファイルをそこから読み込む。
+
+    自動選択では provider_probe で動くと確かめた (保存済みの) バックエンドだけを試すので、
+    使えないバックエンドの Separator を作って失敗する時間がかからない。
     """
-    # バックエンドが強制指定されている場合
-    if backend != "auto":
-        if backend == "cuda":
-            print("[INFO] Using CUDA backend (forced)")
-            return Separator(output_dir=output_dir, output_format="MP3", use_cuda=True)
-        elif backend == "directml":
-            print("[INFO] Using DirectML backend (forced)")
-            return Separator(output_dir=output_dir, output_format="MP3", use_directml=True)
-        elif backend == "coreml":
-            print("[INFO] Using Core ML backend (forced)")
-            return Separator(output_dir=output_dir, output_format="MP3", use_coreml=True)
-        elif backend == "cpu":
-            print("[INFO] Using CPU backend (forced)")
-            return Separator(output_dir=output_dir, output_format="MP3", use_cpu=True)
-
-    platform = sys.platform
-
-    # Windowsの場合
-    if platform == "win32":
-        # まずCUDAを試す（NVIDIA GPUが最も高速）
+    candidates = backend_candidates(backend)
+    if backend == "auto":
+        working = working_backends()
+        if working is not None:
+            candidates = [name for name in candidates if name in working] or ["cpu"]
+    extra = {"model_file_dir": model_file_dir} if model_file_dir else {}
+    for i, name in enumerate(candidates):
+        option, label = SEPARATOR_BACKENDS[name]
         try:
             separator = Separator(
-                output_dir=output_dir,
-                output_format="MP3",
-                use_cuda=True,
+                output_dir=output_dir, output_format="MP3", **extra, **{option: True}
             )
-            print("[INFO] Using CUDA backend (NVIDIA GPU)")
-            return separator
         except Exception:
-            pass
+            if backend != "auto" or i == len(candidates) - 1:
+                raise
+            # 自動選択では次の候補を試す (強制指定と最後の候補の CPU は失敗をそのまま送出する)。
+            # 動作確認の結果と食い違ったので、次回は確かめ直す
+            forget_probe()
+            continue
+        forced = " (forced)" if backend != "auto" else ""
+        print(f"[INFO] Using {label}{forced}", file=sys.stderr)
+        return separator
 
-        # 次にDirectMLを試す（AMD/Intel GPU）
-        try:
-            separator = Separator(
-                output_dir=output_dir,
-                output_format="MP3",
-                use_directml=True,
-            )
-            print("[INFO] Using DirectML backend (AMD/Intel GPU)")
-            return separator
-        except Exception:
-            pass
 
-        # 最後にCPU
-        separator = Separator(
-            output_dir=output_dir,
-            output_format="MP3",
-            use_cpu=True,
-        )
-        print("[INFO] Using CPU backend")
-        return separator
+def load_separator(output_dir, model_name="UVR-MDX-NET-Voc_FT.onnx", backend="auto"):
+    """
+    バックエンドを選択してSeparatorを初期化し、モデルをロードした状態で返す
+    (常駐ワーカーではこの戻り値を使い回す)
+    """
+    # モデルのファイルはローカルのモデルストアから読み込む (なければ取得して保存する)
+    model_file_dir = resolve_separator(model_name)
 
-    # macOSの場合
-    elif platform == "darwin":
-        # Core MLを試す（Apple Silicon: M1/M2/M3）
-        try:
-            separator = Separator(
-                output_dir=output_dir,
-                output_format="MP3",
-                use_coreml=True,
-            )
-            print("[INFO] Using Core ML backend (Apple Silicon)")
-            return separator
-        except Exception:
-            pass
+    # プラットフォームに応じたSeparatorを取得
+    separator = get_optimal_separator(output_dir, backend, model_file_dir)
 
-        # Intel Macの場合はCPU
-        separator = Separator(
-            output_dir=output_dir,
-            output_format="MP3",
-            use_cpu=True,
-        )
-        print("[INFO] Using CPU backend (Intel Mac)")
-        return separator
+    # モデルのロード
+    # MDX23C-InstVoc-HQ はボーカルとインストを高品質に分離するSOTAモデルの一つ
+    # onnxruntime のセッションのスレッド数は resource_policy の上限に合わせる
+    limit_ort_threads()
+    separator.load_model(model_name)
+    return separator
 
-    # Linuxの場合
-    elif platform == "linux":
-        # CUDAを試す
-        try:
-            separator = Separator(
-                output_dir=output_dir,
-                output_format="MP3",
-                use_cuda=True,
-            )
-            print("[INFO] Using CUDA backend (NVIDIA GPU)")
-            return separator
-        except Exception:
-            pass
 
-        # CPUフォールバック
-        separator = Separator(
-            output_dir=output_dir,
-            output_format="MP3",
-            use_cpu=True,
-        )
-        print("[INFO] Using CPU backend")
-        return separator
+def stem_to_array(source, orig_sr, sr=None, mono=True):
+    """分離結果 (サンプル数 × チャンネル数) を float32 の波形 (mono なら 1 次元) にする"""
+    import librosa
 
-    # その他のプラットフォーム
-    else:
-        separator = Separator(
-            output_dir=output_dir,
-            output_format="MP3",
-            use_cpu=True,
+    y = np.asarray(source, dtype=np.float32).T
+    if mono:
+        y = librosa.to_mono(y)
+    if sr is not None and sr != orig_sr:
+        y = librosa.resample(y, orig_sr=orig_sr, target_sr=sr)
+    return np.ascontiguousarray(y, dtype=np.float32)
+
+
+@contextlib.contextmanager
+def capture_stems(separator, write_files=True):
+    """
+    分離中の各ステムの波形を {ステム名: 配列} に集める
+
+    audio-separator はステムごとに model_instance.final_process で書き出すので、
+    それを差し替えて配列を受け取る。write_files が False ならファイルには書き出さない。
+    """
+    model = separator.model_instance
+    original = model.final_process
+    captured = {}
+
+    def final_process(stem_path, source, stem_name):
+        captured[stem_name] = source
+        if write_files:
+            return original(stem_path, source, stem_name)
+        return {stem_name: source}
+
+    model.final_process = final_process
+    try:
+        yield captured
+    finally:
+        del model.final_process
+
+
+def window_separator(separator):
+    """
+    読み込み済みの Separator のモデルで、1 ウィンドウ ((サンプル数, 2) のステレオ、
+    モデルのサンプリングレート) のボーカルを返す関数を作る
+
+    ファイル単位の Separator.separate ではなく、モデルの demix を直接呼ぶ
+    (入力全体での音量の正規化は行わない)。demix のないモデルは StreamingUnsupported。
+    """
+    model = separator.model_instance
+    if not hasattr(model, "demix"):
+        raise StreamingUnsupported(
+            f"{type(model).__name__} はウィンドウごとの分離に対応していません"
         )
-        print(f"[INFO] Unknown platform ({platform}), using CPU backend")
-        return separator
+    vocals_primary = str(getattr(model, "primary_stem_name", "Vocals")).lower() == "vocals"
+
+    def separate(window):
+        mix = np.ascontiguousarray(window.T)
+        source = model.demix(mix)
+        if isinstance(source, dict):
+            # 複数のステムを返すモデル (MDXC など)
+            source = next((v for k, v in source.items() if k.lower() == "vocals"), None)
+            if source is None:
+                raise ValueError("ボーカルのステムがありません")
+        elif not vocals_primary:
+            source = mix - source
+        return np.asarray(source, dtype=np.float32).T
+
+    return separate
+
+
+def stream_vocals(
+    input_audio_path,
+    separator,
+    sr=None,
+    mono=True,
+    window_seconds=WINDOW_SECONDS,
+    overlap_seconds=OVERLAP_SECONDS,
+):
+    """
+    ボーカルをウィンドウごとに分離する StreamingSeparation を返す (長い録音向け)
+
+    スライスした区間までしか分離しないので、呼び出し側は最初のウィンドウから処理を始められる。
+    分離が終わるまで separator を他の用途に使ってはいけない。sr が None ならモデルの
+    サンプリングレートのまま返す。soundfile で読めない形式は StreamingUnsupported。
+    """
+    return StreamingSeparation(
+        input_audio_path,
+        window_separator(separator),
+        separator.model_instance.sample_rate,
+        sr,
+        mono,
+        window_seconds,
+        overlap_seconds,
+    )
+
+
+def write_stream(stream, path, block_seconds=WINDOW_SECONDS):
+    """StreamingSeparation を先頭から順に分離しながら path に書き出す (全体をメモリに持たない)"""
+    import soundfile
+
+    block = int(block_seconds * stream.sr)
+    channels = 1 if stream.mono else 2
+    with soundfile.SoundFile(path, "w", samplerate=stream.sr, channels=channels) as f:
+        for start in range(0, len(stream), block):
+            f.write(stream[start : start + block])
+            stream.release(start + block)
 
 
 def separate_vocals(
-    input_audio_path, output_dir=None, model_name="UVR-MDX-NET-Voc_FT.onnx", backend="auto"
+    input_audio_path,
+    output_dir=None,
+    model_name="UVR-MDX-NET-Voc_FT.onnx",
+    backend="auto",
+    separator=None,
+    stem_cache=None,
+    return_array=False,
+    sr=None,
+    mono=True,
+    metrics=None,
 ):
     """
     audio-separatorライブラリを使用してボーカルを抽出する
 
-    【Windows専用の現状】
-    - use_directml=True でAMD GPUを強制使用
-    - file:// プレフィックス処理もWindowsパス前提
+    バックエンドは get_optimal_separator() で選ぶ (CTC モデルと共通の優先順。
+    backend="auto" なら CUDA / DirectML / Core ML / CPU のうち動くもの、指定すればそれだけ)。
+
+    separator に load_separator() の戻り値を渡すと、モデルのロードを省略して
+    その出力先 (separator.output_dir) に書き出す。
+
+    stem_cache (StemCache) を渡すと、音声の内容とモデルが同じ分離結果を再利用する。
+    未ヒットなら分離結果をキャッシュに移動して返す。どちらの場合も返すパスは
+    キャッシュ内のファイルなので、呼び出し側で削除してはいけない (結果の cache_dir が None 以外)。
+    return_array の配列は MP3 をデコードせず、分離したときの配列をそのまま保存したものを返す
+    (sr と mono の組の配列がまだなければ、分離し直して保存する)。
+
+    return_array が True なら、ボーカルの波形を float32 の配列 (結果の "vocals") で返す。
+    sr を指定するとそのサンプリングレートに変換し、mono なら 1 チャンネルにする
+    (結果の "sample_rate" が配列のサンプリングレート)。ファイルへの書き出しと
+    読み直しを省くため、stem_cache がなければステムのファイルは作らない
+    (vocal_path / instrumental_path は None)。
 
-    【拡張方法】
-    1. get_optimal_separator() を使ってプラットフォームに応じたバックエンドを選択
-    2. ファイルパス処理をクロスプラットフォーム対応に
+    metrics (Metrics) を渡すとステージごとの計測をそこに記録する。省略した場合は
+    結果の "metrics" に入れて返し、BADWAVE_METRICS_FILE があれば追記する。
     """
-    if output_dir is None:
+    args = (
+        input_audio_path,
+        output_dir,
+        model_name,
+        backend,
+        separator,
+        stem_cache,
+        return_array,
+        sr,
+        mono,
+    )
+    if metrics is not None:
+        return _separate_vocals(*args, metrics)
+
+    metrics = Metrics()
+    result = _separate_vocals(*args, metrics)
+    result["metrics"] = metrics.as_dict()
+    append_metrics(
+        {
+            "command": "separate",
+            "status": result["status"],
+            "model": model_name,
+            "cache_hit": result.get("cache_hit"),
+            **result["metrics"],
+        }
+    )
+    return result
+
+
+def _separate_vocals(
+    input_audio_path,
+    output_dir,
+    model_name,
+    backend,
+    separator,
+    stem_cache,
+    return_array,
+    sr,
+    mono,
+    metrics,
+):
+    if separator is not None:
+        output_dir = separator.output_dir
+    elif output_dir is None:
         output_dir = os.path.dirname(os.path.abspath(input_audio_path)) or "."
     else:
         output_dir = os.path.abspath(output_dir)
 
     try:
-        # プラットフォームに応じたSeparatorを取得
-        separator = get_optimal_separator(output_dir, backend)
-
-        # モデルのロード
-        # MDX23C-InstVoc-HQ はボーカルとインストを高品質に分離するSOTAモデルの一つ
-        separator.load_model(model_name)
+        cache_key = None
+        if stem_cache is not None:
+            with stage(metrics, "stem_cache_lookup"):
+                cache_key = StemCache.key(file_digest(input_audio_path), model_name)
+                cached = stem_cache.get(cache_key)
+            if cached is not None and return_array:
+                # 保存した配列がなければ (ファイルだけを保存したエントリ)、分離し直して追加する
+                with stage(metrics, "stem_array_load"):
+                    loaded = stem_cache.get_array(cache_key, sr, mono)
+                if loaded is None:
+                    cached = None
+            if cached is not None:
+                result = {
+                    "status": "success",
+                    "vocal_path": cached[StemCache.VOCALS],
+                    "instrumental_path": cached[StemCache.INSTRUMENTAL],
+                    "output_files": [
+                        os.path.basename(p) for p in cached.values() if p
+                    ],
+                    "cache_dir": os.path.dirname(cached[StemCache.VOCALS]),
+                    "cache_hit": True,
+                }
+                if return_array:
+                    result["vocals"], result["sample_rate"] = loaded
+                return result
+
+        if separator is None:
+            with stage(metrics, "separator_load", model=model_name):
+                separator = load_separator(output_dir, model_name, backend)
 
         # 分離実行
         # outputs[0] が通常ボーカル、[1] がインストゥルメンタル
-        output_files = separator.separate(input_audio_path)
+        write_files = not return_array or cache_key is not None
+        stem_sr = separator.model_instance.sample_rate
+        with stage(metrics, "separation", model=model_name):
+            with capture_stems(separator, write_files) as captured:
+                output_files = separator.separate(input_audio_path)
 
         vocal_path = None
         instrumental_path = None
 
         # ファイル名を特定 (audio-separatorはデフォルトで {input}_{model}_Vocals.mp3 のような名前を付ける)
-        for file in output_files:
-            if "Vocals" in file:
-                vocal_path = os.path.join(output_dir, file)
-            elif "Instrumental" in file:
-                instrumental_path = os.path.join(output_dir, file)
-
-        return {
+        if write_files:
+            for file in output_files:
+                if "Vocals" in file:
+                    vocal_path = os.path.join(output_dir, file)
+                elif "Instrumental" in file:
+                    instrumental_path = os.path.join(output_dir, file)
+        else:
+            output_files = []
+
+        cache_dir = None
+        if cache_key is not None and vocal_path:
+            with stage(metrics, "stem_cache_store"):
+                stems = stem_cache.put(
+                    cache_key,
+                    {StemCache.VOCALS: vocal_path, StemCache.INSTRUMENTAL: instrumental_path},
+                )
+            vocal_path = stems[StemCache.VOCALS]
+            instrumental_path = stems[StemCache.INSTRUMENTAL]
+            output_files = [os.path.basename(p) for p in stems.values() if p]
+            cache_dir = os.path.dirname(vocal_path)
+
+        result = {
             "status": "success",
             "vocal_path": vocal_path,
             "instrumental_path": instrumental_path,
             "output_files": output_files,
+            "cache_dir": cache_dir,
+            "cache_hit": False,
         }
+        if return_array:
+            vocals = next(
+                (v for name, v in captured.items() if name.lower() == "vocals"), None
+            )
+            if vocals is None:
+                return {"status": "error", "message": "ボーカルのステムがありません"}
+            with stage(metrics, "stem_to_array"):
+                result["vocals"] = stem_to_array(vocals, stem_sr, sr, mono)
+            result["sample_rate"] = sr or stem_sr
+            if cache_key is not None and cache_dir is not None:
+                with stage(metrics, "stem_array_store"):
+                    stem_cache.put_array(
+                        cache_key, result["vocals"], result["sample_rate"], sr, mono
+                    )
+        return result
 
     except Exception as e:
         traceback.print_exc()
         return {"status": "error", "message": str(e)}
 
 
+def stream_separate_vocals(
+    input_audio_path, output_dir=None, model_name="UVR-MDX-NET-Voc_FT.onnx", backend="auto"
+):
+    """
+    ボーカルだけをウィンドウごとに分離しながら FLAC に書き出す (1 時間を超える録音など)
+
+    インストゥルメンタルは作らず (instrumental_path は None)、ステムのキャッシュも使わない。
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(input_audio_path)) or "."
+    output_dir = os.path.abspath(output_dir)
+    metrics = Metrics()
+    result = _stream_separate_vocals(
+        input_audio_path, output_dir, model_name, backend, metrics
+    )
+    result["metrics"] = metrics.as_dict()
+    append_metrics(
+        {
+            "command": "separate",
+            "status": result["status"],
+            "model": model_name,
+            "streaming": True,
+            **result["metrics"],
+        }
+    )
+    return result
+
+
+def _stream_separate_vocals(input_audio_path, output_dir, model_name, backend, metrics):
+    try:
+        with stage(metrics, "separator_load", model=model_name):
+            separator = load_separator(output_dir, model_name, backend)
+        name = os.path.splitext(os.path.basename(input_audio_path))[0]
+        vocal_path = os.path.join(output_dir, f"{name}_(Vocals)_{model_name}.flac")
+        stream = stream_vocals(input_audio_path, separator)
+        try:
+            with stage(metrics, "separation", model=model_name, streaming=True) as record:
+                write_stream(stream, vocal_path)
+                record["windows"] = stream.windows
+        finally:
+            stream.close()
+        return {
+            "status": "success",
+            "vocal_path": vocal_path,
+            "instrumental_path": None,
+            "output_files": [os.path.basename(vocal_path)],
+            "cache_dir": None,
+            "cache_hit": False,
+        }
+    except Exception as e:
+        traceback.print_exc()
+        return {"status": "error", "message": str(e)}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Vocal Separation using audio-separator"
@@ -213,17 +453,44 @@ if __name__ == "__main__":
         ),
     )
 
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="Reuse and store stems in the shared stem cache instead of output_dir",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never access the network; the model must already be in the local model store",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Separate in overlapping windows and write only the vocal stem (flat memory for long recordings)",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default=None,
+        help="Resource profile: thread cap, process priority and memory ceiling (default: foreground, or BADWAVE_PROFILE)",
+    )
+    parser.add_argument(
+        "--reprobe",
+        action="store_true",
+        help="Re-check which onnxruntime execution providers work instead of using the saved result",
+    )
+
     args = parser.parse_args()
+    if args.offline:
+        set_offline()
+    if args.reprobe:
+        working_backends(refresh=True)
+    apply_process_policy(args.profile)
 
     input_path = args.input
 
-    # file:// プレフィックスの除去
-    # 【Windows専用の現状】
-    # - Windowsドライブ文字（C:など）の処理がWindows固有
-    # - input_path[2] == ":" はWindowsパス前提
-    #
-    # 【クロスプラットフォーム対応】
-    # urllib.parse.urlparse() を使うとURLを正しく解析できる
+    # file:// URL をローカルのパスに変換する (どのプラットフォームでも urlparse で解析し、
+    # Windows だけドライブ文字の前の / を除く)。バックエンドは --backend で選ぶ
     if input_path.startswith("file://"):
         # 標準的な方法でfile URLをパース
         parsed = urllib.parse.urlparse(input_path)
@@ -237,26 +504,33 @@ if __name__ == "__main__":
 
     input_path = os.path.abspath(input_path)
 
-    result = separate_vocals(input_path, args.output_dir, args.model, args.backend)
+    if args.stream:
+        result = stream_separate_vocals(input_path, args.output_dir, args.model, args.backend)
+    else:
+        result = separate_vocals(
+            input_path,
+            args.output_dir,
+            args.model,
+            args.backend,
+            stem_cache=StemCache() if args.use_cache else None,
+        )
     print(json.dumps(result))
 
 
 """
 ================================================================================
-【Windows専用の現状とクロスプラットフォーム拡張方法】
+【バックエンドの選択とプラットフォームごとの準備】
 ================================================================================
 
-■ 現在のWindows専用部分
+■ 現在の実装
 
-1. バックエンド固定
-   - use_directml=True でAMD/Intel GPUを強制使用
-   - NVIDIA GPU (CUDA) や Mac (Core ML) では動作しない
-   - コード: Separator(output_dir=..., use_directml=True)
+1. バックエンドの選択
+   - get_optimal_separator() が hardware.backend_candidates の優先順で選ぶ
+     (lrc_generator の CTC モデルと共通。--backend で強制指定もできる)
+   - 自動選択では provider_probe で動くと確かめたバックエンドだけを試す
 
 2. ファイルパス処理
-   - Windowsドライブ文字（C:など）の処理がWindows固有
-   - input_path[2] == ":" はWindowsパス前提
-   - file:// URLのパースがWindows向け
+   - file:// URL は urllib.parse で解析し、Windows だけドライブ文字の前の / を除く
 
 
 ■ 拡張方法: CUDA対応
@@ -76,6 +76,29 @@ function copyDir(src, dest) {
   }
 }
 
+// 配布に含めない開発用スクリプト (テスト・ベンチマーク・評価) の接頭辞
+const DEV_SCRIPT_PREFIXES = ["test_", "benchmark_", "evaluate_"];
+
+/**
+ * srcDir 直下の Python スクリプト (開発用を除く) を destDir にコピーし、コピーしたファイル名を返す
+ *
+ * lrc_generator.py などはモジュールを増やすたびに import するので、一覧を持たずに
+ * ディレクトリ内をすべてコピーする (一覧の更新漏れで起動時に ModuleNotFoundError になるのを防ぐ)。
+ */
+function copyPythonScripts(srcDir, destDir) {
+  fs.mkdirSync(destDir, { recursive: true });
+  const scripts = fs
+    .readdirSync(srcDir, { withFileTypes: true })
+    .filter((entry) => entry.isFile() && entry.name.endsWith(".py"))
+    .map((entry) => entry.name)
+    .filter((name) => !DEV_SCRIPT_PREFIXES.some((prefix) => name.startsWith(prefix)))
+    .sort();
+  for (const script of scripts) {
+    fs.copyFileSync(path.join(srcDir, script), path.join(destDir, script));
+  }
+  return scripts;
+}
+
 async function main() {
   console.log("=== Embedded Python ビルド開始 ===\n");
 
@@ -154,14 +177,8 @@ async function main() {
 
   // 7. Python スクリプトをコピー
   console.log("\n[Step 6] Python スクリプトをコピー中...");
-  const scripts = ["lrc_generator.py", "vocal_separator.py"];
-  for (const script of scripts) {
-    const src = path.join(PYTHON_DIR, script);
-    const dest = path.join(PYTHON_DIST_DIR, script);
-    if (fs.existsSync(src)) {
-      fs.copyFileSync(src, dest);
-      console.log(`  - ${script}`);
-    }
+  for (const script of copyPythonScripts(PYTHON_DIR, PYTHON_DIST_DIR)) {
+    console.log(`  - ${script}`);
   }
 
   // 8. 不要なファイルを削除してサイズ削減
@@ -197,7 +214,11 @@ async function main() {
   console.log(`サイズ: ${(totalSize / 1024 / 1024).toFixed(1)} MB`);
 }
 
-main().catch((err) => {
-  console.error("ビルドエラー:", err);
-  process.exit(1);
-});
+if (require.main === module) {
+  main().catch((err) => {
+    console.error("ビルドエラー:", err);
+    process.exit(1);
+  });
+}
+
+module.exports = { copyPythonScripts };